@@ -1,16 +1,28 @@
 import os
 
 from dotenv import load_dotenv
-from flask import Flask, render_template
+from flask import Flask, Response, render_template
 from flask_socketio import SocketIO
 from flask_cors import CORS
 
 from .database import MongoDBHandler
+from .log import configure_logging
+from . import metrics
 
 load_dotenv()
-socketio = SocketIO(cors_allowed_origins='*')
+configure_logging()
+# Threading mode works both under the dev server and gunicorn's gthread worker; the message queue
+# (e.g. redis://) lets separate web and services instances emit to each other's clients
+socketio = SocketIO(cors_allowed_origins='*',
+                    async_mode=os.environ.get('SOCKETIO_ASYNC_MODE', 'threading'),
+                    message_queue=os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None)
 mongodb = MongoDBHandler(os.environ.get('MONGODB_URI'),
-                         os.environ.get('DATABASE_NAME' ))
+                         os.environ.get('DATABASE_NAME' ),
+                         pose_format=os.environ.get('POSE_STORAGE_FORMAT', 'list'),
+                         compress_poses=os.environ.get('POSE_COMPRESSION', 'false').lower() == 'true',
+                         write_concern=os.environ.get('MONGODB_WRITE_CONCERN'),
+                         max_batch=int(os.environ.get('MONGODB_WRITE_BATCH', 500)),
+                         max_latency=float(os.environ.get('MONGODB_WRITE_LATENCY', 0.5)))
 
 
 # mongodb = MongoDBHandler(os.environ.get('MONGODB_URI'), os.environ.get('DATABASE_NAME'))
@@ -36,6 +48,11 @@ def create_app():
     def index():
         return render_template('index.html')
 
+    @app.route('/metrics')
+    def metrics_endpoint():
+        # Per process: with several gunicorn workers each scrape sees the worker that answered it
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
     return app, socketio
 
 
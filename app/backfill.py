@@ -0,0 +1,329 @@
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from pymongo.errors import BulkWriteError
+
+from .database import POSE_PROJECTION
+from .pose_codec import decode_pose
+from .resampling import resample_streams, split_sources
+from .shift_estimation import ShiftTable, merge_windows
+from .utils import pre_normalization
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+# Merged pose windows fetched per query; each becomes one branch of an $or on the (service, timestamp) index
+WINDOWS_PER_QUERY = 200
+
+
+class BackfillJob:
+    """
+    Relabel the recorded events of one device over a time range, in bulk.
+
+    The range is split into chunks of ``chunk_hours``. For each chunk the event notifications are replayed
+    through the shift logic, the pose windows of all events are read with a few large range queries,
+    normalized in one batch and written with ``insert_many``. Finished chunks are recorded in
+    ``progress_collection`` so an interrupted job resumes where it stopped; written documents get an _id
+    derived from the job and event, so a chunk that is processed twice does not duplicate its windows.
+    Windows are sampled like fetch_poses with the same ``sampling``, ``min_quality`` and ``max_gap``.
+    """
+
+    def __init__(self, device_name, start_time, end_time, version="backfill", num_of_poses=30, past_time=None,
+                 custom_shape=(3, 25), source=None, chunk_hours=24, notification_collection="notification",
+                 pose_collection="results", labeled_collection="labeled_poses",
+                 progress_collection="backfill_progress", sampling="resample", min_quality=0.5, max_gap=100):
+        self.device_name = device_name
+        self.start_time = start_time
+        self.end_time = end_time
+        self.version = version
+        self.num_of_poses = num_of_poses
+        self.past_time = past_time  # seconds; None uses the duration recorded with each event
+        self.custom_shape = tuple(custom_shape)
+        self.source = source
+        self.chunk_ms = int(chunk_hours * 3600 * 1000)
+        self.notification_collection = notification_collection
+        self.pose_collection = pose_collection
+        self.labeled_collection = labeled_collection
+        self.progress_collection = progress_collection
+        self.sampling = sampling  # "resample", or "ids" for the former stride selection
+        self.min_quality = min_quality
+        self.max_gap = max_gap  # ms
+
+    @property
+    def job_id(self):
+        return f"{self.device_name}:{self.start_time}:{self.end_time}:{self.version}"
+
+    def chunks(self):
+        return [(start, min(start + self.chunk_ms, self.end_time))
+                for start in range(self.start_time, self.end_time, self.chunk_ms)]
+
+    def pending_chunks(self, mongo_db):
+        progress = mongo_db.get_collection(self.progress_collection).find_one({"_id": self.job_id}) or {}
+        done = {tuple(chunk) for chunk in progress.get("done", [])}
+        return [chunk for chunk in self.chunks() if chunk not in done]
+
+    def mark_done(self, mongo_db, chunk, stats):
+        mongo_db.get_collection(self.progress_collection).update_one(
+            {"_id": self.job_id},
+            {"$addToSet": {"done": list(chunk)},
+             "$inc": {f"stats.{key}": value for key, value in stats.items()},
+             "$set": {"updated": int(time.time() * 1000)}},
+            upsert=True)
+
+    def fetch_events(self, mongo_db, chunk):
+        """Events of the chunk as (label timestamp, label, past_time, event id) tuples."""
+        start, end = chunk
+        collection = mongo_db.get_collection(self.notification_collection)
+        query = {"$or": [
+            {"service": self.device_name, "event_time": {"$gte": start, "$lt": end}},
+            # Notifications from before event_time was recorded only have the shifted label timestamp
+            {"service": self.device_name, "timestamp": {"$gte": start, "$lt": end}, "event_time": None},
+        ]}
+        events = []
+        for document in collection.find(query, {"timestamp": 1, "event_time": 1, "switch": 1, "label_status": 1,
+                                                "duration": 1}):
+            if document.get("event_time") is not None:
+                shift = shift_table(mongo_db).shift(self.device_name, document.get("switch"))
+                timestamp = int(document["event_time"] - shift * 1000)
+            elif document.get("timestamp") is not None:
+                timestamp = document["timestamp"]
+            else:
+                continue
+            past_time = self.past_time if self.past_time is not None else document.get("duration") or 5
+            label = document.get("label_status")
+            events.append((timestamp, 1 if label is None else label, past_time, str(document["_id"])))
+        events.sort()
+        return events
+
+    def fetch_poses(self, mongo_db, windows):
+        """
+        Timestamps, poses and sources of every pose inside ``windows``, in chronological order.
+
+        The poses are stacked into one array, unless the chunk mixes person counts: they are then a 1-D object
+        array of single poses, from which every window keeps the frames that stack with its first one.
+        """
+        collection = mongo_db.get_collection(self.pose_collection)
+        projection = {**POSE_PROJECTION, mongo_db.source_field: 1}
+        timestamps, poses, sources = [], [], []
+        for offset in range(0, len(windows), WINDOWS_PER_QUERY):
+            branches = []
+            for start, end in windows[offset:offset + WINDOWS_PER_QUERY]:
+                branch = {"service": "pose_detector", "timestamp": {"$gte": start, "$lte": end}}
+                if self.source is not None:
+                    branch[mongo_db.source_field] = self.source
+                branches.append(branch)
+            # Sorted here rather than by the server, which would have to sort the $or results in memory
+            for document in collection.find({"$or": branches, "pose": {"$ne": None}}, projection):
+                pose = decode_pose(document["pose"])
+                if pose.shape[:-1] == self.custom_shape:
+                    timestamps.append(document["timestamp"])
+                    poses.append(pose)
+                    sources.append(document.get(mongo_db.source_field))
+        if not poses:
+            return np.empty(0, dtype=np.int64), None, np.empty(0, dtype=object)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        source_array = np.empty(len(sources), dtype=object)
+        source_array[:] = sources
+        if len({pose.shape for pose in poses}) == 1:
+            pose_array = np.stack(poses)
+        else:
+            pose_array = np.empty(len(poses), dtype=object)
+            for index, pose in enumerate(poses):
+                pose_array[index] = pose
+        order = np.argsort(timestamps, kind="stable")
+        return timestamps[order], pose_array[order], source_array[order]
+
+    def sampled_windows(self, pose_times, poses, events):
+        """Evenly spaced poses of every event window with enough poses, like fetch_poses "ids"."""
+        sampled, kept = [], []
+        for position, (timestamp, _, past_time, _) in enumerate(events):
+            first = int(np.searchsorted(pose_times, timestamp - past_time * 1000, side="left"))
+            last = int(np.searchsorted(pose_times, timestamp, side="right"))
+            indices = _stackable(poses, first, last)
+            if len(indices) < self.num_of_poses:
+                continue
+            step = max(len(indices) // self.num_of_poses, 1)
+            sampled.append(_stack(poses, indices[np.arange(self.num_of_poses) * step]))
+            kept.append(position)
+        return kept, sampled
+
+    def resampled_windows(self, pose_times, poses, sources, events):
+        """
+        Every event window resampled onto ``num_of_poses`` frames, like fetch_poses "resample": each camera's
+        poses separately, keeping the best camera's window.
+        """
+        streams = split_sources(pose_times, poses, sources)
+        resampled, kept = [], []
+        for position, (timestamp, _, past_time, _) in enumerate(events):
+            start_time = timestamp - past_time * 1000
+            # The person count of the window's first frame, over every camera like fetch_poses
+            first = int(np.searchsorted(pose_times, start_time - self.max_gap, side="left"))
+            last = int(np.searchsorted(pose_times, timestamp, side="right"))
+            shape = poses[first].shape if last > first and poses.dtype == object else None
+            windows = {}
+            for source, (times, frames) in streams.items():
+                first = int(np.searchsorted(times, start_time - self.max_gap, side="left"))
+                last = int(np.searchsorted(times, timestamp, side="right"))
+                indices = _stackable(frames, first, last, shape)
+                if indices.size:
+                    windows[source] = (times[indices], _stack(frames, indices))
+            frames, quality, _ = resample_streams(windows, start_time, timestamp, self.num_of_poses, self.max_gap)
+            if frames is None or quality < self.min_quality:
+                continue
+            resampled.append(frames)
+            kept.append(position)
+        return kept, resampled
+
+    def normalize(self, windows):
+        """pre_normalization of every (T, C, V, M) window, in one batch per person count M."""
+        normalized = [None] * len(windows)
+        groups = {}
+        for row, window in enumerate(windows):
+            groups.setdefault(window.shape, []).append(row)
+        for rows in groups.values():
+            # (E, T, C, V, M) reshaped to (E, C, T, V, M) exactly like fetch_poses, then normalized at once
+            batch = np.stack([windows[row] for row in rows]).reshape(
+                (len(rows), self.custom_shape[0], self.num_of_poses, self.custom_shape[1], -1)).astype(np.float64)
+            for row, window in zip(rows, pre_normalization(batch)):
+                normalized[row] = window
+        return normalized
+
+    def process_chunk(self, mongo_db, chunk):
+        started = time.perf_counter()
+        stats = {"events": 0, "written": 0, "duplicates": 0, "insufficient_poses": 0}
+        events = self.fetch_events(mongo_db, chunk)
+        stats["events"] = len(events)
+        if events:
+            windows = merge_windows([timestamp - past_time * 1000 - self.max_gap for timestamp, _, past_time, _
+                                     in events], [timestamp for timestamp, _, _, _ in events])
+            pose_times, poses, sources = self.fetch_poses(mongo_db, windows)
+            if poses is None:
+                kept, frames = [], []
+            elif self.sampling == "resample":
+                kept, frames = self.resampled_windows(pose_times, poses, sources, events)
+            else:
+                kept, frames = self.sampled_windows(pose_times, poses, events)
+            stats["insufficient_poses"] = len(events) - len(kept)
+            if kept:
+                normalized = self.normalize(frames)
+                documents = []
+                for row, position in enumerate(kept):
+                    timestamp, label, past_time, event_id = events[position]
+                    document = mongo_db.labeled_pose_document(timestamp, normalized[row], label,
+                                                              past_time=past_time, version=self.version)
+                    document["_id"] = self.document_id(event_id)
+                    document["device"] = self.device_name
+                    documents.append(document)
+                stats["written"], stats["duplicates"] = self.write(mongo_db, documents)
+        self.mark_done(mongo_db, chunk, stats)
+        stats["seconds"] = round(time.perf_counter() - started, 3)
+        return chunk, stats
+
+    def document_id(self, event_id):
+        return hashlib.sha1(f"{self.device_name}:{event_id}:{self.version}".encode()).hexdigest()
+
+    def write(self, mongo_db, documents):
+        try:
+            mongo_db.insert_many(self.labeled_collection, documents, ordered=False)
+            return len(documents), 0
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY for error in errors):
+                raise
+            # Windows already written by an earlier, interrupted run of this chunk
+            return len(documents) - len(errors), len(errors)
+
+    def run(self, mongo_db, workers=0):
+        """Process every pending chunk, in ``workers`` processes (0 runs them in this process)."""
+        pending = self.pending_chunks(mongo_db)
+        logger.info("%s: %s of %s chunks pending", self.job_id, len(pending), len(self.chunks()))
+        totals = {}
+        if workers:
+            # Each worker opens its own MongoClient through app.mongodb
+            with multiprocessing.Pool(workers) as pool:
+                results = pool.imap_unordered(_process_chunk, [(self, chunk) for chunk in pending])
+                for chunk, stats in results:
+                    _report(chunk, stats, totals)
+        else:
+            for chunk in pending:
+                _report(*self.process_chunk(mongo_db, chunk), totals)
+        return totals
+
+
+def _stackable(poses, first, last, shape=None):
+    """
+    Indices in [first, last) of the frames with ``shape``, by default that of frame ``first``, the frames
+    MongoDBHandler._query_frames keeps; all of them when ``poses`` is already stacked.
+    """
+    if poses.dtype != object or last <= first:
+        return np.arange(first, last)
+    shape = shape or poses[first].shape
+    return first + np.flatnonzero([pose.shape == shape for pose in poses[first:last]])
+
+
+def _stack(poses, indices):
+    return np.stack(list(poses[indices])) if poses.dtype == object else poses[indices]
+
+
+_shift_table = None
+
+
+def shift_table(mongo_db):
+    """Shift estimates of this process, loaded once from MongoDB."""
+    global _shift_table
+    if _shift_table is None:
+        table = ShiftTable()
+        table.load(mongo_db)
+        _shift_table = table
+    return _shift_table
+
+
+def _process_chunk(arguments):
+    from app import mongodb
+    job, chunk = arguments
+    return job.process_chunk(mongodb, chunk)
+
+
+def _report(chunk, stats, totals):
+    for key, value in stats.items():
+        totals[key] = totals.get(key, 0) + value
+    start = datetime.fromtimestamp(chunk[0] / 1000, tz=timezone.utc).strftime('%Y-%m-%d %H:%M')
+    logger.info("chunk %s: %s", start, stats)
+
+
+def parse_time(value):
+    """Epoch milliseconds, or an ISO date/datetime taken as UTC."""
+    if value.isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Relabel recorded events of a device in bulk")
+    parser.add_argument("device")
+    parser.add_argument("start", help="epoch ms or ISO date (UTC)")
+    parser.add_argument("end", help="epoch ms or ISO date (UTC)")
+    parser.add_argument("--version", default="backfill")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--chunk-hours", type=float, default=24)
+    parser.add_argument("--num-poses", type=int, default=30)
+    parser.add_argument("--past-time", type=float, default=None, help="seconds; default: each event's duration")
+    parser.add_argument("--camera", default=None)
+    parser.add_argument("--sampling", choices=["resample", "ids"], default="resample")
+    args = parser.parse_args()
+
+    from app import mongodb
+    job = BackfillJob(args.device, parse_time(args.start), parse_time(args.end), version=args.version,
+                      num_of_poses=args.num_poses, past_time=args.past_time, source=args.camera,
+                      chunk_hours=args.chunk_hours, sampling=args.sampling)
+    started = time.perf_counter()
+    totals = job.run(mongodb, workers=args.workers)
+    print(f"done in {time.perf_counter() - started:.1f}s: {totals}")
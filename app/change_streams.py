@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Change stream history for the stored resume token is gone (the oplog rolled over)
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class CollectionWatch:
+    """Configuration of the single change stream opened on one collection."""
+
+    def __init__(self, collection_name, fields, room_fields=None, operations=("insert",), event="notifications"):
+        self.collection_name = collection_name
+        self.fields = tuple(fields)
+        # Subscription key -> document field, e.g. {"camera": "camera_name"} gives rooms "results:camera:<name>"
+        self.room_fields = dict(room_fields or {})
+        self.operations = tuple(operations)
+        self.event = event
+        self.listeners = []
+        self.gap_listeners = []
+        self.resume_token = None
+        self.token_dirty = False
+        self.stats = {"changes": 0, "emitted": 0, "dropped": 0, "max_lag_ms": 0, "last_lag_ms": 0}
+
+    def projected_fields(self):
+        fields = set(self.fields) | set(self.room_fields.values()) | {"timestamp"}
+        for _, listener_fields in self.listeners:
+            fields |= set(listener_fields)
+        return sorted(fields)
+
+    def rooms(self, document):
+        rooms = [self.collection_name]
+        for key, field in self.room_fields.items():
+            if document.get(field) is not None:
+                rooms.append(room_name(self.collection_name, key, document[field]))
+        return rooms
+
+
+def room_name(collection_name, key=None, value=None):
+    """Socket.IO room for a collection, optionally narrowed to documents whose ``key`` equals ``value``."""
+    if key is None:
+        return collection_name
+    return f"{collection_name}:{key}:{value}"
+
+
+class ChangeStreamHub:
+    """
+    Fans MongoDB change streams out to Socket.IO rooms and in-process listeners.
+
+    One change stream is opened per collection, projected server-side to the fields that clients and
+    listeners need. Resume tokens are persisted to ``token_collection`` so a restarted process continues
+    where it stopped. Socket.IO clients join rooms per collection and per device/camera/label; documents
+    for a room are batched and emitted at most once per ``flush_interval`` seconds, keeping only the latest
+    ``max_batch`` documents of a burst.
+    """
+
+    def __init__(self, mongo_db, socketio, token_collection="change_stream_tokens", flush_interval=0.5,
+                 max_batch=50, retry_delay=5):
+        self.mongo_db = mongo_db
+        self.socketio = socketio
+        self.token_collection = token_collection
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.retry_delay = retry_delay
+        self.watches = {}
+        self._pending = defaultdict(lambda: deque(maxlen=self.max_batch))
+        self._pending_counts = defaultdict(int)
+        self._lock = threading.Lock()
+        self._running = False
+        self._active_tasks = 0
+
+    def watch(self, collection_name, fields, room_fields=None, operations=("insert",), event="notifications"):
+        """Declare the change stream of a collection; must be called before start()."""
+        self.watches[collection_name] = CollectionWatch(collection_name, fields, room_fields, operations, event)
+        return self.watches[collection_name]
+
+    def add_listener(self, collection_name, callback, fields=(), on_gap=None):
+        """
+        Call ``callback(document)`` in the watcher thread for every change of ``collection_name``.
+
+        ``on_gap()`` is called whenever the change stream is opened without a resume token, i.e. from now on,
+        so changes made while no stream was open are never delivered.
+        """
+        self.watches[collection_name].listeners.append((callback, tuple(fields)))
+        if on_gap is not None:
+            self.watches[collection_name].gap_listeners.append(on_gap)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        tasks = [(self._watch, watch) for watch in self.watches.values()] + [(self._flush_loop,)]
+        with self._lock:
+            self._active_tasks += len(tasks)
+        for task in tasks:
+            self.socketio.start_background_task(self._run_task, *task)
+
+    def stop(self, timeout=None):
+        """
+        Stop the watchers; the flush loop emits what is pending and saves the resume tokens first. ``timeout``
+        bounds the wait for all of them together.
+
+        The tasks are waited for with ``socketio.sleep``, since what start_background_task returns differs
+        between the threading, eventlet and gevent async modes.
+        """
+        self._running = False
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._active_tasks and (deadline is None or time.monotonic() < deadline):
+            self.socketio.sleep(0.05)
+        if self._active_tasks:
+            logger.warning("%s change stream tasks still running after %ss", self._active_tasks, timeout)
+
+    def _run_task(self, target, *args):
+        try:
+            target(*args)
+        finally:
+            with self._lock:
+                self._active_tasks -= 1
+
+    def metrics(self):
+        return {name: dict(watch.stats) for name, watch in self.watches.items()}
+
+    def _load_token(self, watch):
+        saved = self.mongo_db.get_collection(self.token_collection).find_one({"_id": watch.collection_name})
+        return saved["token"] if saved else None
+
+    def _save_tokens(self):
+        for watch in self.watches.values():
+            if not watch.token_dirty:
+                continue
+            watch.token_dirty = False
+            try:
+                self.mongo_db.get_collection(self.token_collection).update_one(
+                    {"_id": watch.collection_name},
+                    {"$set": {"token": watch.resume_token, "updated": int(time.time() * 1000)}},
+                    upsert=True)
+            except PyMongoError as e:
+                logger.error("Error saving resume token for %s: %s", watch.collection_name, e)
+
+    def _pipeline(self, watch):
+        projection = {f"fullDocument.{field}": 1 for field in watch.projected_fields()}
+        projection["operationType"] = 1
+        return [{'$match': {'operationType': {'$in': list(watch.operations)}}}, {'$project': projection}]
+
+    def _watch(self, watch):
+        logger.info("Starting watcher on %s", watch.collection_name)
+        collection = self.mongo_db.get_collection(watch.collection_name)
+        full_document = "updateLookup" if "update" in watch.operations else None
+        try:
+            watch.resume_token = self._load_token(watch)
+        except PyMongoError as e:
+            logger.error("Error loading resume token for %s: %s", watch.collection_name, e)
+        while self._running:
+            if watch.resume_token is None:
+                self._notify_gap(watch)
+            try:
+                with collection.watch(self._pipeline(watch), full_document=full_document,
+                                      resume_after=watch.resume_token, max_await_time_ms=1000) as stream:
+                    while self._running and stream.alive:
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        watch.resume_token = stream.resume_token
+                        watch.token_dirty = True
+                        document = change.get('fullDocument')
+                        if document:
+                            self._dispatch(watch, document)
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    logger.warning("Resume token for %s expired, starting from now", watch.collection_name)
+                    watch.resume_token = None
+                    continue
+                logger.error("Change stream on %s failed: %s", watch.collection_name, e)
+                self.socketio.sleep(self.retry_delay)
+            except PyMongoError as e:
+                logger.error("Change stream on %s failed: %s", watch.collection_name, e)
+                self.socketio.sleep(self.retry_delay)
+
+    def _notify_gap(self, watch):
+        for callback in watch.gap_listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Error in %s gap listener: %s", watch.collection_name, e)
+
+    def _dispatch(self, watch, document):
+        watch.stats["changes"] += 1
+        timestamp = document.get("timestamp")
+        if isinstance(timestamp, (int, float)):
+            lag = int(time.time() * 1000) - timestamp
+            watch.stats["last_lag_ms"] = lag
+            watch.stats["max_lag_ms"] = max(watch.stats["max_lag_ms"], lag)
+            metrics.CHANGE_STREAM_LAG.observe(lag / 1000, collection=watch.collection_name)
+
+        for callback, _ in watch.listeners:
+            try:
+                callback(document)
+            except Exception as e:
+                logger.error("Error in %s change listener: %s", watch.collection_name, e)
+
+        message = {field: document[field] for field in watch.fields if field in document}
+        with self._lock:
+            for room in watch.rooms(document):
+                self._pending[(watch.event, room)].append(message)
+                self._pending_counts[(watch.event, room)] += 1
+
+    def _flush(self):
+        """Emit the documents batched for every room since the last flush."""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(lambda: deque(maxlen=self.max_batch))
+            counts, self._pending_counts = self._pending_counts, defaultdict(int)
+        for (event, room), messages in pending.items():
+            collection_name = room.split(":", 1)[0]
+            dropped = counts[(event, room)] - len(messages)
+            self.socketio.emit(event, {"room": room, "count": counts[(event, room)], "dropped": dropped,
+                                       "documents": list(messages)}, to=room)
+            stats = self.watches[collection_name].stats
+            stats["emitted"] += 1
+            metrics.SOCKET_EMITS.inc(event=event)
+            stats["dropped"] += dropped
+
+    def _flush_loop(self):
+        last_token_save = time.monotonic()
+        while self._running:
+            self.socketio.sleep(self.flush_interval)
+            self._flush()
+            if time.monotonic() - last_token_save >= 5:
+                self._save_tokens()
+                last_token_save = time.monotonic()
+        self._save_tokens()
@@ -1,25 +1,257 @@
+import atexit
+import logging
+import os
 import time
+from collections import defaultdict
 from datetime import datetime
 import pytz
 import numpy as np
-from pymongo import MongoClient
-from .utils import pre_normalization
+from pymongo import MongoClient, WriteConcern
+from pymongo.errors import BulkWriteError, PyMongoError
+from .utils import pre_normalization, json_loads
+from .pose_codec import encode_pose, decode_pose
+from .pose_buffer import PoseBufferSet
+from .window_cache import PoseWindowCache
+from .indexes import index_models
+from .resampling import resample_streams, split_sources
+from . import metrics
 import threading
-from confluent_kafka import Consumer, KafkaException
+from confluent_kafka import Consumer, KafkaError, KafkaException, TopicPartition
+
+logger = logging.getLogger(__name__)
+
+POSE_PROJECTION = {"pose": 1, "timestamp": 1}
+
+
+def _evenly_spaced(items, count):
+    """Pick ``count`` items spread evenly over ``items`` (every ``len(items) // count``-th one)."""
+    step = max(len(items) // count, 1)
+    return [items[i * step] for i in range(count) if i * step < len(items)]
+
+
+class BufferedWriter:
+    """
+    Coalesces single-document inserts per collection into unordered ``insert_many`` bulk writes.
+
+    A background thread flushes a collection's buffer once it holds ``max_batch`` documents or its oldest
+    document has waited ``max_latency`` seconds. Batches that fail because the server is unreachable are
+    put back and retried on the next flush, keeping at most ``max_buffered`` documents per collection.
+    """
+
+    def __init__(self, handler, max_batch=500, max_latency=0.5, max_buffered=100000):
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.max_buffered = max_buffered
+        self._buffers = defaultdict(list)
+        self._oldest = {}
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._pid = None
+        self._atexit_registered = False
+        self.stats = {"buffered": 0, "written": 0, "batches": 0, "failed": 0, "dropped": 0}
+
+    def start(self):
+        with self._condition:
+            if self._running and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                # Forked child: the flusher thread did not survive, and the parent writes its own buffers
+                self._buffers.clear()
+                self._oldest.clear()
+            self._running = True
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="mongo-writer", daemon=True)
+            # Once per writer: close() flushes whatever is buffered however often the writer was restarted
+            register, self._atexit_registered = not self._atexit_registered, True
+        self._thread.start()
+        if register:
+            atexit.register(self.close)
+
+    def add(self, collection_name, document):
+        self.start()
+        with self._condition:
+            buffer = self._buffers[collection_name]
+            if not buffer:
+                self._oldest[collection_name] = time.monotonic()
+            buffer.append(document)
+            self.stats["buffered"] += 1
+            if len(buffer) >= self.max_batch:
+                self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return sum(len(buffer) for buffer in self._buffers.values())
+
+    def flush(self, collection_names=None):
+        """Synchronously write everything buffered (for the given collections, or all of them)."""
+        with self._flush_lock:
+            with self._condition:
+                names = list(self._buffers) if collection_names is None else collection_names
+                batches = {name: self._buffers.pop(name) for name in names if self._buffers.get(name)}
+                for name in batches:
+                    self._oldest.pop(name, None)
+            for name, documents in batches.items():
+                self._write(name, documents)
+
+    def close(self):
+        """Stop the background flusher and write whatever is still buffered."""
+        with self._condition:
+            running, self._running = self._running, False
+            self._condition.notify_all()
+        if running and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+    def _write(self, collection_name, documents):
+        for start in range(0, len(documents), self.max_batch):
+            batch = documents[start:start + self.max_batch]
+            started = time.perf_counter()
+            try:
+                self.handler.insert_many(collection_name, batch, ordered=False)
+                self.stats["written"] += len(batch)
+                metrics.MONGO_DOCUMENTS_WRITTEN.inc(len(batch), collection=collection_name)
+            except BulkWriteError as e:
+                # Unordered: every document without a write error has been stored
+                errors = len(e.details.get("writeErrors", []))
+                self.stats["written"] += len(batch) - errors
+                self.stats["failed"] += errors
+                metrics.MONGO_DOCUMENTS_WRITTEN.inc(len(batch) - errors, collection=collection_name)
+                logger.error("%s documents rejected by %s: %s", errors, collection_name,
+                             e.details.get('writeErrors', [])[:1])
+            except PyMongoError as e:
+                logger.error("Error writing %s documents to %s, will retry: %s", len(documents) - start,
+                             collection_name, e)
+                self._requeue(collection_name, documents[start:])
+                return
+            finally:
+                self.stats["batches"] += 1
+                metrics.MONGO_WRITE_SECONDS.observe(time.perf_counter() - started, collection=collection_name)
+
+    def _requeue(self, collection_name, documents):
+        with self._condition:
+            buffer = documents + self._buffers[collection_name]
+            overflow = len(buffer) - self.max_buffered
+            if overflow > 0:
+                self.stats["dropped"] += overflow
+                buffer = buffer[overflow:]
+            self._buffers[collection_name] = buffer
+            self._oldest[collection_name] = time.monotonic()
+
+    def _due(self):
+        # Must be called with self._condition held
+        now = time.monotonic()
+        return [name for name, buffer in self._buffers.items()
+                if buffer and (len(buffer) >= self.max_batch or now - self._oldest[name] >= self.max_latency)]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._due() or not self._running, timeout=self.max_latency)
+                if not self._running:
+                    return
+                due = self._due()
+            if due:
+                self.flush(due)
+
 
 class MongoDBHandler:
 
-    def __init__(self, uri=None, db_name=None):
-        self.client = MongoClient(uri)
-        self.db = self.client[db_name]  # db name
+    def __init__(self, uri=None, db_name=None, pose_format="list", compress_poses=False, write_concern=None,
+                 max_batch=500, max_latency=0.5, source_field="camera_name"):
+        self.uri = uri
+        self.db_name = db_name
+        # write_concern is a WriteConcern "w" value such as 0, 1 or "majority"; None keeps the server default
+        if isinstance(write_concern, str) and write_concern.isdigit():
+            write_concern = int(write_concern)
+        self.write_concern = write_concern
+        # The client is created on first use and again in a forked child, since MongoClient is not fork-safe
+        self._client = None
+        self._db = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+        # Storage format for poses written by this handler, see pose_codec.POSE_FORMATS
+        self.pose_format = pose_format
+        self.compress_poses = compress_poses
+        self.writer = BufferedWriter(self, max_batch=max_batch, max_latency=max_latency)
+        # Field of pose documents naming their camera, and the optional in-memory pose ring buffer
+        self.source_field = source_field
+        self.pose_buffer = None
+        # Optional cache of the frames and normalized windows read by fetch_poses, see enable_window_cache
+        self.window_cache = None
+
+    def is_connected(self):
+        """True if this process has created its MongoClient."""
+        return self._client is not None and self._client_pid == os.getpid()
+
+    def _connect(self):
+        with self._client_lock:
+            if self.is_connected():
+                return
+            client = MongoClient(self.uri)
+            if self.write_concern is not None:
+                self._db = client.get_database(self.db_name, write_concern=WriteConcern(w=self.write_concern))
+            else:
+                self._db = client[self.db_name]  # db name
+            self._client, self._client_pid = client, os.getpid()
+
+    @property
+    def client(self):
+        if not self.is_connected():
+            self._connect()
+        return self._client
+
+    @property
+    def db(self):
+        if not self.is_connected():
+            self._connect()
+        return self._db
+
+    def close(self):
+        """Write everything still buffered and close this process's MongoClient."""
+        self.writer.close()
+        if self.pose_buffer is not None:
+            self.pose_buffer.stop()
+        with self._client_lock:
+            if self._client is not None and self._client_pid == os.getpid():
+                self._client.close()
+            self._client = self._db = self._client_pid = None
 
     def get_collection(self, collection_name):
         return self.db[collection_name]
 
+    def ensure_indexes(self, collection_names=None):
+        """
+        Create the indexes of indexes.index_models that are missing (for all collections, or the given ones).
+
+        Existing indexes with the same definition are left alone, so this is cheap to call on every start.
+        :return: Index names per collection
+        """
+        ensured = {}
+        for collection_name, models in index_models(self.source_field).items():
+            if collection_names is None or collection_name in collection_names:
+                ensured[collection_name] = self.get_collection(collection_name).create_indexes(models)
+        return ensured
+
     def insert(self, collection_name, data):
         collection = self.get_collection(collection_name)
         return collection.insert_one(data)
 
+    def insert_many(self, collection_name, documents, ordered=False):
+        """Insert a list of documents in one round trip; unordered so one bad document does not stop the rest."""
+        collection = self.get_collection(collection_name)
+        return collection.insert_many(documents, ordered=ordered)
+
+    def buffered_insert(self, collection_name, data):
+        """Queue a document for the background bulk writer instead of writing it immediately."""
+        self.writer.add(collection_name, data)
+
+    def flush(self):
+        """Write every buffered document now."""
+        self.writer.flush()
+
     def notify_training(self, message, collection_name="notification", local_timestamp=None):
         if not local_timestamp:
             # Local Timestamp
@@ -32,7 +264,7 @@ class MongoDBHandler:
             "local_time": local_timestamp,
             "timestamp": timestamp
         }
-        self.db.insert(collection_name, insert_data)
+        self.buffered_insert(collection_name, insert_data)
 
     def store_training_logs(self, logs, collection_name="training_logs", local_timestamp=None):
         if not local_timestamp:
@@ -47,7 +279,7 @@ class MongoDBHandler:
             "service": "Training Service",
             "timestamp": timestamp
         }
-        self.db.insert(collection_name, insert_data)
+        self.buffered_insert(collection_name, insert_data)
 
     # Example usage: log_training_status({"version": "1.0.0", "timestamp": "2023-11-13", "logs": logs})
 
@@ -56,7 +288,33 @@ class MongoDBHandler:
                     num_of_poses=30,
                     past_time=None,
                     timestamp=None,
-                    custom_shape=(3, 25)):
+                    custom_shape=(3, 25),
+                    sampling="resample",
+                    source=None,
+                    min_quality=0.5,
+                    max_gap=100):
+        """
+        Fetch ``num_of_poses`` evenly spaced poses from the ``past_time`` seconds before ``timestamp``.
+
+        ``sampling`` selects where the even spacing is done:
+
+        * ``"resample"``: read every pose of the window and interpolate them onto ``num_of_poses`` evenly spaced
+          times, see resampling.resample_poses. Irregular frame timing and short gaps are absorbed; the window
+          is only rejected when less than ``min_quality`` of the grid times have a pose within ``max_gap`` ms.
+        * ``"ids"``: scan only ``_id`` in timestamp order, pick every ``step``-th one and fetch just those poses.
+          Selects exactly the same documents as ``"all"`` while transferring only the poses that are used.
+        * ``"buckets"``: split the window into ``num_of_poses`` equal time buckets and let an aggregation
+          return the first pose of each bucket.
+        * ``"all"``: fetch every pose in the window and pick every ``step``-th one on the client.
+
+        When the pose ring buffer is enabled and holds the whole window, every selection but ``"buckets"`` is
+        made from memory without querying MongoDB. ``source`` restricts the window to one camera; without it,
+        ``"resample"`` resamples every camera's poses separately and keeps the best camera's window. With the
+        window cache enabled, a repeated request returns the cached (read-only) tensor, and ``"resample"``
+        reads only the part of its window that is not already cached.
+        """
+        started = time.perf_counter()
+        source_label = "mongodb"
         collection = self.get_collection(collection_name)
 
         all_poses = []
@@ -65,29 +323,54 @@ class MongoDBHandler:
             # Calculate the time range
             start_time = timestamp - (past_time * 1000)
 
-            query = {
-                "timestamp": {"$gte": start_time, "$lte": timestamp},
-                "service": "pose_detector",
-                "pose": {"$ne": None}
-            }
-
-            # Fetch all poses within the time range
-            results = list(collection.find(query).sort("timestamp", 1))
-
-            if results:
-                # Evenly distribute the selection of poses over the time range
-                total_results = len(results)
-                step = max(total_results // num_of_poses, 1)
-
-                selected_indices = [i * step for i in range(num_of_poses) if i * step < total_results]
-
-                for index in selected_indices:
-                    pose_array = np.array(results[index]['pose'])
-                    # print(results[index]["timestamp"])
+            cache_key = None
+            if self.window_cache is not None:
+                cache_key = (collection_name, source, start_time, timestamp, num_of_poses, tuple(custom_shape),
+                             sampling, min_quality, max_gap)
+                cached = self.window_cache.tensor(cache_key)
+                if cached is not None:
+                    metrics.FETCH_POSES_SECONDS.observe(time.perf_counter() - started, source="cache")
+                    return cached
+
+            buffered = None
+            if sampling not in ("buckets", "resample"):
+                buffered = self._buffered_window(collection_name, start_time, timestamp, custom_shape, source)
+
+            if sampling == "resample":
+                streams, from_buffer = self._window_frames(collection, collection_name, start_time, timestamp,
+                                                           custom_shape, source, max_gap)
+                source_label = "buffer" if from_buffer else source_label
+                resampled, quality, _ = resample_streams(streams, start_time, timestamp, num_of_poses, max_gap)
+                metrics.POSE_WINDOW_QUALITY.observe(quality)
+                if resampled is None or quality < min_quality:
+                    logger.warning("Pose window before %s rejected: quality %.2f from %s poses, %s required",
+                                   timestamp, quality, sum(len(times) for times, _ in streams.values()),
+                                   min_quality)
+                    metrics.FETCH_POSES_SECONDS.observe(time.perf_counter() - started, source=source_label)
+                    return None
+                all_poses = list(resampled)
+            elif buffered is not None:
+                source_label = "buffer"
+                buffered = buffered[1]
+                all_poses = [buffered[index] for index in _evenly_spaced(range(len(buffered)), num_of_poses)]
+            else:
+                query = {
+                    "timestamp": {"$gte": start_time, "$lte": timestamp},
+                    "service": "pose_detector",
+                    "pose": {"$ne": None}
+                }
+                if source is not None:
+                    query[self.source_field] = source
+
+                results = self._sample_poses(collection, query, num_of_poses, start_time, timestamp, sampling)
+
+                for document in results:
+                    pose_array = decode_pose(document['pose'])
+                    # print(document["timestamp"])
                     if pose_array.shape[:-1] == custom_shape:
                         all_poses.append(pose_array)
                     else:
-                        print(f"Unexpected shape for pose: {pose_array.shape}")
+                        logger.warning("Unexpected shape for pose: %s", pose_array.shape)
 
         else:
             # If past_time is not provided, fetch the latest poses
@@ -96,19 +379,22 @@ class MongoDBHandler:
                 "service": "pose_detector",
                 "pose": {"$ne": None}
             }
-            results = collection.find(query).limit(num_of_poses)
-            for document in results:
-                pose_array = np.array(document['pose'])
+            # Newest first on the (service, timestamp) index, returned in chronological order
+            results = list(collection.find(query, POSE_PROJECTION).sort("timestamp", -1).limit(num_of_poses))
+            metrics.FETCH_POSES_DOCUMENTS.inc(len(results))
+            for document in reversed(results):
+                pose_array = decode_pose(document['pose'])
                 if custom_shape and pose_array.shape[:-1] == custom_shape:
                     all_poses.append(pose_array)
                 elif not custom_shape:
                     all_poses.append(pose_array)
                 else:
-                    print(f"Unexpected shape for document {document['_id']}: {pose_array.shape}")
+                    logger.warning("Unexpected shape for document %s: %s", document['_id'], pose_array.shape)
 
         if len(all_poses) < num_of_poses:
-            print(f"Only {len(all_poses)} poses found in the database. "
-                  f"Please check if the pose detector is running properly.")
+            logger.warning("Only %s poses found in the database. "
+                           "Please check if the pose detector is running properly.", len(all_poses))
+            metrics.FETCH_POSES_SECONDS.observe(time.perf_counter() - started, source=source_label)
             return None
 
         all_poses_stacked = np.stack(all_poses, axis=0)
@@ -117,22 +403,179 @@ class MongoDBHandler:
         final_shape = (1, custom_shape[0], num_of_poses, custom_shape[1], -1)
         final_poses = all_poses_stacked.reshape(final_shape)
 
-        training_poses = pre_normalization(final_poses)
+        with metrics.PRE_NORMALIZATION_SECONDS.time():
+            training_poses = pre_normalization(final_poses)
         # print(training_poses.shape)
+        if past_time and cache_key is not None:
+            self.window_cache.put_tensor(cache_key, training_poses, timestamp)
+        metrics.FETCH_POSES_SECONDS.observe(time.perf_counter() - started, source=source_label)
         return training_poses
 
-    def store_labeled_pose(self, timestamp, poses, label, past_time=None, version=None,
-                           collection_name="labeled_poses"):
-        collection = self.get_collection(collection_name)
-        # Assuming that poses is already a list of np.arrays with shape (3, 60, 25, 1)
-        # Convert each np.array pose to a list before storing in MongoDB
+    def enable_pose_buffer(self, capacity=3600, pose_shape=(3, 25, 1), collection_name="results", watch=True):
+        """
+        Keep the latest ``capacity`` poses of each source in memory.
+
+        With ``watch`` the buffer opens its own change stream; otherwise the caller feeds it, e.g. as a
+        ChangeStreamHub listener.
+        """
+        if self.pose_buffer is None:
+            self.pose_buffer = PoseBufferSet(capacity=capacity, pose_shape=pose_shape, source_field=self.source_field)
+            if watch:
+                self.pose_buffer.watch(self.get_collection(collection_name))
+        return self.pose_buffer
+
+    def enable_window_cache(self, max_frame_bytes=64 * 2 ** 20, max_tensor_bytes=16 * 2 ** 20, max_age=120,
+                            settle=5):
+        """Cache the windows read by fetch_poses in memory, see window_cache.PoseWindowCache."""
+        if self.window_cache is None:
+            self.window_cache = PoseWindowCache(max_frame_bytes=max_frame_bytes, max_tensor_bytes=max_tensor_bytes,
+                                                max_age=max_age, settle=settle)
+        return self.window_cache
+
+    def _buffered_window(self, collection_name, start_time, end_time, custom_shape, source=None):
+        """(timestamps, poses) of the window from the ring buffer, or None if it is disabled or misses the window."""
+        if self.pose_buffer is None or collection_name != "results":
+            return None
+        if self.pose_buffer.pose_shape[:-1] != tuple(custom_shape):
+            return None
+        return self.pose_buffer.window(start_time, end_time, source)
+
+    def _window_frames(self, collection, collection_name, start_time, end_time, custom_shape, source=None,
+                       margin=0):
+        """
+        Timestamps and stacked (N, C, V, M) poses of the whole window per source, and whether they came from the
+        ring buffer.
+
+        Poses are read from ``margin`` ms before the window, so its first grid time has a neighbour, from the
+        ring buffer when it covers the window and otherwise from MongoDB, through the frame tier of the window
+        cache when it is enabled. Without ``source``, the cameras whose buffer misses the window are read from
+        MongoDB, so the result does not depend on what the buffer holds.
+        """
+        start_time -= margin
+        buffered = self._buffered_streams(collection_name, start_time, end_time, custom_shape, source)
+        if buffered is not None:
+            streams, missing = buffered
+            for name in missing:
+                timestamps, poses, _ = self._read_frames(collection, collection_name, start_time, end_time,
+                                                         custom_shape, name)
+                if poses is not None:
+                    streams[name] = (timestamps, poses)
+            return streams, not missing
+        timestamps, poses, sources = self._read_frames(collection, collection_name, start_time, end_time,
+                                                       custom_shape, source)
+        return (split_sources(timestamps, poses, sources) if poses is not None else {}), False
+
+    def _read_frames(self, collection, collection_name, start_time, end_time, custom_shape, source=None):
+        """_query_frames through the frame tier of the window cache when it is enabled."""
+        if self.window_cache is None:
+            return self._query_frames(collection, start_time, end_time, custom_shape, source)
+        return self.window_cache.frames(
+            (collection_name, source, tuple(custom_shape)), start_time, end_time,
+            lambda start, end: self._query_frames(collection, start, end, custom_shape, source))
+
+    def _buffered_streams(self, collection_name, start_time, end_time, custom_shape, source=None):
+        """
+        ({source: (timestamps, poses)} of the window from the per-source ring buffers, [sources to read from
+        MongoDB]), or None if the buffer is disabled or misses the window.
+
+        Without ``source`` the buffer of all sources must cover the window: then every camera with a pose in it
+        has a buffer, and only those whose own buffer misses the window, e.g. one that started mid-window, are
+        left to MongoDB.
+        """
+        if source is not None:
+            buffered = self._buffered_window(collection_name, start_time, end_time, custom_shape, source)
+            return None if buffered is None else ({source: buffered}, [])
+        if (self.pose_buffer is None or collection_name != "results"
+                or self.pose_buffer.pose_shape[:-1] != tuple(custom_shape)
+                or not self.pose_buffer.covers(start_time, end_time)):
+            return None
+        streams, missing = {}, []
+        for name in self.pose_buffer.sources():
+            if not self.pose_buffer.covers(start_time, end_time, name):
+                missing.append(name)
+                continue
+            times, poses = self.pose_buffer.window(start_time, end_time, name)
+            if len(times):
+                streams[name] = (times, poses)
+        return streams, missing
+
+    def _query_frames(self, collection, start_time, end_time, custom_shape, source=None):
+        """
+        Timestamps, stacked poses and sources of the pose documents in [start_time, end_time], in timestamp order
+        (poses None if there are none).
+        """
+        query = {
+            "timestamp": {"$gte": start_time, "$lte": end_time},
+            "service": "pose_detector",
+            "pose": {"$ne": None}
+        }
+        if source is not None:
+            query[self.source_field] = source
+        projection = {**POSE_PROJECTION, self.source_field: 1}
+        documents = list(collection.find(query, projection).sort("timestamp", 1))
+        metrics.FETCH_POSES_DOCUMENTS.inc(len(documents))
+        timestamps, poses, sources = [], [], []
+        for document in documents:
+            pose_array = decode_pose(document['pose'])
+            # Frames must stack: the expected joints, and the person count of the first frame
+            if pose_array.shape[:-1] == tuple(custom_shape) and (not poses or pose_array.shape == poses[0].shape):
+                timestamps.append(document["timestamp"])
+                poses.append(pose_array)
+                sources.append(document.get(self.source_field))
+            else:
+                logger.warning("Unexpected shape for pose: %s", pose_array.shape)
+        source_array = np.empty(len(sources), dtype=object)
+        source_array[:] = sources
+        return np.asarray(timestamps, dtype=np.int64), (np.stack(poses) if poses else None), source_array
+
+    @staticmethod
+    def _sample_poses(collection, query, num_of_poses, start_time, end_time, sampling="ids"):
+        """Return up to ``num_of_poses`` pose documents of the window, ordered by timestamp."""
+        if sampling == "ids":
+            ids = [document["_id"] for document in collection.find(query, {"_id": 1}).sort("timestamp", 1)]
+            selected_ids = _evenly_spaced(ids, num_of_poses)
+            metrics.FETCH_POSES_DOCUMENTS.inc(len(ids))
+            if not selected_ids:
+                return []
+            results = list(collection.find({"_id": {"$in": selected_ids}}, POSE_PROJECTION).sort("timestamp", 1))
+            metrics.FETCH_POSES_DOCUMENTS.inc(len(results))
+            return results
+
+        if sampling == "buckets":
+            bucket_width = max((end_time - start_time) / num_of_poses, 1)
+            pipeline = [
+                {"$match": query},
+                {"$sort": {"timestamp": 1}},
+                {"$group": {
+                    "_id": {"$floor": {"$divide": [{"$subtract": ["$timestamp", start_time]}, bucket_width]}},
+                    "pose": {"$first": "$pose"},
+                    "timestamp": {"$first": "$timestamp"}
+                }},
+                {"$sort": {"timestamp": 1}},
+                {"$limit": num_of_poses}
+            ]
+            results = list(collection.aggregate(pipeline))
+            metrics.FETCH_POSES_DOCUMENTS.inc(len(results))
+            return results
+
+        if sampling == "all":
+            # Fetch all poses within the time range and evenly distribute the selection on the client
+            results = list(collection.find(query, POSE_PROJECTION).sort("timestamp", 1))
+            metrics.FETCH_POSES_DOCUMENTS.inc(len(results))
+            return _evenly_spaced(results, num_of_poses)
+
+        raise ValueError(f"Unknown sampling mode: {sampling}")
+
+    def labeled_pose_document(self, timestamp, pose, label, past_time=None, version=None, pose_format=None):
+        """Build a ``labeled_poses`` document for one normalized pose window."""
+        # Encode the np.array pose as a list or a binary blob before storing in MongoDB
+        if pose_format is None:
+            pose_format = self.pose_format
         la_timezone = pytz.timezone('America/Los_Angeles')
         local_timestamp = datetime.now(la_timezone).strftime('%Y-%m-%d %H:%M:%S')  # Readable local timestamp
 
-        print(poses.shape)
-        pose_list = poses[0].tolist()  # Convert each (3, 60, 25, 1) pose to a list
         document = {
-            "pose": pose_list,
+            "pose": encode_pose(pose, pose_format=pose_format, compress=self.compress_poses),
             "label": label,
             "local_time": local_timestamp,
             "service": "Data Service 2",
@@ -142,49 +585,187 @@ class MongoDBHandler:
             document["version"] = version
         if past_time is not None:
             document["past_time"] = past_time
+        return document
 
-        collection.insert_one(document)
+    def store_labeled_pose(self, timestamp, poses, label, past_time=None, version=None,
+                           collection_name="labeled_poses", pose_format=None, buffered=True):
+        # Assuming that poses is already a list of np.arrays with shape (3, 60, 25, 1)
+        logger.debug("Storing labeled poses of shape %s", poses.shape)
+        document = self.labeled_pose_document(timestamp, poses[0], label, past_time=past_time, version=version,
+                                              pose_format=pose_format)
+        if buffered:
+            self.buffered_insert(collection_name, document)
+        else:
+            self.insert(collection_name, document)
 
 
 class KafkaMongoConsumer:
-    def __init__(self, mongo_handler, kafka_config, topic, collection, batch_duration=1.0):
+    """
+    Kafka to MongoDB ingestion stage with at-least-once delivery.
+
+    Messages are collected until ``batch_size`` messages or ``batch_duration`` seconds, decoded as JSON in
+    one pass and written with an unordered ``insert_many``. Offsets are committed only after the batch has
+    been written; a failed write is retried before anything else is consumed, so a crash can replay but
+    never skip messages. ``consumer`` can be any object with the confluent_kafka Consumer interface, which
+    lets tests and benchmarks run against an in-process fake.
+    """
+
+    def __init__(self, mongo_handler, kafka_config, topic, collection, batch_duration=1.0, batch_size=1000,
+                 consumer=None, retry_delay=1.0):
         self.mongo_handler = mongo_handler
-        self.consumer = Consumer(kafka_config)
+        # Offsets are committed manually after each successful write
+        self.consumer = consumer or Consumer({**kafka_config, "enable.auto.commit": False})
         self.topic = topic
         self.collection = collection
         self.running = False
+        self.thread = None
         self.batch_duration = batch_duration
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.last_batch_time = time.monotonic()
+        self.started_at = None
+        self.stats = {
+            "messages": 0,
+            "batches": 0,
+            "decode_errors": 0,
+            "tombstones": 0,
+            "write_errors": 0,
+            "commit_errors": 0,
+            "last_batch_size": 0,
+            "last_batch_ms": 0.0
+        }
 
     def start(self):
         self.running = True
-        self.thread = threading.Thread(target=self.run)
+        self.thread = threading.Thread(target=self.run, name=f"kafka-{self.topic}", daemon=True)
         self.thread.start()
 
     def stop(self):
         self.running = False
-        self.thread.join()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
     def run(self):
+        self.started_at = time.monotonic()
+        self.last_batch_time = time.monotonic()
+        message_batch = []
         try:
             self.consumer.subscribe([self.topic])
-            message_batch = []
 
             while self.running:
-                msg = self.consumer.poll(0.1)  # Reduced poll timeout
-
-                if msg is not None and not msg.error():
-                    message_batch.append(msg.value())
-
-                # Check if the batch duration has elapsed
-                if len(message_batch) > 0 and time.time() - self.last_batch_time >= self.batch_duration:
-                    # Insert the batch into MongoDB
-                    self.mongo_handler.insert_many(self.collection, message_batch)
+                messages = self.consumer.consume(num_messages=self.batch_size - len(message_batch), timeout=0.1)
+                for msg in messages:
+                    if msg.error():
+                        if msg.error().code() != KafkaError._PARTITION_EOF:
+                            logger.error("Kafka error on %s: %s", self.topic, msg.error())
+                        continue
+                    message_batch.append(msg)
+
+                # Flush on a full batch or once the batch duration has elapsed
+                if message_batch and (len(message_batch) >= self.batch_size
+                                      or time.monotonic() - self.last_batch_time >= self.batch_duration):
+                    self._write_until_done(message_batch)
                     message_batch = []  # Reset the batch
-                    self.last_batch_time = time.time()
+                    self.last_batch_time = time.monotonic()
 
+            if message_batch:
+                self._write_until_done(message_batch)
         finally:
             self.consumer.close()
 
+    def _write_until_done(self, messages):
+        while not self.write_batch(messages):
+            if not self.running:
+                logger.warning("Stopping with %s uncommitted messages; they will be redelivered", len(messages))
+                return
+            time.sleep(self.retry_delay)
+
+    @staticmethod
+    def decode_values(values):
+        """
+        Decode a list of JSON payloads in one parser call, falling back to one by one on bad input.
+
+        The joined parse is only used if it yields one document per payload: a payload such as ``1,2`` is
+        invalid on its own but would otherwise shift the documents after it.
+        """
+        try:
+            documents = json_loads(b"[" + b",".join(values) + b"]")
+            if len(documents) == len(values):
+                return documents, 0
+        except ValueError:
+            pass
+        documents, errors = [], 0
+        for value in values:
+            try:
+                documents.append(json_loads(value))
+            except ValueError:
+                errors += 1
+        return documents, errors
+
+    def write_batch(self, messages):
+        """Insert one batch and commit its offsets. Returns False if the write must be retried."""
+        started = time.perf_counter()
+        values = [msg.value() for msg in messages]
+        # Tombstones (deletes on a compacted topic) have no document to insert; their offsets are committed
+        payloads = [value for value in values if value is not None]
+        self.stats["tombstones"] += len(values) - len(payloads)
+        documents, errors = self.decode_values(payloads)
+        self.stats["decode_errors"] += errors
+        documents = [document if isinstance(document, dict) else {"value": document} for document in documents]
+        if documents:
+            try:
+                self.mongo_handler.insert_many(self.collection, documents, ordered=False)
+            except BulkWriteError as e:
+                # Unordered: the rest of the batch was written, e.g. redelivered duplicates were skipped
+                self.stats["write_errors"] += len(e.details.get("writeErrors", []))
+            except PyMongoError as e:
+                logger.error("Error writing %s messages to %s: %s", len(documents), self.collection, e)
+                return False
+
+        # Commit the next offset of every partition in the batch
+        offsets = {}
+        for msg in messages:
+            key = (msg.topic(), msg.partition())
+            offsets[key] = max(offsets.get(key, -1), msg.offset() + 1)
+        try:
+            self.consumer.commit(offsets=[TopicPartition(topic, partition, offset)
+                                          for (topic, partition), offset in offsets.items()],
+                                 asynchronous=False)
+        except KafkaException as e:
+            # E.g. a rebalance in progress: the batch is retried like a redelivery, at least once
+            logger.error("Error committing %s messages of %s: %s", len(messages), self.topic, e)
+            self.stats["commit_errors"] += 1
+            return False
+
+        self.stats["messages"] += len(messages)
+        self.stats["batches"] += 1
+        self.stats["last_batch_size"] = len(messages)
+        self.stats["last_batch_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        return True
+
+    def lag(self):
+        """Messages between the committed position and the end of each assigned partition."""
+        total = 0
+        assignment = self.consumer.assignment()
+        for partition in self.consumer.position(assignment) if assignment else []:
+            low, high = self.consumer.get_watermark_offsets(partition, timeout=1.0)
+            position = partition.offset if partition.offset >= 0 else low
+            total += max(high - position, 0)
+        return total
+
+    def metrics(self):
+        stats = dict(self.stats)
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        stats["messages_per_sec"] = round(stats["messages"] / elapsed, 1) if elapsed else 0.0
+        stats["avg_batch_size"] = round(stats["messages"] / stats["batches"], 1) if stats["batches"] else 0.0
+        try:
+            stats["lag"] = self.lag()
+        except KafkaException as e:
+            stats["lag"] = None
+            logger.error("Error reading consumer lag: %s", e)
+        return stats
+
 
 if __name__ == '__main__':
     # notify_training('Training started')
@@ -0,0 +1,288 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from .pose_codec import decode_pose
+
+MANIFEST = "manifest.json"
+FETCH_BATCH = 500
+# Seconds before an export's start after which documents are left to the next export: labels are written a
+# few seconds after their timestamp, and not always in timestamp order
+SETTLE_SECONDS = 300
+
+
+class DatasetExporter:
+    """
+    Incremental export of ``labeled_poses`` into sharded, memory-mappable ``.npy`` files.
+
+    Every export appends new shards holding the documents that match the filter and are not exported yet;
+    shards already written are never modified. New documents are found from the ``watermark`` of the
+    manifest, the latest exported timestamp, so an export reads only what was labeled since the last one.
+    Documents written later with an older timestamp, e.g. by a backfill, are only picked up by an export
+    with ``history=True``, which compares the ids of the whole filter with the exported ones.
+
+    Each shard ``shard-NNNNN.npy`` is an (N, *pose_shape) array with a parallel ``shard-NNNNN.index.npz`` of
+    labels, timestamps and document ids. ``manifest.json`` lists the shards and is replaced atomically once
+    they are on disk, so a reader never sees a partial export.
+    """
+
+    def __init__(self, mongo_db, output_dir, collection_name="labeled_poses", shard_size=4096, dtype="float32"):
+        self.mongo_db = mongo_db
+        self.output_dir = output_dir
+        self.collection_name = collection_name
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+
+    @staticmethod
+    def query(version=None, labels=None, since=None, until=None):
+        query = {"pose": {"$ne": None}}
+        if version is not None:
+            query["version"] = version
+        if labels is not None:
+            query["label"] = {"$in": list(labels)}
+        if since is not None or until is not None:
+            query["timestamp"] = {}
+            if since is not None:
+                query["timestamp"]["$gte"] = since
+            if until is not None:
+                query["timestamp"]["$lte"] = until
+        return query
+
+    def load_manifest(self):
+        path = os.path.join(self.output_dir, MANIFEST)
+        if not os.path.exists(path):
+            return None
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+
+    def _write_manifest(self, manifest):
+        path = os.path.join(self.output_dir, MANIFEST)
+        with open(path + ".tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def exported_ids(self, manifest):
+        ids = set()
+        for shard in manifest["shards"]:
+            with np.load(os.path.join(self.output_dir, shard["index"])) as index:
+                ids.update(index["ids"].tolist())
+        return ids
+
+    def new_documents(self, collection, manifest, query, history):
+        """``_id`` and timestamp of the matching documents that are not exported yet, in timestamp order."""
+        watermark = manifest.get("watermark")
+        if history or watermark is None:
+            exported = self.exported_ids(manifest) if manifest["shards"] else set()
+        else:
+            # Only the documents at the watermark itself can already be in the dataset
+            exported = set(watermark["ids"])
+            bounds = dict(query.get("timestamp", {}))
+            bounds["$gte"] = max(bounds.get("$gte", watermark["timestamp"]), watermark["timestamp"])
+            query = {**query, "timestamp": bounds}
+        return [document for document in collection.find(query, {"_id": 1, "timestamp": 1}).sort("timestamp", 1)
+                if str(document["_id"]) not in exported]
+
+    def export(self, version=None, labels=None, since=None, until=None, history=False, settle=SETTLE_SECONDS):
+        """
+        Append the matching documents that are not in the dataset yet.
+
+        The filter of the first export is stored in the manifest; later exports into the same directory must
+        use the same filter. Documents of the last ``settle`` seconds are left to the next export.
+        ``history`` also looks for documents older than the watermark, at the cost of reading every id of
+        the filter. Returns a dict with the number of documents exported and skipped.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        query_filter = {"version": version, "labels": None if labels is None else sorted(labels),
+                        "since": since, "until": until}
+        manifest = self.load_manifest()
+        if manifest is None:
+            manifest = {"format": 1, "collection": self.collection_name, "filter": query_filter,
+                        "dtype": self.dtype.str, "pose_shape": None, "count": 0, "shards": []}
+        elif manifest["filter"] != query_filter:
+            raise ValueError(f"{self.output_dir} was exported with filter {manifest['filter']}, not {query_filter}")
+
+        collection = self.mongo_db.get_collection(self.collection_name)
+        settled = int((time.time() - settle) * 1000)
+        query = self.query(version, labels, since, settled if until is None else min(until, settled))
+        new_documents = self.new_documents(collection, manifest, query, history)
+        new_ids = [document["_id"] for document in new_documents]
+
+        stats = {"exported": 0, "skipped": 0, "shards": 0}
+        writer = None
+        for offset in range(0, len(new_ids), FETCH_BATCH):
+            batch_ids = new_ids[offset:offset + FETCH_BATCH]
+            cursor = collection.find({"_id": {"$in": batch_ids}}, {"pose": 1, "label": 1, "timestamp": 1})
+            for document in sorted(cursor, key=lambda document: document.get("timestamp") or 0):
+                pose = decode_pose(document["pose"])
+                if manifest["pose_shape"] is None:
+                    manifest["pose_shape"] = list(pose.shape)
+                if list(pose.shape) != manifest["pose_shape"]:
+                    stats["skipped"] += 1
+                    continue
+                if writer is None:
+                    writer = _ShardWriter(self.output_dir, len(manifest["shards"]), self.shard_size,
+                                          tuple(manifest["pose_shape"]), self.dtype,
+                                          min(self.shard_size, len(new_ids) - offset))
+                writer.append(pose, document.get("label"), document.get("timestamp"), str(document["_id"]))
+                stats["exported"] += 1
+                if writer.full():
+                    manifest["shards"].append(writer.close())
+                    stats["shards"] += 1
+                    writer = None
+        if writer is not None:
+            manifest["shards"].append(writer.close())
+            stats["shards"] += 1
+
+        manifest["count"] = sum(shard["count"] for shard in manifest["shards"])
+        manifest["watermark"] = _advance(manifest.get("watermark"), new_documents)
+        manifest["updated"] = int(time.time() * 1000)
+        self._write_manifest(manifest)
+        return stats
+
+
+def _advance(watermark, documents):
+    """The latest timestamp of ``watermark`` and ``documents``, with the ids of every document at it."""
+    timestamps = [document["timestamp"] for document in documents if document.get("timestamp") is not None]
+    if not timestamps:
+        return watermark
+    latest = max(timestamps)
+    ids = [str(document["_id"]) for document in documents if document.get("timestamp") == latest]
+    if watermark is not None:
+        if watermark["timestamp"] > latest:
+            return watermark
+        if watermark["timestamp"] == latest:
+            ids = watermark["ids"] + ids
+    return {"timestamp": latest, "ids": ids}
+
+
+class _ShardWriter:
+    def __init__(self, output_dir, number, shard_size, pose_shape, dtype, expected):
+        self.output_dir = output_dir
+        self.name = f"shard-{number:05d}"
+        self.capacity = shard_size
+        self.poses = np.lib.format.open_memmap(os.path.join(output_dir, f"{self.name}.npy.tmp"), mode="w+",
+                                               dtype=dtype, shape=(max(expected, 1),) + pose_shape)
+        self.pose_shape = pose_shape
+        self.dtype = dtype
+        self.labels, self.timestamps, self.ids = [], [], []
+
+    def full(self):
+        return len(self.ids) >= self.capacity
+
+    def append(self, pose, label, timestamp, document_id):
+        if len(self.ids) == len(self.poses):
+            # More documents than expected: grow the file
+            self.poses = self._resize(min(self.capacity, len(self.poses) * 2))
+        self.poses[len(self.ids)] = pose
+        self.labels.append(-1 if label is None else label)
+        self.timestamps.append(-1 if timestamp is None else timestamp)
+        self.ids.append(document_id)
+
+    def _resize(self, rows):
+        path = os.path.join(self.output_dir, f"{self.name}.npy.tmp")
+        current = np.array(self.poses[:len(self.ids)])
+        del self.poses
+        poses = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(rows,) + self.pose_shape)
+        poses[:len(current)] = current
+        return poses
+
+    def close(self):
+        count = len(self.ids)
+        if count != len(self.poses):
+            self.poses = self._resize(count)
+        self.poses.flush()
+        del self.poses
+        data_file, index_file = f"{self.name}.npy", f"{self.name}.index.npz"
+        os.replace(os.path.join(self.output_dir, f"{self.name}.npy.tmp"), os.path.join(self.output_dir, data_file))
+        with open(os.path.join(self.output_dir, index_file), "wb") as index:
+            np.savez(index, labels=np.asarray(self.labels, dtype=np.int64),
+                     timestamps=np.asarray(self.timestamps, dtype=np.int64), ids=np.asarray(self.ids))
+        return {"data": data_file, "index": index_file, "count": count,
+                "first_timestamp": min(self.timestamps), "last_timestamp": max(self.timestamps)}
+
+
+class PoseDataset:
+    """
+    Read side of an exported dataset: memory-mapped shards with labels and timestamps in memory.
+
+    ``dataset[i]`` returns a read-only view into the shard file, without copying. ``batches()`` yields
+    shuffled (poses, labels) batches; each batch is gathered shard by shard so reads stay local.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.shards = []
+        labels, timestamps = [], []
+        for shard in self.manifest["shards"]:
+            self.shards.append(np.load(os.path.join(path, shard["data"]), mmap_mode="r"))
+            with np.load(os.path.join(path, shard["index"])) as index:
+                labels.append(index["labels"])
+                timestamps.append(index["timestamps"])
+        self.labels = np.concatenate(labels) if labels else np.empty(0, dtype=np.int64)
+        self.timestamps = np.concatenate(timestamps) if timestamps else np.empty(0, dtype=np.int64)
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _locate(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        shard = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        return shard, index - int(self.offsets[shard])
+
+    def __getitem__(self, index):
+        shard, row = self._locate(index)
+        return self.shards[shard][row], int(self.labels[index])
+
+    def take(self, indices):
+        """Poses and labels of ``indices`` (copied into one array), read shard by shard."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if not self.shards:
+            if len(indices):
+                raise IndexError(int(indices[0]))
+            shape = tuple(self.manifest["pose_shape"] or ())
+            return np.empty((0,) + shape, dtype=self.manifest["dtype"]), np.empty(0, dtype=np.int64)
+        shard_of = np.searchsorted(self.offsets, indices, side="right") - 1
+        poses = np.empty((len(indices),) + self.shards[0].shape[1:], dtype=self.shards[0].dtype)
+        for shard in np.unique(shard_of):
+            selected = np.flatnonzero(shard_of == shard)
+            rows = indices[selected] - self.offsets[shard]
+            order = np.argsort(rows)
+            poses[selected[order]] = self.shards[shard][rows[order]]
+        return poses, self.labels[indices]
+
+    def batches(self, batch_size, shuffle=True, seed=None, drop_last=False):
+        """Iterate over (poses, labels) batches covering the dataset once."""
+        order = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            if drop_last and len(indices) < batch_size:
+                return
+            yield self.take(indices)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export labeled poses into memory-mapped shards")
+    parser.add_argument("output_dir")
+    parser.add_argument("--version", default=None)
+    parser.add_argument("--label", type=int, action="append", help="repeatable; default: all labels")
+    parser.add_argument("--since", type=int, default=None, help="epoch ms")
+    parser.add_argument("--until", type=int, default=None, help="epoch ms")
+    parser.add_argument("--shard-size", type=int, default=4096)
+    parser.add_argument("--history", action="store_true",
+                        help="also export documents older than the last export, e.g. backfilled windows")
+    args = parser.parse_args()
+
+    from app import mongodb
+    started = time.perf_counter()
+    result = DatasetExporter(mongodb, args.output_dir, shard_size=args.shard_size).export(
+        version=args.version, labels=args.label, since=args.since, until=args.until, history=args.history)
+    print(f"{result} in {time.perf_counter() - started:.1f}s, {PoseDataset(args.output_dir).manifest['count']} total")
@@ -0,0 +1,144 @@
+import numpy as np
+
+SWITCH_OFF = 0
+SWITCH_ON = 1
+
+_NO_EVENTS = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8))
+# Batches smaller than this are compared sample by sample, where NumPy's per-call overhead would dominate
+SCALAR_BATCH = 32
+
+
+class EventDetector:
+    """
+    Streaming on/off detector for power meter readings, evaluated on whole micro-batches with NumPy.
+
+    A sample switches the device on when it rises by at least ``threshold`` over the previous sample and
+    either lands in (0, ``rise_max_value``) or rises by at least ``rise_min_jump``. It switches the device
+    off when it falls by at least ``threshold`` from a previous value in (0, ``fall_max_previous``).
+    Events closer than ``debounce_time`` seconds to the last event fired are suppressed, so a physical
+    switch that shows up as several steps fires once. The last value and event time carry over between
+    batches. Batches of fewer than SCALAR_BATCH samples, e.g. one network read, take a plain Python path
+    with the same results.
+    """
+
+    def __init__(self, threshold, rise_max_value=42, rise_min_jump=30, fall_max_previous=28, debounce_time=0):
+        self.threshold = threshold
+        self.rise_max_value = rise_max_value
+        self.rise_min_jump = rise_min_jump
+        self.fall_max_previous = fall_max_previous
+        self.debounce_time = debounce_time  # seconds
+        self.previous_value = None
+        self.last_event_time = None
+        self.stats = {"samples": 0, "events": 0, "debounced": 0}
+
+    def reset(self):
+        """Forget the carried-over sample and event, e.g. after a gap in the stream."""
+        self.previous_value = None
+        self.last_event_time = None
+
+    def detect(self, values, timestamps=None):
+        """
+        Find the switch events in a batch of consecutive samples.
+
+        :param values: Meter readings in arrival order; NaN marks a sample without a reading
+        :param timestamps: Epoch milliseconds of the samples, required when ``debounce_time`` is set
+        :return: (indices into the batch, switch types SWITCH_ON/SWITCH_OFF) of the events that fired
+        """
+        if len(values) < SCALAR_BATCH:
+            return self._detect_scalar(values, timestamps)
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return _NO_EVENTS
+        self.stats["samples"] += values.size
+        positions = None
+        valid = ~np.isnan(values)
+        if not valid.all():
+            positions = np.flatnonzero(valid)
+            values = values[valid]
+            if values.size == 0:
+                return _NO_EVENTS
+
+        previous = np.empty_like(values)
+        previous[0] = np.nan if self.previous_value is None else self.previous_value
+        previous[1:] = values[:-1]
+        self.previous_value = float(values[-1])
+
+        rise = values - previous
+        fall = previous - values
+        on = (rise >= self.threshold) & (((values > 0) & (values < self.rise_max_value))
+                                         | (rise >= self.rise_min_jump))
+        off = (fall >= self.threshold) & (previous > 0) & (previous < self.fall_max_previous) & ~on
+        indices = np.flatnonzero(on | off)
+        if indices.size == 0:
+            return _NO_EVENTS
+        switches = on[indices].astype(np.int8)
+        if positions is not None:
+            indices = positions[indices]
+
+        if self.debounce_time > 0:
+            if timestamps is None:
+                raise ValueError("timestamps are required to debounce events")
+            indices, switches = self._debounce(indices, switches, np.asarray(timestamps, dtype=np.int64))
+        self.stats["events"] += indices.size
+        return indices, switches
+
+    def _detect_scalar(self, values, timestamps):
+        if isinstance(values, np.ndarray):
+            values = values.tolist()
+        if not values:
+            return _NO_EVENTS
+        self.stats["samples"] += len(values)
+        threshold, rise_max_value, rise_min_jump = self.threshold, self.rise_max_value, self.rise_min_jump
+        previous = self.previous_value
+        events = []
+        for index, value in enumerate(values):
+            value = float(value)
+            if value != value:  # NaN: no reading
+                continue
+            if previous is not None:
+                rise = value - previous
+                if rise >= threshold and (0 < value < rise_max_value or rise >= rise_min_jump):
+                    events.append((index, SWITCH_ON))
+                elif -rise >= threshold and 0 < previous < self.fall_max_previous:
+                    events.append((index, SWITCH_OFF))
+            previous = value
+        self.previous_value = previous
+        if not events:
+            return _NO_EVENTS
+
+        if self.debounce_time > 0:
+            if timestamps is None:
+                raise ValueError("timestamps are required to debounce events")
+            window = self.debounce_time * 1000
+            last = self.last_event_time
+            kept = []
+            for index, switch in events:
+                event_time = int(timestamps[index])
+                if last is None or event_time - last >= window:
+                    kept.append((index, switch))
+                    last = event_time
+            self.stats["debounced"] += len(events) - len(kept)
+            self.last_event_time = last
+            events = kept
+            if not events:
+                return _NO_EVENTS
+        self.stats["events"] += len(events)
+        indices, switches = zip(*events)
+        return np.array(indices, dtype=np.int64), np.array(switches, dtype=np.int8)
+
+    def _debounce(self, indices, switches, timestamps):
+        window = self.debounce_time * 1000
+        times = timestamps[indices]
+        last = self.last_event_time
+        # Common case: events are already further apart than the window
+        if (last is None or times[0] - last >= window) and (np.diff(times) >= window).all():
+            self.last_event_time = int(times[-1])
+            return indices, switches
+        keep = np.zeros(indices.size, dtype=bool)
+        for i, event_time in enumerate(times.tolist()):
+            if last is None or event_time - last >= window:
+                keep[i] = True
+                last = event_time
+        self.stats["debounced"] += int(indices.size - keep.sum())
+        self.last_event_time = last
+        return indices[keep], switches[keep]
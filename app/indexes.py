@@ -0,0 +1,165 @@
+import argparse
+import time
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+
+def index_models(source_field="camera_name"):
+    """
+    Indexes backing every query the service issues, by collection; MongoDBHandler.ensure_indexes creates them.
+
+    :param source_field: Field of pose documents naming their camera, see MongoDBHandler.source_field
+    """
+    return {
+        "results": [
+            # fetch_poses, the pose watermark and the shift estimation: pose detector output by time
+            IndexModel([("service", ASCENDING), ("timestamp", ASCENDING)], name="service_timestamp"),
+            # The same, narrowed to one camera
+            IndexModel([("service", ASCENDING), (source_field, ASCENDING), ("timestamp", ASCENDING)],
+                       name=f"service_{source_field}_timestamp"),
+        ],
+        "notification": [
+            # Event history of a device for the shift estimation; older notifications have no event_time
+            IndexModel([("service", ASCENDING), ("event_time", ASCENDING)], name="service_event_time",
+                       partialFilterExpression={"event_time": {"$gte": 0}}),
+            IndexModel([("service", ASCENDING), ("timestamp", ASCENDING)], name="service_timestamp"),
+        ],
+        "labeled_poses": [
+            IndexModel([("timestamp", ASCENDING)], name="timestamp"),
+            IndexModel([("label", ASCENDING), ("timestamp", ASCENDING)], name="label_timestamp"),
+            # Dataset exports of one model version
+            IndexModel([("version", ASCENDING), ("label", ASCENDING), ("timestamp", ASCENDING)],
+                       name="version_label_timestamp"),
+        ],
+        "training_logs": [
+            IndexModel([("timestamp", DESCENDING)], name="timestamp_desc"),
+        ],
+    }
+
+
+def query_shapes(now=None, source_field="camera_name"):
+    """
+    The query shapes issued against the indexed collections, with representative values.
+
+    Each shape is (name, collection, filter, projection, sort, limit) and mirrors a query in database.py,
+    labeling.py, shift_estimation.py, dataset_export.py or change_streams.py. An aggregation has its pipeline
+    in place of the filter and no projection, sort or limit.
+    """
+    now = int(time.time() * 1000) if now is None else now
+    window = {"$gte": now - 5000, "$lte": now}
+    poses = {"timestamp": window, "service": "pose_detector", "pose": {"$ne": None}}
+    # fetch_poses with sampling="buckets": 30 poses over 5 s
+    buckets = [
+        {"$match": poses},
+        {"$sort": {"timestamp": 1}},
+        {"$group": {
+            "_id": {"$floor": {"$divide": [{"$subtract": ["$timestamp", now - 5000]}, 5000 / 30]}},
+            "pose": {"$first": "$pose"},
+            "timestamp": {"$first": "$timestamp"}
+        }},
+        {"$sort": {"timestamp": 1}},
+        {"$limit": 30}
+    ]
+    # fetch_poses with sampling="resample" reads from max_gap ms before the window
+    resample = {**poses, "timestamp": {"$gte": now - 5100, "$lte": now}}
+    return [
+        ("fetch_poses ids", "results", poses, {"_id": 1}, [("timestamp", ASCENDING)], 0),
+        # The selected ids; sorting at most num_of_poses documents in memory is expected
+        ("fetch_poses ids follow-up", "results", {"_id": {"$in": [ObjectId() for _ in range(30)]}},
+         {"pose": 1, "timestamp": 1}, [("timestamp", ASCENDING)], 0),
+        ("fetch_poses buckets", "results", buckets, None, None, 0),
+        ("fetch_poses resample", "results", resample, {"pose": 1, "timestamp": 1, source_field: 1},
+         [("timestamp", ASCENDING)], 0),
+        ("fetch_poses resample camera", "results", {**resample, source_field: "pi-cam-3"},
+         {"pose": 1, "timestamp": 1, source_field: 1}, [("timestamp", ASCENDING)], 0),
+        ("fetch_poses all", "results", poses, {"pose": 1, "timestamp": 1}, [("timestamp", ASCENDING)], 0),
+        ("fetch_poses camera", "results", {**poses, source_field: "pi-cam-3"}, {"_id": 1},
+         [("timestamp", ASCENDING)], 0),
+        ("fetch_poses latest", "results", {"timestamp": {"$lte": now}, "service": "pose_detector",
+                                           "pose": {"$ne": None}},
+         {"pose": 1, "timestamp": 1}, [("timestamp", DESCENDING)], 30),
+        ("pose watermark", "results", {"service": "pose_detector"}, {"timestamp": 1},
+         [("timestamp", DESCENDING)], 1),
+        ("shift estimation poses", "results", {**poses, source_field: {"$in": ["pi-cam-3", "pi-cam-6"]}},
+         {"timestamp": 1, "pose": 1, source_field: 1}, [("timestamp", ASCENDING)], 0),
+        ("shift estimation events", "notification",
+         {"service": "power-meter-14", "event_time": {"$gte": now - 30 * 86400000}},
+         {"event_time": 1, "switch": 1}, None, 0),
+        ("labeled poses by time", "labeled_poses", {"timestamp": window}, None, [("timestamp", ASCENDING)], 0),
+        # DatasetExporter.new_documents from the watermark of the last export
+        ("dataset export", "labeled_poses",
+         {"pose": {"$ne": None}, "version": "v1", "label": {"$in": [0, 1]},
+          "timestamp": {"$gte": now - 86400000, "$lte": now - 300000}},
+         {"_id": 1, "timestamp": 1}, [("timestamp", ASCENDING)], 0),
+        ("training logs latest", "training_logs", {}, None, [("timestamp", DESCENDING)], 20),
+        # ChangeStreamHub resume tokens, read on start and upserted on every flush
+        ("change stream token", "change_stream_tokens", {"_id": "results"}, None, None, 1),
+    ]
+
+
+def plan_stages(plan):
+    """Stage names of a winning plan, from the root down."""
+    plan = plan.get("queryPlan", plan)
+    stages = [plan.get("stage")]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages.extend(plan_stages(child))
+    return [stage for stage in stages if stage]
+
+
+def explain_query(mongo_db, name, collection_name, query, projection=None, sort=None, limit=0):
+    """
+    Run ``explain`` for one query shape and summarise the winning plan and its execution statistics.
+
+    For an aggregation (``query`` is a pipeline) the plan is that of the documents read from the collection;
+    the stages after them run in memory on what the plan returned.
+    """
+    collection = mongo_db.get_collection(collection_name)
+    if isinstance(query, list):
+        explanation = collection.database.command(
+            "explain", {"aggregate": collection_name, "pipeline": query, "cursor": {}},
+            verbosity="executionStats")
+        if "stages" in explanation:
+            # Only the first stages were pushed down to the query layer
+            explanation = explanation["stages"][0]["$cursor"]
+    else:
+        cursor = collection.find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        explanation = cursor.explain()
+    stats = explanation.get("executionStats", {})
+    stages = plan_stages(explanation["queryPlanner"]["winningPlan"])
+    return {
+        "query": name,
+        "collection": collection_name,
+        "plan": " <- ".join(stages),
+        "collscan": "COLLSCAN" in stages,
+        "in_memory_sort": "SORT" in stages,
+        "keys_examined": stats.get("totalKeysExamined"),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "returned": stats.get("nReturned"),
+    }
+
+
+def explain_all(mongo_db, now=None):
+    return [explain_query(mongo_db, *shape) for shape in query_shapes(now, mongo_db.source_field)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Explain every query shape and flag collection scans")
+    parser.add_argument("--ensure", action="store_true", help="create the declared indexes first")
+    args = parser.parse_args()
+
+    from app import mongodb
+    if args.ensure:
+        print(f"Indexes ensured: {mongodb.ensure_indexes()}")
+    failed = False
+    for report in explain_all(mongodb):
+        flag = "COLLSCAN" if report["collscan"] else ("SORT" if report["in_memory_sort"] else "ok")
+        failed = failed or report["collscan"]
+        print(f"{flag:>8}  {report['query']:<28} {report['collection']:<14} keys {report['keys_examined']:>8}  "
+              f"docs {report['docs_examined']:>8}  returned {report['returned']:>8}  {report['plan']}")
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,129 @@
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LabelRequest:
+    def __init__(self, timestamp, callback, deadline, sequence):
+        self.timestamp = timestamp
+        self.callback = callback
+        self.deadline = deadline
+        self.sequence = sequence
+
+
+class DeferredLabelQueue:
+    """
+    Holds label requests until the poses they need have been written, then fires them from one worker.
+
+    A request for ``timestamp`` fires as soon as the pose watermark (latest ``timestamp`` written by
+    ``service`` to ``collection_name``) reaches it, or once ``max_delay`` seconds have passed, whichever
+    comes first. The watermark is only queried while requests are pending, at most every
+    ``poll_interval`` seconds.
+    """
+
+    def __init__(self, mongo_db, collection_name="results", service="pose_detector", max_delay=60,
+                 poll_interval=1.0):
+        self.mongo_db = mongo_db
+        self.collection_name = collection_name
+        self.service = service
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+
+        self._pending = []
+        self._in_flight = 0  # taken from _pending, callback not finished yet
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+        self.stats = {"enqueued": 0, "fired_on_watermark": 0, "fired_on_timeout": 0, "failed": 0}
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="deferred-labels", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            if not self._running:
+                return
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def enqueue(self, timestamp, callback):
+        """Call ``callback()`` once the poses up to ``timestamp`` (epoch ms) are available."""
+        self.start()
+        request = LabelRequest(timestamp, callback, time.monotonic() + self.max_delay, next(self._sequence))
+        with self._condition:
+            self._pending.append(request)
+            self.stats["enqueued"] += 1
+            self._condition.notify()
+        return request
+
+    def pending(self):
+        """Requests waiting to fire or whose callback is still running."""
+        with self._condition:
+            return len(self._pending) + self._in_flight
+
+    def drain(self, timeout=None):
+        """Block until every pending request has fired and its callback returned. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(min(self.poll_interval, 0.1))
+        return True
+
+    def pose_watermark(self):
+        """Timestamp of the latest pose written by the pose service, or None."""
+        collection = self.mongo_db.get_collection(self.collection_name)
+        latest = collection.find_one({"service": self.service}, {"timestamp": 1}, sort=[("timestamp", -1)])
+        return latest["timestamp"] if latest else None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or not self._running)
+                if not self._running:
+                    return
+
+            try:
+                watermark = self.pose_watermark()
+            except Exception as e:
+                logger.error("Error reading pose watermark: %s", e)
+                watermark = None
+
+            now = time.monotonic()
+            with self._condition:
+                ready = [request for request in self._pending
+                         if (watermark is not None and request.timestamp <= watermark) or now >= request.deadline]
+                for request in ready:
+                    self._pending.remove(request)
+                self._in_flight += len(ready)
+                next_deadline = min((request.deadline for request in self._pending), default=None)
+
+            for request in sorted(ready, key=lambda r: (r.timestamp, r.sequence)):
+                on_time = watermark is not None and request.timestamp <= watermark
+                self.stats["fired_on_watermark" if on_time else "fired_on_timeout"] += 1
+                try:
+                    request.callback()
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    logger.error("Error firing deferred label at %s: %s", request.timestamp, e)
+                finally:
+                    with self._condition:
+                        self._in_flight -= 1
+
+            wait = self.poll_interval
+            if next_deadline is not None:
+                wait = max(0.0, min(wait, next_deadline - time.monotonic()))
+            with self._condition:
+                if self._running:
+                    self._condition.wait(wait)
@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Seconds a web instance waits for the services instance to answer a forwarded request
+FORWARD_TIMEOUT = 30
+FORWARDED_HEADER = "X-Forwarded-To-Services"
+
+# Shares of the stop_services timeout: draining labels and tasks, then the watchers; the rest is for the flush
+DRAIN_SHARE = 0.5
+WATCHERS_SHARE = 0.2
+
+_lock = threading.Lock()
+_started_pid = None
+_stopped = False
+_forward_session = None
+_forward_session_pid = None
+
+
+def start_services():
+    """
+    Start the change-stream watchers and the power meter receivers of this process.
+
+    Background services are started once per process, never at import time: the dev server calls this from
+    ``run.py``, gunicorn from its ``post_worker_init`` hook, so every forked worker starts its own threads
+    instead of inheriting dead ones from the master. Returns False if they are already running here.
+    """
+    global _started_pid
+    with _lock:
+        if _started_pid == os.getpid():
+            return False
+        _started_pid = os.getpid()
+
+    from app import mongodb
+    from .routes import start_receivers
+    from .sockets import hub
+
+    if os.environ.get('MONGODB_ENSURE_INDEXES', 'true').lower() == 'true':
+        # Off the startup path: an unreachable server must not hold up the receivers
+        threading.Thread(target=_ensure_indexes, args=(mongodb,), name="ensure-indexes", daemon=True).start()
+
+    pose_buffer_capacity = int(os.environ.get('POSE_BUFFER_CAPACITY', 3600))  # poses per camera, 0 disables
+    if pose_buffer_capacity > 0:
+        # Fed by the results change stream of the notification hub
+        pose_buffer = mongodb.enable_pose_buffer(capacity=pose_buffer_capacity, watch=False)
+        hub.add_listener("results", pose_buffer.add, fields=["timestamp", "pose", mongodb.source_field],
+                         on_gap=pose_buffer.mark_gap)
+    window_cache_mb = float(os.environ.get('POSE_WINDOW_CACHE_MB', 64))  # 0 disables
+    if window_cache_mb > 0:
+        mongodb.enable_window_cache(max_frame_bytes=int(window_cache_mb * 2 ** 20),
+                                    max_tensor_bytes=int(float(os.environ.get('POSE_TENSOR_CACHE_MB', 16)) * 2 ** 20),
+                                    max_age=float(os.environ.get('POSE_WINDOW_CACHE_AGE', 120)),
+                                    settle=float(os.environ.get('POSE_WINDOW_CACHE_SETTLE', 5)))
+    hub.start()
+    start_receivers()
+    return True
+
+
+def _ensure_indexes(mongodb):
+    try:
+        mongodb.ensure_indexes()
+    except PyMongoError as e:
+        logger.error("Error ensuring MongoDB indexes: %s", e)
+
+
+def stop_services(timeout=10):
+    """
+    Stop the background services of this process and drain the work they hold.
+
+    Receivers stop reading their streams, deferred labels fire and queued tasks finish, the watchers emit
+    what is pending and save their resume tokens, and buffered writes are flushed before the MongoClient is
+    closed. The steps share one ``timeout``: draining gets at most DRAIN_SHARE of it and the watchers
+    WATCHERS_SHARE, leaving the rest for the final flush. Buffered writes are also flushed before each long
+    wait, so a kill at the deadline loses as little as possible. Services are not started again in this
+    process afterwards.
+    """
+    global _stopped
+    with _lock:
+        if _started_pid != os.getpid() or _stopped:
+            return False
+        _stopped = True
+
+    from app import mongodb
+    from .routes import manager
+    from .sockets import hub
+
+    logger.info("Stopping receivers and watchers...")
+    deadline = time.monotonic() + timeout
+    mongodb.flush()
+    manager.shutdown(timeout=timeout * DRAIN_SHARE)
+    mongodb.flush()
+    hub.stop(timeout=max(0.0, min(timeout * WATCHERS_SHARE, deadline - time.monotonic())))
+    mongodb.close()
+    logger.info("Background services stopped")
+    return True
+
+
+def services_started():
+    return _started_pid == os.getpid() and not _stopped
+
+
+def forward_to_services():
+    """
+    ``before_request`` hook of the blueprints whose routes act on the receivers and watchers.
+
+    Web instances started with START_SERVICES=false have none; when SERVICES_URL points to the instance that
+    runs them, the request is forwarded there unchanged and its response returned. Requests are handled
+    locally when this process runs the services, SERVICES_URL is unset, or the request was already forwarded.
+    """
+    from flask import Response, jsonify, request
+
+    services_url = os.environ.get('SERVICES_URL')
+    if not services_url or services_started() or request.headers.get(FORWARDED_HEADER):
+        return None
+    url = services_url.rstrip('/') + request.path
+    if request.query_string:
+        url += "?" + request.query_string.decode()
+    headers = {FORWARDED_HEADER: "1"}
+    if request.content_type:
+        headers["Content-Type"] = request.content_type
+    try:
+        response = _session().request(request.method, url, data=request.get_data(), headers=headers,
+                                      timeout=FORWARD_TIMEOUT)
+    except requests.RequestException as e:
+        logger.error("Error forwarding %s %s to the services process: %s", request.method, request.path, e)
+        return jsonify({"error": "Services process unreachable"}), 502
+    return Response(response.content, status=response.status_code,
+                    content_type=response.headers.get("Content-Type"))
+
+
+def _session():
+    # One keep-alive session per process; a forked worker must not share its parent's connections
+    global _forward_session, _forward_session_pid
+    with _lock:
+        if _forward_session is None or _forward_session_pid != os.getpid():
+            _forward_session, _forward_session_pid = requests.Session(), os.getpid()
+        return _forward_session
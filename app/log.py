@@ -0,0 +1,67 @@
+import logging
+import os
+import sys
+import threading
+import time
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most ``burst`` records per call site every ``interval`` seconds.
+
+    Records are keyed by the line that logged them, so a message repeated for every sample or document is
+    cut off after the burst while other messages still get through. The first record of the next interval
+    reports how many were suppressed. Suppressed records are dropped before their message is formatted.
+    """
+
+    def __init__(self, burst=10, interval=60.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.burst <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            started, count, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - started >= self.interval:
+                started, count, suppressed, reported = now, 0, 0, suppressed
+            else:
+                reported = 0
+            if count >= self.burst:
+                self._windows[key] = (started, count, suppressed + 1)
+                return False
+            self._windows[key] = (started, count + 1, suppressed)
+        if reported:
+            record.msg = f"{record.msg} ({reported} similar messages suppressed)"
+        return True
+
+
+def configure_logging(level=None, burst=None, interval=None):
+    """
+    Send the ``app`` loggers to stderr at ``level`` through a RateLimitFilter.
+
+    Defaults come from LOG_LEVEL (INFO), LOG_RATE_LIMIT (records per call site and interval, 10; 0 disables)
+    and LOG_RATE_INTERVAL (seconds, 60). Calling it again replaces the handler.
+    """
+    level = level or os.environ.get('LOG_LEVEL', 'INFO')
+    burst = burst if burst is not None else int(os.environ.get('LOG_RATE_LIMIT', 10))
+    interval = interval if interval is not None else float(os.environ.get('LOG_RATE_INTERVAL', 60))
+
+    logger = logging.getLogger("app")
+    for handler in [handler for handler in logger.handlers if getattr(handler, "_app_handler", False)]:
+        logger.removeHandler(handler)
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    handler.addFilter(RateLimitFilter(burst, interval))
+    handler._app_handler = True
+    logger.addHandler(handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+    return logger
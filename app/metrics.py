@@ -0,0 +1,192 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Registry:
+    """The metrics of this process, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [(name, value) for name, value in zip(names, values)] + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. ``SAMPLES.inc(len(values), device="power-meter-14")``."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Value that goes up and down."""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative ``buckets``, with their sum and count."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block, in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(bound))])} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render():
+    return REGISTRY.render()
+
+
+# Power meter receivers (save_trigger)
+SAMPLES = Counter("powermeter_samples_total", "Power meter samples run through the event detector", ["device"])
+EVENTS = Counter("powermeter_events_total", "Switch events detected", ["device", "switch"])
+EVENTS_DROPPED = Counter("powermeter_events_dropped_total", "Events dropped because the scheduler queue was full",
+                         ["device"])
+CLIP_REQUEST_LATENCY = Histogram("event_clip_request_latency_seconds",
+                                 "Time from detecting an event to requesting its clips from the cameras", ["device"])
+
+# Pose windows and MongoDB (database)
+FETCH_POSES_SECONDS = Histogram("fetch_poses_seconds", "Duration of fetch_poses, by where the poses came from",
+                                ["source"])
+FETCH_POSES_DOCUMENTS = Counter("fetch_poses_documents_total", "Documents read from MongoDB by fetch_poses")
+POSE_WINDOW_QUALITY = Histogram("pose_window_quality",
+                                "Fraction of the resampled frames of a pose window backed by a recorded pose",
+                                buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0))
+POSE_CACHE_REQUESTS = Counter("pose_window_cache_requests_total",
+                              "Window cache lookups of fetch_poses, by tier (frames, tensor) and result",
+                              ["tier", "result"])
+POSE_CACHE_BYTES = Gauge("pose_window_cache_bytes", "Memory held by each tier of the window cache", ["tier"])
+PRE_NORMALIZATION_SECONDS = Histogram("pre_normalization_seconds", "Duration of pre_normalization in fetch_poses")
+MONGO_WRITE_SECONDS = Histogram("mongo_write_seconds", "Duration of the bulk writes of the buffered writer",
+                                ["collection"])
+MONGO_DOCUMENTS_WRITTEN = Counter("mongo_documents_written_total", "Documents written by the buffered writer",
+                                  ["collection"])
+
+# Change streams and Socket.IO (change_streams, sockets)
+CHANGE_STREAM_LAG = Histogram("change_stream_lag_seconds",
+                              "Delay between a document's timestamp and its change event reaching the service",
+                              ["collection"], buckets=LAG_BUCKETS)
+SOCKET_EMITS = Counter("socketio_emits_total", "Socket.IO messages emitted", ["event"])
+SOCKET_CLIENTS = Gauge("socketio_clients", "Connected Socket.IO clients")
@@ -0,0 +1,210 @@
+import logging
+import threading
+import time
+
+import numpy as np
+from pymongo.errors import PyMongoError
+
+from .pose_codec import decode_pose
+
+logger = logging.getLogger(__name__)
+
+
+class PoseRingBuffer:
+    """
+    Fixed-size, chronologically ordered ring of recent poses backed by pre-allocated NumPy arrays.
+
+    Poses are stored as float64, the dtype fetch_poses works in, in a (capacity, C, V, M) array next to an
+    int64 timestamp array, so a window read from the buffer equals the one read from MongoDB. Appends are
+    O(1); a pose that arrives slightly out of order is shifted into place. Time-range lookups use binary
+    search on the two sorted segments of the ring. Poses may be missing before ``continuous_since`` (epoch
+    ms), set by mark_gap when the feed of the buffer was interrupted.
+    """
+
+    def __init__(self, capacity, pose_shape):
+        self.capacity = capacity
+        self.pose_shape = tuple(pose_shape)
+        self.poses = np.zeros((capacity,) + self.pose_shape, dtype=np.float64)
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.start = 0  # physical index of the oldest pose
+        self.size = 0
+        self.continuous_since = None
+        self.lock = threading.Lock()
+
+    def _physical(self, logical):
+        return (self.start + logical) % self.capacity
+
+    def oldest(self):
+        return int(self.timestamps[self.start]) if self.size else None
+
+    def latest(self):
+        return int(self.timestamps[self._physical(self.size - 1)]) if self.size else None
+
+    def _search(self, timestamp, side):
+        """Logical index at which ``timestamp`` would be inserted to keep the ring ordered."""
+        end = self.start + self.size
+        if end <= self.capacity:
+            return int(np.searchsorted(self.timestamps[self.start:end], timestamp, side=side))
+        first = self.timestamps[self.start:]
+        if timestamp < first[-1] or (side == "left" and timestamp == first[-1]):
+            return int(np.searchsorted(first, timestamp, side=side))
+        return len(first) + int(np.searchsorted(self.timestamps[:end - self.capacity], timestamp, side=side))
+
+    def append(self, timestamp, pose):
+        with self.lock:
+            latest = self.latest()
+            if latest is None or timestamp >= latest:
+                position = self.size
+            else:
+                position = self._search(timestamp, "right")
+                if position == 0 and self.size == self.capacity:
+                    return False  # older than everything kept
+            if self.size == self.capacity:
+                # Evict the oldest pose to make room
+                self.start = (self.start + 1) % self.capacity
+                self.size -= 1
+                position -= 1
+            # Shift the poses newer than this one by one slot (only for out-of-order arrivals)
+            for logical in range(self.size, position, -1):
+                source, target = self._physical(logical - 1), self._physical(logical)
+                self.poses[target] = self.poses[source]
+                self.timestamps[target] = self.timestamps[source]
+            target = self._physical(position)
+            self.poses[target] = pose
+            self.timestamps[target] = timestamp
+            self.size += 1
+            return True
+
+    def mark_gap(self, since):
+        """Poses up to ``since`` may be missing, e.g. after the change stream restarted without resuming."""
+        with self.lock:
+            if self.continuous_since is None or since > self.continuous_since:
+                self.continuous_since = since
+
+    def covers(self, start_time, end_time):
+        """True if every pose in [start_time, end_time] written since the buffer started is held here."""
+        with self.lock:
+            if self.continuous_since is not None and start_time < self.continuous_since:
+                return False
+            return self.size > 0 and self.oldest() <= start_time and self.latest() >= end_time
+
+    def slice(self, start_time, end_time):
+        """Copies of the timestamps and poses in [start_time, end_time], in chronological order."""
+        with self.lock:
+            first = self._search(start_time, "left")
+            last = self._search(end_time, "right")
+            indices = (self.start + np.arange(first, last)) % self.capacity
+            return self.timestamps[indices], self.poses[indices]
+
+
+class PoseBufferSet:
+    """
+    Ring buffers of recent poses: one for all sources together plus one per source (e.g. camera).
+
+    ``source_field`` names the document field identifying the source. Poses whose shape does not match
+    ``pose_shape`` are not buffered, which breaks the coverage of their buffers at their timestamp.
+    """
+
+    def __init__(self, capacity=3600, pose_shape=(3, 25, 1), source_field="camera_name"):
+        self.capacity = capacity
+        self.pose_shape = tuple(pose_shape)
+        self.source_field = source_field
+        self.buffers = {}
+        self.lock = threading.Lock()
+        self.watch_thread = None
+        self.watching = False
+        self.continuous_since = None
+        self.stats = {"buffered": 0, "rejected": 0, "gaps": 0, "hits": 0, "misses": 0}
+
+    def buffer(self, source=None):
+        with self.lock:
+            if source not in self.buffers:
+                buffer = PoseRingBuffer(self.capacity, self.pose_shape)
+                if self.continuous_since is not None:
+                    buffer.mark_gap(self.continuous_since)
+                self.buffers[source] = buffer
+            return self.buffers[source]
+
+    def mark_gap(self, since=None):
+        """
+        The feed of the buffers was interrupted and poses up to ``since`` (epoch ms, default now) may be
+        missing; windows starting before it are left to MongoDB.
+        """
+        since = int(time.time() * 1000) if since is None else since
+        with self.lock:
+            self.continuous_since = max(since, self.continuous_since or since)
+            buffers = list(self.buffers.values())
+        for buffer in buffers:
+            buffer.mark_gap(since)
+        self.stats["gaps"] += 1
+
+    def sources(self):
+        """The sources with a buffer of their own."""
+        with self.lock:
+            return [source for source in self.buffers if source is not None]
+
+    def add(self, document):
+        """Buffer a ``results`` document holding a pose."""
+        pose = document.get("pose")
+        if pose is None:
+            return False
+        pose = decode_pose(pose)
+        timestamp = document["timestamp"]
+        source = document.get(self.source_field)
+        if pose.shape != self.pose_shape:
+            # fetch_poses would miss this pose in every window of the buffer that contains it
+            self.stats["rejected"] += 1
+            self.buffer(None).mark_gap(timestamp + 1)
+            if source is not None:
+                self.buffer(source).mark_gap(timestamp + 1)
+            return False
+        self.buffer(None).append(timestamp, pose)
+        if source is not None:
+            self.buffer(source).append(timestamp, pose)
+        self.stats["buffered"] += 1
+        return True
+
+    def covers(self, start_time, end_time, source=None):
+        """True if the buffer of ``source`` (None: all sources) holds every pose of the window."""
+        buffer = self.buffers.get(source)
+        return buffer is not None and buffer.covers(start_time, end_time)
+
+    def window(self, start_time, end_time, source=None):
+        """(timestamps, poses) of the window, or None when the buffer does not cover it."""
+        buffer = self.buffers.get(source)
+        if buffer is None or not buffer.covers(start_time, end_time):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return buffer.slice(start_time, end_time)
+
+    def watch(self, collection, service="pose_detector", retry_delay=5):
+        """Feed the buffers from a change stream on ``collection`` in a background thread."""
+        if self.watch_thread is not None:
+            return
+        self.watching = True
+        self.watch_thread = threading.Thread(target=self._watch, args=(collection, service, retry_delay),
+                                             name="pose-buffer", daemon=True)
+        self.watch_thread.start()
+
+    def stop(self):
+        self.watching = False
+
+    def _watch(self, collection, service, retry_delay):
+        pipeline = [
+            {'$match': {'operationType': 'insert', 'fullDocument.service': service}},
+            {'$project': {'fullDocument.timestamp': 1, 'fullDocument.pose': 1,
+                          f'fullDocument.{self.source_field}': 1}}
+        ]
+        while self.watching:
+            try:
+                # Opened from now: whatever was inserted while no stream was open is not buffered
+                self.mark_gap()
+                with collection.watch(pipeline, max_await_time_ms=1000) as stream:
+                    while self.watching and stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            self.add(change['fullDocument'])
+            except PyMongoError as e:
+                logger.error("Pose buffer change stream failed, fetch_poses will use MongoDB: %s", e)
+                time.sleep(retry_delay)
@@ -0,0 +1,57 @@
+import zlib
+
+import numpy as np
+from bson.binary import Binary
+
+# Storage formats accepted by encode_pose; "list" keeps the legacy nested-array documents
+POSE_FORMATS = {
+    "list": None,
+    "float32": "<f4",
+    "float16": "<f2",
+}
+
+
+def encode_pose(pose, pose_format="float32", compress=False):
+    """
+    Encode a pose tensor for storage in a MongoDB document.
+
+    :param pose: Array-like pose tensor, e.g. a (3, T, 25, 1) labeled window
+    :param pose_format: One of ``POSE_FORMATS``; ``"list"`` stores nested BSON arrays as before
+    :param compress: Compress the binary payload with zlib
+    :return: A nested list, or a sub-document holding the raw bytes with dtype, shape and compression
+    """
+    if pose_format not in POSE_FORMATS:
+        raise ValueError(f"Unknown pose format: {pose_format}")
+    pose = np.asarray(pose)
+    if pose_format == "list":
+        return pose.tolist()
+
+    payload = np.ascontiguousarray(pose, dtype=POSE_FORMATS[pose_format]).tobytes()
+    compression = None
+    if compress:
+        payload = zlib.compress(payload)
+        compression = "zlib"
+    return {
+        "data": Binary(payload),
+        "dtype": POSE_FORMATS[pose_format],
+        "shape": list(pose.shape),
+        "compression": compression
+    }
+
+
+def is_binary_pose(value):
+    return isinstance(value, dict) and "data" in value
+
+
+def decode_pose(value):
+    """
+    Decode a stored pose into a NumPy array, accepting both the legacy nested list and the binary format.
+
+    Binary poses are decoded with ``np.frombuffer`` and are therefore read-only views of the payload.
+    """
+    if not is_binary_pose(value):
+        return np.array(value)
+    payload = value["data"]
+    if value.get("compression") == "zlib":
+        payload = zlib.decompress(payload)
+    return np.frombuffer(payload, dtype=value["dtype"]).reshape(value["shape"])
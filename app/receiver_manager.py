@@ -0,0 +1,163 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+import aiohttp
+from pymongo.errors import PyMongoError
+
+from .labeling import DeferredLabelQueue
+from .save_trigger import PowerMeterReceiver
+from .scheduler import TaskScheduler
+from .segmenter_client import StreamSegmenterClient
+from .shift_estimation import ShiftTable
+
+logger = logging.getLogger(__name__)
+
+# Receiver settings that can be given per device, with their defaults
+DEVICE_DEFAULTS = {
+    "threshold": 15,
+    "save_time": 3,  # seconds
+    "trigger_time": 0.1,  # minutes
+    "frequency": 0,
+    "value_key": "Current",
+    "camera_name_list": [],
+    "custom_shape": (3, 25),
+    # Event detector bounds, see EventDetector
+    "rise_max_value": 42,
+    "rise_min_jump": 30,
+    "fall_max_previous": 28,
+    "debounce_time": 0  # seconds
+}
+
+
+def load_device_configs(path=None, default_device=None):
+    """
+    Read the per-device receiver configuration.
+
+    :param path: JSON file holding a list of device objects, each with at least ``device_name``
+    :param default_device: Configuration used when no file is given
+    :return: List of device configuration dicts
+    """
+    if not path:
+        return [default_device] if default_device else []
+    with open(path) as config_file:
+        return json.load(config_file)
+
+
+class ReceiverManager:
+    """
+    Registry of PowerMeterReceiver instances, one per power meter.
+
+    Every device stream is consumed by a coroutine on one shared asyncio loop, and all receivers share one
+    TaskScheduler, one StreamSegmenterClient and one DeferredLabelQueue, so the thread count stays
+    constant as devices are added.
+    Devices can be added, reconfigured and removed at runtime without touching the others.
+    """
+
+    def __init__(self, mongo_db, base_url, camera_base_url, scheduler=None, segmenter_client=None):
+        self.mongo_db = mongo_db
+        self.base_url = base_url
+        self.camera_base_url = camera_base_url
+        self.scheduler = scheduler or TaskScheduler(workers=8, max_queue=1024, name="receivers")
+        self.segmenter_client = segmenter_client or StreamSegmenterClient(max_workers=32)
+        self.label_queue = DeferredLabelQueue(mongo_db)
+        self.shift_table = ShiftTable()
+        self.receivers = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._loop_thread = None
+        self._http_session = None
+
+    def _ensure_loop(self):
+        if self._loop is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name="receiver-loop", daemon=True)
+        self._loop_thread.start()
+        self._http_session = asyncio.run_coroutine_threadsafe(self._create_session(), self._loop).result()
+
+    @staticmethod
+    async def _create_session():
+        # Stream reads have no total timeout; one connection is held open per device
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10)
+        return aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0))
+
+    def add(self, device_name, start=True, **config):
+        """Register a receiver for ``device_name`` and optionally start monitoring it."""
+        with self._lock:
+            if device_name in self.receivers:
+                raise ValueError(f"Device {device_name} is already registered")
+            self._ensure_loop()
+            settings = {**DEVICE_DEFAULTS, **config}
+            settings["custom_shape"] = tuple(settings["custom_shape"])
+            receiver = PowerMeterReceiver(base_url=settings.pop("base_url", self.base_url),
+                                          device_name=device_name,
+                                          camera_base_url=settings.pop("camera_base_url", self.camera_base_url),
+                                          mongo_db=self.mongo_db,
+                                          segmenter_client=self.segmenter_client,
+                                          scheduler=self.scheduler,
+                                          label_queue=self.label_queue,
+                                          shift_table=self.shift_table,
+                                          event_loop=self._loop,
+                                          http_session=self._http_session,
+                                          **settings)
+            self.receivers[device_name] = receiver
+        if start:
+            receiver.start()
+        return receiver
+
+    def remove(self, device_name):
+        """Stop and unregister a receiver. Returns False if the device is unknown."""
+        with self._lock:
+            receiver = self.receivers.pop(device_name, None)
+        if receiver is None:
+            return False
+        receiver.stop()
+        return True
+
+    def load_shifts(self):
+        """Reload the estimated event shifts saved by ``python -m app.shift_estimation --save``."""
+        try:
+            return self.shift_table.load(self.mongo_db)
+        except PyMongoError as e:
+            logger.error("Error loading shift estimates, using the defaults: %s", e)
+            return 0
+
+    def get(self, device_name):
+        return self.receivers.get(device_name)
+
+    def devices(self):
+        return {name: {"running": receiver.is_running(),
+                       "status": receiver.check_status(),
+                       "label_count": receiver.label_count}
+                for name, receiver in list(self.receivers.items())}
+
+    def start_all(self):
+        for receiver in list(self.receivers.values()):
+            receiver.start()
+
+    def stop_all(self):
+        for receiver in list(self.receivers.values()):
+            receiver.stop()
+
+    def shutdown(self, timeout=None):
+        """
+        Stop every receiver and release the shared loop, HTTP session and workers.
+
+        Deferred labels and then the queued tasks get what is left of ``timeout`` seconds to finish.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.stop_all()
+        if not self.label_queue.drain(timeout):
+            logger.warning("%s deferred labels dropped at shutdown", self.label_queue.pending())
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._http_session.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join()
+            self._loop.close()
+            self._loop = None
+        self.label_queue.stop()
+        self.scheduler.shutdown(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+        self.segmenter_client.close()
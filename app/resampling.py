@@ -0,0 +1,76 @@
+import numpy as np
+
+
+def missing_joints(poses):
+    """True for the joints of (N, C, V, M) frames that were not detected (all channels zero), shaped (N, V, M)."""
+    return ~np.any(poses, axis=1)
+
+
+def resample_poses(timestamps, poses, start_time, end_time, num_frames, max_gap=100):
+    """
+    Resample a pose sequence onto ``num_frames`` evenly spaced times from ``start_time`` to ``end_time``.
+
+    Every grid time is linearly interpolated between the recorded frames around it, so irregular detector
+    timing no longer skews the window. A joint that is missing in either neighbour takes the value of the
+    nearer one instead of being blended halfway towards the origin; grid times before the first or after the
+    last frame hold the edge frame. Gaps are filled the same way and show up in the quality score.
+
+    :param timestamps: Epoch milliseconds of the frames, ascending
+    :param poses: Frames shaped (N, C, V, M)
+    :param max_gap: A grid time counts as observed when a recorded frame lies within ``max_gap`` ms of it
+    :return: (frames shaped (num_frames, C, V, M), quality) where quality is the fraction of observed grid
+             times; (None, 0.0) when there are no frames
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if timestamps.size == 0:
+        return None, 0.0
+    poses = np.asarray(poses, dtype=np.float64)
+    grid = np.linspace(start_time, end_time, num_frames)
+
+    # Recorded frames on either side of every grid time
+    right = np.searchsorted(timestamps, grid, side="right")
+    left = np.clip(right - 1, 0, timestamps.size - 1)
+    right = np.clip(right, 0, timestamps.size - 1)
+    left_times, right_times = timestamps[left], timestamps[right]
+    span = right_times - left_times
+    weight = np.clip(np.divide(grid - left_times, span, out=np.zeros_like(grid), where=span > 0), 0, 1)
+
+    expand = (slice(None),) + (np.newaxis,) * (poses.ndim - 1)
+    resampled = poses[left] * (1 - weight[expand]) + poses[right] * weight[expand]
+    missing = missing_joints(poses)
+    nearest = np.where(weight < 0.5, left, right)
+    unpaired = (missing[left] | missing[right])[:, np.newaxis]
+    resampled = np.where(unpaired, poses[nearest], resampled)
+
+    distance = np.minimum(np.abs(grid - left_times), np.abs(right_times - grid))
+    quality = float(np.mean(distance <= max_gap))
+    return resampled, quality
+
+
+def split_sources(timestamps, poses, sources):
+    """Group chronologically ordered frames by their source, as {source: (timestamps, poses)}."""
+    groups = {}
+    for index, source in enumerate(sources):
+        groups.setdefault(source, []).append(index)
+    return {source: (timestamps[indices], poses[indices]) for source, indices in groups.items()}
+
+
+def resample_streams(streams, start_time, end_time, num_frames, max_gap=100):
+    """
+    Resample the frames of every source separately and keep the best window.
+
+    Poses of different cameras are in unrelated pixel coordinates, so they are never interpolated with each
+    other: each camera's stream is resampled on its own and the one with the highest quality wins, ties going
+    to the stream with more frames and then to the first source by name.
+
+    :param streams: {source: (timestamps, poses)} as returned by split_sources
+    :return: (frames, quality, source) of the chosen stream; (None, 0.0, None) when there are no frames
+    """
+    best = (None, 0.0, None)
+    best_rank = None
+    for source, (timestamps, poses) in sorted(streams.items(), key=lambda item: str(item[0])):
+        frames, quality = resample_poses(timestamps, poses, start_time, end_time, num_frames, max_gap)
+        rank = (quality, len(timestamps))
+        if frames is not None and (best_rank is None or rank > best_rank):
+            best, best_rank = (frames, quality, source), rank
+    return best
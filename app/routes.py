@@ -1,7 +1,13 @@
-from .save_trigger import PowerMeterReceiver
+import logging
+import os
+
+from .lifecycle import forward_to_services
+from .receiver_manager import ReceiverManager, load_device_configs
 from flask import blueprints, request, jsonify
 from app import mongodb
 
+logger = logging.getLogger(__name__)
+
 BASE_URL = "http://128.195.151.182:9001/api/data"
 THRESHOLD = 15
 STREAM_SEGMENTER_URL = "http://128.195.151.182:9095/api/v1/web_stream"
@@ -13,29 +19,98 @@ DEVICE_NAME = "power-meter-14"
 # DEVICE_NAME = "mock-power-meter-1"
 VALUE_KEY = "Current"
 
-receiver = PowerMeterReceiver(base_url=BASE_URL, device_name=DEVICE_NAME, threshold=THRESHOLD, save_time=SAVE_TIME,
-                              camera_base_url=STREAM_SEGMENTER_URL, camera_name_list=CAMERA_NAME_LIST, trigger_time=TRIGGER_TIME,
-                              value_key=VALUE_KEY, mongo_db=mongodb, frequency=0)
-print("Starting receiver...")
-receiver.start()
+# Used when DEVICES_CONFIG does not point to a JSON list of devices
+DEFAULT_DEVICE = {
+    "device_name": DEVICE_NAME,
+    "threshold": THRESHOLD,
+    "save_time": SAVE_TIME,
+    "trigger_time": TRIGGER_TIME,
+    "camera_name_list": CAMERA_NAME_LIST,
+    "value_key": VALUE_KEY,
+    "frequency": 0
+}
+
+manager = ReceiverManager(mongo_db=mongodb, base_url=BASE_URL, camera_base_url=STREAM_SEGMENTER_URL)
+# Routes without a device in the path act on the first configured device
+default_device = None
+
+
+def start_receivers():
+    """Add and start the configured receivers; called once per process by app.lifecycle.start_services."""
+    global default_device
+    logger.info("%s shift estimates loaded", manager.load_shifts())
+    logger.info("Starting receivers...")
+    for device_config in load_device_configs(os.environ.get('DEVICES_CONFIG'), DEFAULT_DEVICE):
+        manager.add(**device_config)
+    default_device = next(iter(manager.receivers), None)
+    logger.info("Receivers started successfully")
 
-print("Receiver started successfully")
 
 trigger_blueprint = blueprints.Blueprint('tigger', __name__, url_prefix='/api/v1/trigger')
+trigger_blueprint.before_request(forward_to_services)
+
+
+def device_not_found(device):
+    return jsonify({"error": f"Unknown device {device}"}), 404
+
+
+@trigger_blueprint.route('/devices', methods=['GET'])
+def list_devices():
+    return jsonify(manager.devices()), 200
+
+
+@trigger_blueprint.route('/devices', methods=['POST'])
+def add_device():
+    data = request.json
+    if not data or 'device_name' not in data:
+        return jsonify({"error": "device_name is required"}), 400
+    global default_device
+    try:
+        manager.add(**data)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    if default_device is None:
+        default_device = data['device_name']
+    return jsonify({"message": f"Device {data['device_name']} added"}), 201
+
+
+@trigger_blueprint.route('/devices/<string:device>', methods=['DELETE'])
+def remove_device(device):
+    global default_device
+    if not manager.remove(device):
+        return device_not_found(device)
+    if device == default_device:
+        default_device = next(iter(manager.receivers), None)
+    return jsonify({"message": f"Device {device} removed"}), 200
+
+
+@trigger_blueprint.route('/shifts', methods=['GET'])
+def list_shifts():
+    return jsonify(manager.shift_table.as_dict()), 200
+
+
+@trigger_blueprint.route('/shifts/reload', methods=['POST'])
+def reload_shifts():
+    return jsonify({"loaded": manager.load_shifts()}), 200
 
 
 @trigger_blueprint.route('/update_info', methods=['POST'])
-def update_info():
+@trigger_blueprint.route('/<string:device>/update_info', methods=['POST'])
+def update_info(device=None):
+    receiver = manager.get(device or default_device)
+    if receiver is None:
+        return device_not_found(device)
 
     data = request.json
+    if 'device_name' in data:
+        # The receivers are keyed by device name and stream from its meter: remove the device and add it again
+        return jsonify({"error": "device_name cannot be changed, remove the device and add it again"}), 400
     if 'camera_base_url' in data:
         receiver.camera_base_url = data['camera_base_url']
     if 'stream_url' in data:
         receiver.stream_url = data['stream_url']
     if 'camera_name' in data:
         receiver.camera_name_list = data['camera_name_list']
-    if 'device_name' in data:
-        receiver.device_name = data['device_name']
     if 'trainer_url' in data:
         receiver.trainer_url = data['trainer_url']
     if 'value_key' in data:
@@ -46,6 +121,9 @@ def update_info():
         receiver.threshold = data['threshold']
     if 'trigger_time' in data:
         receiver.auto_insert_time = data['trigger_time']
+    for bound in ('rise_max_value', 'rise_min_jump', 'fall_max_previous', 'debounce_time'):
+        if bound in data:
+            setattr(receiver.detector, bound, data[bound])
 
     if 'status' in data:
         status = data['labe']
@@ -59,7 +137,12 @@ def update_info():
 
 
 @trigger_blueprint.route('/get_info', methods=['GET'])
-def get_info():
+@trigger_blueprint.route('/<string:device>/get_info', methods=['GET'])
+def get_info(device=None):
+    receiver = manager.get(device or default_device)
+    if receiver is None:
+        return device_not_found(device)
+
     info = {
         "camera_base_url": receiver.camera_base_url,
         "camera_name_list": receiver.camera_name_list,
@@ -70,14 +153,28 @@ def get_info():
         "save_time": receiver.save_time,
         "threshold": receiver.threshold,
         "trigger_time": receiver.auto_insert_time,
+        "rise_max_value": receiver.detector.rise_max_value,
+        "rise_min_jump": receiver.detector.rise_min_jump,
+        "fall_max_previous": receiver.detector.fall_max_previous,
+        "debounce_time": receiver.detector.debounce_time,
+        "detector": receiver.detector.stats,
         "label_count": receiver.label_count,
-        "status": receiver.check_status()
+        "status": receiver.check_status(),
+        "scheduler": receiver.scheduler.metrics(),
+        "pending_labels": receiver.label_queue.pending()
     }
+    if receiver.mongo_db.window_cache is not None:
+        info["window_cache"] = receiver.mongo_db.window_cache.summary()
     return jsonify(info), 200
 
 
 @trigger_blueprint.route('/pose_status')
-def pose_status():
+@trigger_blueprint.route('/<string:device>/pose_status')
+def pose_status(device=None):
+    receiver = manager.get(device or default_device)
+    if receiver is None:
+        return device_not_found(device)
+
     pose_detected = request.args.get('detected', 'false')
     # Convert the string to a boolean
     if pose_detected.lower() == 'true':
@@ -91,7 +188,12 @@ def pose_status():
 
 
 @trigger_blueprint.route('/change_status/<string:status>', methods=['GET'])
-def change_status(status):
+@trigger_blueprint.route('/<string:device>/change_status/<string:status>', methods=['GET'])
+def change_status(status, device=None):
+    receiver = manager.get(device or default_device)
+    if receiver is None:
+        return device_not_found(device)
+
     status = int(status)
     if status in [1, 0, -1]:
         status = receiver.change_status(status=status)
@@ -101,30 +203,55 @@ def change_status(status):
 
 
 @trigger_blueprint.route('/check_status', methods=['GET'])
-def check_status():
+@trigger_blueprint.route('/<string:device>/check_status', methods=['GET'])
+def check_status(device=None):
+    receiver = manager.get(device or default_device)
+    if receiver is None:
+        return device_not_found(device)
+
     status = receiver.check_status()
     return jsonify({"message": f"Current status is {status}"}), 200
 
 
 @trigger_blueprint.route('/start', methods=['GET'])
-def start():
+@trigger_blueprint.route('/<string:device>/start', methods=['GET'])
+def start(device=None):
+    receiver = manager.get(device or default_device)
+    if receiver is None:
+        return device_not_found(device)
+
     message = receiver.start()
     return jsonify({"message": message}), 200
 
 
 @trigger_blueprint.route('/stop', methods=['GET'])
-def stop():
+@trigger_blueprint.route('/<string:device>/stop', methods=['GET'])
+def stop(device=None):
+    receiver = manager.get(device or default_device)
+    if receiver is None:
+        return device_not_found(device)
+
     message = receiver.stop()
     return jsonify({"message": "Receiver stopped successfully"}), 200
 
 
 @trigger_blueprint.route('/start_auto_labeling', methods=['POST'])
-def start_labeling():
+@trigger_blueprint.route('/<string:device>/start_auto_labeling', methods=['POST'])
+def start_labeling(device=None):
+    receiver = manager.get(device or default_device)
+    if receiver is None:
+        return device_not_found(device)
+
     receiver.start_auto_labeling()
     return jsonify({"message": "Labeling started successfully"}), 200
 
 
 @trigger_blueprint.route('/stop_auto_labeling', methods=['POST'])
-def stop_labeling():
+@trigger_blueprint.route('/<string:device>/stop_auto_labeling', methods=['POST'])
+def stop_labeling(device=None):
+    receiver = manager.get(device or default_device)
+    if receiver is None:
+        return device_not_found(device)
+
     receiver.stop_auto_labeling()
     return jsonify({"message": "Labeling stopped successfully"}), 200
@@ -1,22 +1,37 @@
+import asyncio
+import logging
 import threading
 from datetime import datetime, timedelta
-from .utils import interactive_model_shift, effect_state_detection
-import pytz
+from .utils import parse_meter_timestamp, timestamp_to_datetime
 
 from .database import MongoDBHandler
+from .segmenter_client import StreamSegmenterClient
+from .scheduler import TaskScheduler
+from .sse import SSEStreamClient, parse_json_payload
+from .labeling import DeferredLabelQueue
+from .event_detector import EventDetector
+from .shift_estimation import ShiftTable
+from . import metrics
 import requests
 import time
-import json
+
+logger = logging.getLogger(__name__)
 
 
 class PowerMeterReceiver:
 
     def __init__(self, base_url, device_name, threshold, camera_base_url, camera_name_list, value_key, frequency=0,
-                 save_time=5, trigger_time=5, mongo_db=None, status=0, custom_shape=(3, 25)):
+                 save_time=5, trigger_time=5, mongo_db=None, status=0, custom_shape=(3, 25),
+                 segmenter_client=None, scheduler=None, event_loop=None, http_session=None, label_queue=None,
+                 rise_max_value=42, rise_min_jump=30, fall_max_previous=28, debounce_time=0, shift_table=None):
         # self.stream_url = f"{base_url}/kafka_stream/latest/{device_name}"
         self.label_count = {0: 0, 1: 0}
         self.stream_url = f"{base_url}/kafka_stream/{device_name}?frequency={frequency}"
-        self.threshold = threshold
+        # Switch detection on micro-batches of samples, see EventDetector for the bounds
+        self.detector = EventDetector(threshold, rise_max_value=rise_max_value, rise_min_jump=rise_min_jump,
+                                      fall_max_previous=fall_max_previous, debounce_time=debounce_time)
+        # Learned delay between an event and the pose activity behind it, see shift_estimation
+        self.shift_table = shift_table or ShiftTable()
         self.device_name = device_name
         self.save_time = save_time  # for saving past video and poses
         self.auto_insert_time = trigger_time  # for triggering the label insertion
@@ -24,11 +39,25 @@ class PowerMeterReceiver:
         self.status = status
         self.camera_base_url = camera_base_url
         self.camera_name_list = camera_name_list
-        self.previous_value = None
+        # Shared keep-alive client used to request clips from every camera concurrently
+        self.segmenter_client = segmenter_client or StreamSegmenterClient()
+        # Fixed worker pool and timer shared by event processing, status resets and auto-labeling
+        self.scheduler = scheduler or TaskScheduler(name=f"receiver-{device_name}")
+        self.auto_label_task = None
+        # Label requests wait here until the pose detector has caught up with their timestamp
+        self.label_queue = label_queue or DeferredLabelQueue(mongo_db)
+        # Time of the last sample seen, used to resume the stream after a reconnect without losing samples
+        self.last_sample_timestamp = None
+        self.replay_until = None
         self.value_key = value_key
         self.mongo_db = mongo_db
         self.notification_db = 'notification'
         self.monitor_thread = None
+        # When an event loop is given (see ReceiverManager) the stream is consumed by a coroutine on that
+        # shared loop instead of a dedicated blocking thread
+        self.event_loop = event_loop
+        self.http_session = http_session
+        self.monitor_future = None
         self.auto_tagging = False  # A flag to control the scheduling
         self.event_tagging = False
         self.monitor_flag = True
@@ -37,21 +66,28 @@ class PowerMeterReceiver:
         # deprecated
         self.has_pose = True
 
+    @property
+    def threshold(self):
+        return self.detector.threshold
+
+    @threshold.setter
+    def threshold(self, threshold):
+        self.detector.threshold = threshold
+
     def schedule_labeling(self, interval_in_minutes=10):
         """Schedule a label to be inserted at regular intervals."""
         # Calculate the next trigger time
         next_trigger_time = datetime.now() + timedelta(minutes=interval_in_minutes)
-        print(next_trigger_time)
         # Schedule the insert_label to be called
-        threading.Timer(interval_in_minutes * 60, self.trigger_label_auto_insertion).start()
+        self.auto_label_task = self.scheduler.call_later(interval_in_minutes * 60, self.trigger_label_auto_insertion)
 
-        print(f"Labeling scheduled at: {next_trigger_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        logger.info("Labeling scheduled at: %s", next_trigger_time.strftime('%Y-%m-%d %H:%M:%S'))
 
     def trigger_label_auto_insertion(self):
         """Trigger label insertion and reschedule the next one."""
         if self.auto_tagging:
             label = self.status
-            print(f"Time for auto label insertion... current label: {label}")
+            logger.info("Time for auto label insertion... current label: %s", label)
             if not self.event_tagging and self.has_pose:
                 timestamp = int(time.time() * 1000)
                 self._save_past_video(self.save_time, timestamp=timestamp)
@@ -68,14 +104,22 @@ class PowerMeterReceiver:
     def stop_auto_labeling(self):
         """Stop the periodic labeling process."""
         self.auto_tagging = False
+        if self.auto_label_task is not None:
+            self.auto_label_task.cancel()
+            self.auto_label_task = None
 
-    def event_triggering_process(self, past_video=True, save_time=None, timestamp=None, label=None):
+    def event_triggering_process(self, past_video=True, save_time=None, timestamp=None, label=None, event_time=None,
+                                 switch=None, detected_at=None):
 
         if label is None:
             label = self.status
-        self.save_event_triggered_notification(label=label, timestamp=timestamp, database=self.notification_db)
-        print("saving video...")
+        self.save_event_triggered_notification(label=label, timestamp=timestamp, database=self.notification_db,
+                                               event_time=event_time, switch=switch)
+        logger.debug("saving video...")
         """Save past video segments and schedule to save future video segments."""
+        if detected_at is not None:
+            # time.monotonic() of the detection, see handle_event
+            metrics.CLIP_REQUEST_LATENCY.observe(time.monotonic() - detected_at, device=self.device_name)
         if past_video:
             self._save_past_video(save_time, timestamp=timestamp)
         elif save_time is not None:
@@ -85,58 +129,54 @@ class PowerMeterReceiver:
         # self.insert_label(label=label, timestamp=timestamp)
 
     def _save_past_video(self, save_time=None, timestamp=None):
-        """Save past video segments."""
-        try:
-            for camera_name in self.camera_name_list:
-                if timestamp:
-                    print("startime", timestamp - save_time * 1000, "stoptime", timestamp)
-                    response = requests.post(f"{self.camera_base_url}/save_past",
-                                             json={"camera_name": camera_name,
-                                                   "start_time": timestamp - save_time * 1000,
-                                                   "stop_time": timestamp,
-                                                   "is_timestamps": True
-                                                   }
-                                             )
-                else:
-                    response = requests.post(f"{self.camera_base_url}/save_past",
-                                             json={"camera_name": camera_name,
-                                                   "start_time": save_time,
-                                                   "stop_time": 0
-                                                   }
-                                             )
-                if response.status_code == 200:
-                    print(response.json().get('status', 'Operation completed'))
-                else:
-                    print(f"Error saving past video: {response.text}")
-        except requests.RequestException as e:
-            print(f"Error saving past video: {e}")
+        """Save past video segments of every camera concurrently."""
+        payloads = {}
+        for camera_name in self.camera_name_list:
+            if timestamp:
+                payloads[camera_name] = {"camera_name": camera_name,
+                                         "start_time": timestamp - save_time * 1000,
+                                         "stop_time": timestamp,
+                                         "is_timestamps": True
+                                         }
+            else:
+                payloads[camera_name] = {"camera_name": camera_name,
+                                         "start_time": save_time,
+                                         "stop_time": 0
+                                         }
+        if timestamp:
+            logger.debug("startime %s stoptime %s", timestamp - save_time * 1000, timestamp)
+        results = self.segmenter_client.post_to_cameras(f"{self.camera_base_url}/save_past", payloads)
+        for camera_name, result in results.items():
+            if result["ok"]:
+                logger.info("%s: %s (%s ms)", camera_name, result['status'], result['elapsed_ms'])
+            else:
+                logger.error("Error saving past video for %s: %s", camera_name, result['error'])
+        return results
 
     def _save_next_video(self, save_time=None, timestamp=None):
-        """Schedule to save future video segments."""
-        try:
-            for camera_name in self.camera_name_list:
-                response = requests.post(f"{self.camera_base_url}/save_next",
-                                         json={"camera_name": camera_name,
-                                               "save_time": save_time
-                                               }
-                                         )
-                if response.status_code == 200:
-                    print(response.json().get('status', 'Operation completed'))
-                else:
-                    print(f"Error scheduling next video save: {response.text}")
-        except requests.RequestException as e:
-            print(f"Error scheduling next video save: {e}")
-
-    def save_event_triggered_notification(self, label=0, database='notification', duration=None, timestamp=None):
-        """Save status change."""
+        """Schedule to save future video segments of every camera concurrently."""
+        payloads = {camera_name: {"camera_name": camera_name, "save_time": save_time}
+                    for camera_name in self.camera_name_list}
+        results = self.segmenter_client.post_to_cameras(f"{self.camera_base_url}/save_next", payloads)
+        for camera_name, result in results.items():
+            if result["ok"]:
+                logger.info("%s: %s (%s ms)", camera_name, result['status'], result['elapsed_ms'])
+            else:
+                logger.error("Error scheduling next video save for %s: %s", camera_name, result['error'])
+        return results
+
+    def save_event_triggered_notification(self, label=0, database='notification', duration=None, timestamp=None,
+                                          event_time=None, switch=None):
+        """Save status change; the unshifted event time and switch type feed the shift estimation."""
         try:
             if duration is None:
                 duration = self.save_time
-            self.mongo_db.insert(database,
-                                 {'service': self.device_name, 'label_status': label, 'timestamp': timestamp,
-                                  'duration': duration})
+            self.mongo_db.buffered_insert(database,
+                                          {'service': self.device_name, 'label_status': label,
+                                           'timestamp': timestamp, 'duration': duration,
+                                           'event_time': event_time, 'switch': switch})
         except Exception as e:
-            print(f"Error saving status change: {e}")
+            logger.error("Error saving status change: %s", e)
 
     def insert_label(self, label=None, max_retries=3, delay_between_retries=0, timestamp=None):
         """Tagging the poses with the label"""
@@ -145,51 +185,72 @@ class PowerMeterReceiver:
             label = self.status
         if not timestamp:
             timestamp = int(time.time() * 1000)
+        # Wait for the all possible lagged pose to be available without holding this thread
+        return self.label_queue.enqueue(timestamp, lambda: self._store_label(label=label, timestamp=timestamp))
+
+    def _store_label(self, label, timestamp):
         try:
-            # Wait for the all possible lagged pose to be available
-            time.sleep(60)
             poses = self.mongo_db.fetch_poses(timestamp=timestamp, past_time=self.save_time,
                                               custom_shape=self.custom_shape)
-            print("auto fetched complete")
+            logger.debug("auto fetched complete")
             self.mongo_db.store_labeled_pose(timestamp=timestamp, poses=poses, label=label, past_time=self.save_time)
             self.label_count[label] += 1
         except Exception as e:
-            print(f"Error inserting labeled poses: {e}")
+            logger.error("Error inserting labeled poses: %s", e)
 
     def process_data_point(self, data_point):
         """Process a single data point from the power meter stream."""
-        # print("processing data points")
-        current_value = data_point.get("values", {}).get(self.value_key)
-        time_string = data_point.get("time")
-        dt = datetime.strptime(time_string, "%m/%d/%Y %H:%M:%S.%f").replace(tzinfo=pytz.utc)
-
-        # Convert the timezone-aware datetime object into a timestamp (in seconds)
-        # print(current_value)
-        # Convert to Unix timestamp in milliseconds
-        timestamp = int(dt.timestamp() * 1000)
-        if current_value is None:
+        self.process_data_points([data_point])
+
+    def process_data_points(self, data_points):
+        """Process consecutive data points from the power meter stream, detecting events in one batch."""
+        timestamps = []
+        values = []
+        for data_point in data_points:
+            # Convert the UTC meter time to a Unix timestamp in milliseconds
+            timestamp = parse_meter_timestamp(data_point.get("time"))
+            if self.replay_until is not None:
+                # Skip samples the server replays from before the reconnect
+                if timestamp <= self.replay_until:
+                    continue
+                self.replay_until = None
+            self.last_sample_timestamp = timestamp
+            current_value = data_point.get("values", {}).get(self.value_key)
+            if current_value is not None:
+                timestamps.append(timestamp)
+                values.append(current_value)
+        if not values:
             return
 
-        if self.previous_value is not None:
-            status, switch = effect_state_detection(self.previous_value, current_value, self.threshold)
-            if status == 1:
-                self.status = 1
-                self.event_tagging = True
-                print(f"event detected at {dt.strftime('%Y-%m-%d %H:%M:%S')}, timestamp: {timestamp}")
-                shift_time, shifted_timestamp = interactive_model_shift(timestamp=timestamp, additional_parameters=None, switch=switch)
-                threading.Thread(
-                    target=self.event_triggering_process,
-                    kwargs={
-                        'past_video': True,
-                        'save_time': self.save_time,
-                        'timestamp': shifted_timestamp,
-                        'label': status
-                    }
-                ).start()
-
-                threading.Timer(self.save_time, self.change_status, args=(0,)).start()  # Resets after 5 second
-
-        self.previous_value = current_value
+        metrics.SAMPLES.inc(len(values), device=self.device_name)
+        indices, switches = self.detector.detect(values, timestamps)
+        for index, switch in zip(indices.tolist(), switches.tolist()):
+            self.handle_event(timestamps[index], switch)
+
+    def handle_event(self, timestamp, switch):
+        """Start saving the clips and poses of a detected switch event."""
+        status = 1
+        self.status = status
+        self.event_tagging = True
+        detected_at = time.monotonic()
+        metrics.EVENTS.inc(device=self.device_name, switch=switch)
+        logger.info("event detected at %s, timestamp: %s",
+                    timestamp_to_datetime(timestamp).strftime('%Y-%m-%d %H:%M:%S'), timestamp)
+        shifted_timestamp = int(timestamp - self.shift_table.shift(self.device_name, switch) * 1000)
+        accepted = self.scheduler.submit(self.event_triggering_process,
+                                         past_video=True,
+                                         save_time=self.save_time,
+                                         timestamp=shifted_timestamp,
+                                         label=status,
+                                         event_time=timestamp,
+                                         switch=switch,
+                                         detected_at=detected_at)
+        if not accepted:
+            metrics.EVENTS_DROPPED.inc(device=self.device_name)
+            logger.warning("Event at %s dropped, scheduler queue is full", timestamp)
+
+        # Resets after 5 second, one timer per event like the former threading.Timer
+        self.scheduler.call_later(self.save_time, self.change_status, 0)
 
     def change_status(self, status=0):
         self.status = status
@@ -209,49 +270,99 @@ class PowerMeterReceiver:
                 with requests.get(self.stream_url, stream=True) as response:
                     # Ensure that the request was successful
                     response.raise_for_status()
-                    print(self.stream_url)
-                    print("stream received")
+                    logger.info("stream received: %s", self.stream_url)
                     # Stream and process the data
                     for line in response.iter_lines():
                         if not self.monitor_flag:
                             break
                         if line:
-                            # Parse the JSON data from the line
-                            try:
-                                decoded_line = line.decode('utf-8')
-                                if decoded_line.startswith("data: "):
-                                    # remove "data: " prefix and replace single quotes
-                                    json_str = decoded_line[6:].replace("'", '"')
-                                    data = json.loads(json_str)
-                                    self.process_data_point(data)
-                                else:
-                                    print(f"Unexpected line format: {decoded_line}")
-                            except json.JSONDecodeError:
-                                print(f"Failed to decode JSON from line: {line.decode('utf-8')[6:]}")
+                            self.handle_stream_line(line)
 
             except requests.RequestException as e:
-                print(f"Error while connecting to the power meter stream: {e}")
+                logger.error("Error while connecting to the power meter stream: %s", e)
                 time.sleep(10)
-            print("starting another attempt in 10 seconds...")
+            logger.info("starting another attempt in 10 seconds...")
+
+    def resume_url(self):
+        """Stream URL for a (re)connect, asking the meter to resume from the last sample seen."""
+        if self.last_sample_timestamp is None:
+            return self.stream_url
+        self.replay_until = self.last_sample_timestamp
+        separator = "&" if "?" in self.stream_url else "?"
+        return f"{self.stream_url}{separator}start_time={self.last_sample_timestamp}"
+
+    async def monitor(self, session):
+        """Coroutine version of start_monitoring that consumes the stream on a shared event loop."""
+        client = SSEStreamClient(session, self.resume_url, should_continue=lambda: self.monitor_flag)
+        async for events in client.event_batches():
+            # Events completed by one network read go through the detector as one batch
+            try:
+                self.handle_stream_payloads([payload for event in events for payload in event.data.split(b"\n")
+                                             if payload])
+            except Exception:
+                # A batch that fails to process must not end the monitor
+                logger.exception("Error processing %s power meter events", len(events))
+
+    def _monitor_done(self, future):
+        """Log why the monitor coroutine ended, and let start() run it again."""
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error("Power meter monitor stopped: %r", error, exc_info=error)
+        if self.monitor_future is future:
+            self.monitor_future = None
+
+    def handle_stream_line(self, line):
+        """Parse one non-empty line of the power meter stream and process its data point."""
+        if line.startswith(b"data: "):
+            # remove "data: " prefix
+            self.handle_stream_payload(line[6:])
+        else:
+            logger.warning("Unexpected line format: %s", line.decode('utf-8', 'replace'))
+
+    def handle_stream_payload(self, payload):
+        self.handle_stream_payloads([payload])
+
+    def handle_stream_payloads(self, payloads):
+        data_points = []
+        for payload in payloads:
+            try:
+                data_points.append(parse_json_payload(payload))
+            except ValueError:
+                logger.warning("Failed to decode JSON from line: %s", payload.decode('utf-8', 'replace'))
+        if data_points:
+            self.process_data_points(data_points)
+
+    def is_running(self):
+        return self.monitor_thread is not None or self.monitor_future is not None
 
     def start(self):
-        if self.monitor_thread is not None:
+        if self.is_running():
             return "Already started"
-        print("start the save_trigger")
+        logger.info("start the save_trigger")
         self.monitor_flag = True
-        self.monitor_thread = threading.Thread(target=self.start_monitoring)
-        self.monitor_thread.start()
+        if self.event_loop is not None:
+            self.monitor_future = asyncio.run_coroutine_threadsafe(self.monitor(self.http_session), self.event_loop)
+            self.monitor_future.add_done_callback(self._monitor_done)
+        else:
+            self.monitor_thread = threading.Thread(target=self.start_monitoring)
+            self.monitor_thread.start()
         # print("Starting labeling...")
         # self.start_auto_labeling()
         return "Started"
 
     def stop(self):
-        if self.monitor_thread is None:
+        if not self.is_running():
             return "Already stopped"
         self.monitor_flag = False
-        self.monitor_thread.join()
+        if self.monitor_future is not None:
+            self.monitor_future.cancel()
+            self.monitor_future = None
+        else:
+            self.monitor_thread.join()
+            self.monitor_thread = None
         self.stop_auto_labeling()
-        self.monitor_thread = None
         return "Stopped"
 
 
@@ -276,3 +387,4 @@ if __name__ == "__main__":
     timestamp = 1700781155079
     receiver.save_event_triggered_notification(label=label, database='notification', timestamp=timestamp)
     receiver.insert_label(label=label, timestamp=timestamp)
+    receiver.label_queue.drain()
@@ -0,0 +1,201 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+
+
+class ScheduledTask:
+    """Handle of a delayed or periodic task, returned by ``call_later`` and ``call_every``."""
+
+    def __init__(self, due, func, args, kwargs, interval=None):
+        self.due = due
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TaskScheduler:
+    """
+    Fixed-size worker pool with a bounded task queue and a heap-based timer.
+
+    The number of threads is constant (``workers`` plus one timer thread) no matter how many tasks are
+    submitted. When the queue is full the ``drop_policy`` decides what happens to submitted work:
+    ``drop_newest`` rejects the new task, ``drop_oldest`` discards the oldest queued task and ``block``
+    waits up to ``block_timeout`` seconds for room. Timers that come due are always queued.
+
+    The threads start with the scheduler. After ``shutdown`` no work is accepted, so a task that is still
+    running cannot bring the threads back, until ``start`` is called again.
+    """
+
+    def __init__(self, workers=4, max_queue=256, drop_policy=DROP_NEWEST, block_timeout=1.0, name="scheduler"):
+        if drop_policy not in (DROP_NEWEST, DROP_OLDEST, BLOCK):
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+        self.workers = workers
+        self.max_queue = max_queue
+        self.drop_policy = drop_policy
+        self.block_timeout = block_timeout
+        self.name = name
+
+        self._queue = deque()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._timer_changed = threading.Condition(self._lock)
+        self._threads = []
+        self._running = False
+
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "dropped": 0,
+            "max_queue_depth": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+            "total_run_ms": 0.0,
+            "max_run_ms": 0.0
+        }
+        self.start()
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._threads = [threading.Thread(target=self._worker, name=f"{self.name}-worker-{i}", daemon=True)
+                             for i in range(self.workers)]
+            self._threads.append(threading.Thread(target=self._timer_loop, name=f"{self.name}-timer", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stop accepting work, let queued tasks finish and join the threads, for up to ``timeout`` seconds."""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._timers.clear()
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            self._timer_changed.notify_all()
+        if wait:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            for thread in self._threads:
+                thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            unfinished = sum(thread.is_alive() for thread in self._threads)
+            if unfinished:
+                logger.warning("%s: %s threads still busy after %ss, %s queued tasks left", self.name, unfinished,
+                               timeout, len(self._queue))
+        self._threads = []
+
+    def submit(self, func, *args, **kwargs):
+        """Queue ``func(*args, **kwargs)`` for a worker. Returns False if the task was dropped or not accepted."""
+        with self._lock:
+            if not self._running:
+                return False
+            return self._enqueue(func, args, kwargs)
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """Run ``func`` on a worker after ``delay`` seconds. Returns None if the scheduler is shut down."""
+        return self._schedule(ScheduledTask(time.monotonic() + delay, func, args, kwargs))
+
+    def call_every(self, interval, func, *args, **kwargs):
+        """Run ``func`` on a worker every ``interval`` seconds until the returned handle is cancelled."""
+        return self._schedule(ScheduledTask(time.monotonic() + interval, func, args, kwargs, interval=interval))
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queue_depth"] = len(self._queue)
+            stats["scheduled"] = sum(1 for _, _, task in self._timers if not task.cancelled)
+        finished = stats["completed"] + stats["failed"]
+        stats["avg_wait_ms"] = round(stats.pop("total_wait_ms") / finished, 3) if finished else 0.0
+        stats["avg_run_ms"] = round(stats.pop("total_run_ms") / finished, 3) if finished else 0.0
+        stats["threads"] = len(self._threads)
+        return stats
+
+    def _schedule(self, task):
+        with self._lock:
+            if not self._running:
+                return None
+            heapq.heappush(self._timers, (task.due, next(self._sequence), task))
+            self._timer_changed.notify()
+        return task
+
+    def _enqueue(self, func, args, kwargs, force=False):
+        # Must be called with self._lock held
+        if len(self._queue) >= self.max_queue and not force:
+            if self.drop_policy == DROP_OLDEST:
+                self._queue.popleft()
+                self._stats["dropped"] += 1
+            elif self.drop_policy == BLOCK:
+                self._not_full.wait_for(lambda: len(self._queue) < self.max_queue or not self._running,
+                                        timeout=self.block_timeout)
+            if len(self._queue) >= self.max_queue or not self._running:
+                self._stats["dropped"] += 1
+                return False
+        self._queue.append((time.monotonic(), func, args, kwargs))
+        self._stats["submitted"] += 1
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._queue))
+        self._not_empty.notify()
+        return True
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                self._not_empty.wait_for(lambda: self._queue or not self._running)
+                if not self._queue:
+                    return
+                enqueued, func, args, kwargs = self._queue.popleft()
+                self._not_full.notify()
+            started = time.monotonic()
+            failed = False
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                logger.error("Error in scheduled task %s: %s", getattr(func, '__name__', func), e)
+            finished = time.monotonic()
+            wait_ms = (started - enqueued) * 1000
+            run_ms = (finished - started) * 1000
+            with self._lock:
+                self._stats["failed" if failed else "completed"] += 1
+                self._stats["total_wait_ms"] += wait_ms
+                self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+                self._stats["total_run_ms"] += run_ms
+                self._stats["max_run_ms"] = max(self._stats["max_run_ms"], run_ms)
+
+    def _timer_loop(self):
+        with self._lock:
+            while self._running:
+                if not self._timers:
+                    self._timer_changed.wait()
+                    continue
+                due, _, task = self._timers[0]
+                now = time.monotonic()
+                if due > now:
+                    self._timer_changed.wait(due - now)
+                    continue
+                heapq.heappop(self._timers)
+                if task.cancelled:
+                    continue
+                if task.interval is not None:
+                    task.due = due + task.interval
+                    heapq.heappush(self._timers, (task.due, next(self._sequence), task))
+                # Due timers bypass the queue bound so delayed work such as status resets is never lost
+                self._enqueue(task.func, task.args, task.kwargs, force=True)
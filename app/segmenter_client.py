@@ -0,0 +1,66 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class StreamSegmenterClient:
+    """
+    Keep-alive HTTP client for the stream segmenter that fans a request out to many cameras at once.
+
+    All requests share one ``requests.Session`` whose connection pool is sized to the number of workers,
+    so repeated clip requests reuse open connections instead of paying a new TCP handshake per camera.
+    """
+
+    def __init__(self, max_workers=16, timeout=(1.0, 5.0), retries=2, backoff_factor=0.1):
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Only requests that never reached the segmenter are retried: save_past and save_next are not
+        # idempotent, and a POST that timed out or got a 5xx may still have started its clip
+        retry = Retry(total=retries,
+                      connect=retries,
+                      read=0,
+                      status=0,
+                      backoff_factor=backoff_factor,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="segmenter")
+
+    def _post(self, url, payload):
+        start = time.perf_counter()
+        try:
+            response = self.session.post(url, json=payload, timeout=self.timeout)
+            result = {"ok": response.status_code == 200, "status_code": response.status_code}
+            if result["ok"]:
+                body = response.json()
+                if not isinstance(body, dict):
+                    # The segmenter answers with a JSON object; any other 200 still means the clip was requested
+                    body = {}
+                result["status"] = body.get('status', 'Operation completed')
+            else:
+                result["error"] = response.text
+        except (requests.RequestException, ValueError) as e:
+            result = {"ok": False, "status_code": None, "error": str(e)}
+        result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return result
+
+    def post_to_cameras(self, url, payloads):
+        """
+        POST one payload per camera concurrently and wait for all of them.
+
+        :param url: Segmenter endpoint, e.g. ``{camera_base_url}/save_past``
+        :param payloads: Mapping of camera name to JSON payload
+        :return: Mapping of camera name to a result summary with ``ok``, ``status_code``, ``status`` or
+                 ``error`` and ``elapsed_ms``
+        """
+        futures = {camera_name: self.executor.submit(self._post, url, payload)
+                   for camera_name, payload in payloads.items()}
+        return {camera_name: future.result() for camera_name, future in futures.items()}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
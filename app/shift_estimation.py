@@ -0,0 +1,225 @@
+import argparse
+import time
+
+import numpy as np
+
+from .pose_codec import decode_pose
+
+# Used until a device has an estimate; the former fixed values of interactive_model_shift
+DEFAULT_SHIFTS = {1: 2.4, 0: 1.4, None: 2.0}  # seconds, by switch type
+
+
+class ShiftTable:
+    """
+    Per-device, per-switch shift in seconds, served from memory.
+
+    ``shift()`` costs two dict lookups and allocates nothing, so it can be called for every event on the
+    stream path. ``load()`` replaces the table as a whole, so readers never see a half-loaded state.
+    """
+
+    def __init__(self, defaults=None, collection_name="shift_estimates"):
+        self.defaults = dict(DEFAULT_SHIFTS if defaults is None else defaults)
+        self.default_shift = self.defaults.get(None, 2.0)
+        self.collection_name = collection_name
+        self._shifts = {}
+
+    def shift(self, device_name, switch):
+        return self._shifts.get(device_name, self.defaults).get(switch, self.default_shift)
+
+    def set(self, device_name, switch, shift):
+        shifts = dict(self._shifts)
+        shifts[device_name] = {**shifts.get(device_name, self.defaults), switch: shift}
+        self._shifts = shifts
+
+    def load(self, mongo_db):
+        """Replace the table with the estimates saved in MongoDB. Returns the number of estimates."""
+        shifts = {}
+        count = 0
+        collection = mongo_db.get_collection(self.collection_name)
+        for estimate in collection.find({}, {"device": 1, "switch": 1, "shift": 1}):
+            shifts.setdefault(estimate["device"], dict(self.defaults))[estimate["switch"]] = estimate["shift"]
+            count += 1
+        self._shifts = shifts
+        return count
+
+    def as_dict(self):
+        return {"defaults": {str(switch): shift for switch, shift in self.defaults.items()},
+                "devices": {device: {str(switch): shift for switch, shift in shifts.items()}
+                            for device, shifts in self._shifts.items()}}
+
+
+def fetch_events(mongo_db, device_name, since=None, until=None, collection_name="notification"):
+    """Event times (epoch ms) of ``device_name`` grouped by switch type, from the event notifications."""
+    # A lower bound also keeps the query on the partial index of notifications that have an event_time
+    time_range = {"$gte": since if since is not None else 0}
+    if until is not None:
+        time_range["$lte"] = until
+    query = {"service": device_name, "event_time": time_range}
+    events = {}
+    for document in mongo_db.get_collection(collection_name).find(query, {"event_time": 1, "switch": 1}):
+        events.setdefault(document.get("switch"), []).append(document["event_time"])
+    return {switch: np.sort(np.asarray(times, dtype=np.int64)) for switch, times in events.items()}
+
+
+def merge_windows(starts, ends):
+    """Union of [start, end] intervals as a list of non-overlapping (start, end) tuples."""
+    order = np.argsort(starts)
+    merged = []
+    for start, end in zip(np.asarray(starts)[order].tolist(), np.asarray(ends)[order].tolist()):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(window) for window in merged]
+
+
+def motion_energy(timestamps, poses):
+    """
+    Motion energy of a pose sequence: summed absolute joint displacement since the previous frame.
+
+    Frames without a person (all-zero poses) and the frame after them get zero energy instead of the jump
+    from or to the origin. Returns (timestamps, energy) for every frame but the first.
+    """
+    if len(poses) < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    flat = poses.reshape(len(poses), -1)
+    present = np.abs(flat).sum(axis=1) > 0
+    energy = np.abs(np.diff(flat, axis=0)).sum(axis=1)
+    energy[~(present[1:] & present[:-1])] = 0
+    return timestamps[1:], energy
+
+
+def fetch_motion_energy(mongo_db, windows, cameras=None, collection_name="results", service="pose_detector"):
+    """Motion energy of the stored poses inside ``windows``, computed per camera and merged by time."""
+    collection = mongo_db.get_collection(collection_name)
+    source_field = mongo_db.source_field
+    times, energies = [], []
+    for start, end in windows:
+        query = {"timestamp": {"$gte": start, "$lte": end}, "service": service, "pose": {"$ne": None}}
+        if cameras:
+            query[source_field] = {"$in": list(cameras)}
+        sequences = {}
+        cursor = collection.find(query, {"timestamp": 1, "pose": 1, source_field: 1}).sort("timestamp", 1)
+        for document in cursor:
+            sequence = sequences.setdefault(document.get(source_field), ([], []))
+            sequence[0].append(document["timestamp"])
+            sequence[1].append(decode_pose(document["pose"]))
+        for sequence_times, poses in sequences.values():
+            shapes = {pose.shape for pose in poses}
+            if len(shapes) != 1:
+                continue
+            frame_times, energy = motion_energy(np.asarray(sequence_times, dtype=np.int64),
+                                                np.stack(poses).astype(np.float32))
+            times.append(frame_times)
+            energies.append(energy)
+    if not times:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    times = np.concatenate(times)
+    order = np.argsort(times, kind="stable")
+    return times[order], np.concatenate(energies)[order]
+
+
+def cross_correlate(event_times, energy_times, energy, max_shift=5.0, resolution=100):
+    """
+    Event-triggered average of motion energy as a function of the lag before the event.
+
+    Each event's window [event - max_shift, event] is normalised by its own mean so that busy scenes do not
+    dominate, then binned by lag at ``resolution`` ms. Returns (lags in ms, mean normalised energy, number of
+    events that contributed); lags without data are NaN.
+    """
+    bins = int(max_shift * 1000 // resolution) + 1
+    sums = np.zeros(bins)
+    counts = np.zeros(bins)
+    used = 0
+    starts = np.searchsorted(energy_times, event_times - int(max_shift * 1000), side="left")
+    ends = np.searchsorted(energy_times, event_times, side="right")
+    for event_time, start, end in zip(event_times.tolist(), starts.tolist(), ends.tolist()):
+        window = energy[start:end]
+        mean = window.mean() if window.size else 0
+        if mean <= 0:
+            continue
+        lag_bins = (event_time - energy_times[start:end]) // resolution
+        sums += np.bincount(lag_bins, weights=window / mean, minlength=bins)[:bins]
+        counts += np.bincount(lag_bins, minlength=bins)[:bins]
+        used += 1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        profile = sums / counts
+    return np.arange(bins) * resolution + resolution / 2, profile, used
+
+
+def estimate_shifts(mongo_db, device_name, cameras=None, since=None, until=None, max_shift=5.0, resolution=100,
+                    smoothing=0.5, min_events=5, min_score=2.0):
+    """
+    Estimate the shift of every switch type of ``device_name`` from its event and pose history.
+
+    People move (reach for the switch, open the door) a moment before the meter registers the change, so
+    the pose window of an event starts before the event. The motion energy of the poses around every
+    recorded event is cross-correlated with the event times and the lag at which motion peaks is the shift.
+    Only the windows around events are read from ``results``, so a long history is cheap to process.
+
+    :param cameras: Cameras watching the device; all cameras when None
+    :param max_shift: Longest delay considered, in seconds
+    :param resolution: Lag resolution in milliseconds
+    :param smoothing: Width in seconds of the moving average applied to the correlation before peak picking
+    :param min_events: Events with pose data needed before an estimate is accepted
+    :param min_score: Peak prominence (z-score of the peak within the profile) needed to accept it
+    :return: List of estimate dicts with device, switch, shift (s), events, score and accepted
+    """
+    events = fetch_events(mongo_db, device_name, since, until)
+    estimates = []
+    for switch, event_times in sorted(events.items(), key=lambda item: (item[0] is None, item[0])):
+        windows = merge_windows(event_times - int(max_shift * 1000), event_times)
+        energy_times, energy = fetch_motion_energy(mongo_db, windows, cameras)
+        lags, profile, used = cross_correlate(event_times, energy_times, energy, max_shift, resolution)
+        estimate = {"device": device_name, "switch": switch, "events": used, "shift": None, "score": 0.0,
+                    "accepted": False}
+        if used and not np.isnan(profile).all():
+            # Smooth so that the peak of the activity wins, not a single noisy bin
+            width = max(1, int(round(smoothing * 1000 / resolution)))
+            profile = np.convolve(np.where(np.isnan(profile), np.nanmean(profile), profile),
+                                  np.ones(width) / width, mode="same")
+            peak = int(np.argmax(profile))
+            spread = profile.std()
+            score = float((profile[peak] - profile.mean()) / spread) if spread > 0 else 0.0
+            estimate.update(shift=round(float(lags[peak]) / 1000, 3), score=round(score, 2),
+                            accepted=used >= min_events and score >= min_score)
+        estimates.append(estimate)
+    return estimates
+
+
+def save_estimates(mongo_db, estimates, collection_name="shift_estimates"):
+    """Store the accepted estimates for ShiftTable.load. Returns the number saved."""
+    collection = mongo_db.get_collection(collection_name)
+    saved = 0
+    for estimate in estimates:
+        if not estimate["accepted"]:
+            continue
+        collection.update_one({"_id": f"{estimate['device']}:{estimate['switch']}"},
+                              {"$set": {"device": estimate["device"], "switch": estimate["switch"],
+                                        "shift": estimate["shift"], "events": estimate["events"],
+                                        "score": estimate["score"], "updated": int(time.time() * 1000)}},
+                              upsert=True)
+        saved += 1
+    return saved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Estimate event-to-pose shifts from history")
+    parser.add_argument("device", nargs="+")
+    parser.add_argument("--camera", action="append", help="camera watching the devices, repeatable")
+    parser.add_argument("--since-days", type=float, default=None)
+    parser.add_argument("--max-shift", type=float, default=5.0, help="seconds")
+    parser.add_argument("--resolution", type=int, default=100, help="milliseconds")
+    parser.add_argument("--min-events", type=int, default=5)
+    parser.add_argument("--save", action="store_true", help="store accepted estimates for the receivers")
+    args = parser.parse_args()
+
+    from app import mongodb
+    since = int((time.time() - args.since_days * 86400) * 1000) if args.since_days else None
+    for device in args.device:
+        results = estimate_shifts(mongodb, device, cameras=args.camera, since=since, max_shift=args.max_shift,
+                                  resolution=args.resolution, min_events=args.min_events)
+        for result in results:
+            print(result)
+        if args.save:
+            print(f"{save_estimates(mongodb, results)} estimates saved for {device}")
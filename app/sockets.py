@@ -1,47 +1,71 @@
-import time
+import logging
 
 from flask import blueprints, current_app
+from flask_socketio import join_room, leave_room
 from app import mongodb, socketio
 
+from . import metrics
+from .change_streams import ChangeStreamHub, room_name
+from .lifecycle import forward_to_services
+
+logger = logging.getLogger(__name__)
+
 notifications_blueprint = blueprints.Blueprint('notifications', __name__, url_prefix='/api/v1/notifications')
-watcher = None
+notifications_blueprint.before_request(forward_to_services)
+
+hub = ChangeStreamHub(mongodb, socketio)
+# Pose detector output; clients subscribe per camera, e.g. {"collection": "results", "camera": "pi-cam-3"}
+hub.watch("results", fields=["timestamp", "service", "camera_name"], room_fields={"camera": "camera_name"},
+          event='notifications')
+# Power meter events; clients subscribe per device or label, e.g. {"collection": "notification", "device": "power-meter-14"}
+hub.watch("notification", fields=["timestamp", "service", "label_status", "duration"],
+          room_fields={"device": "service", "label": "label_status"}, event='notifications')
+hub.watch("labeled_poses", fields=["timestamp", "label", "version", "past_time"], room_fields={"label": "label"},
+          event='notifications')
 
 
-def mongo_watch(collection, operations=None, event='notifications'):
-    print('Starting watcher')
-    collection = mongodb.get_collection(collection)
+def subscription_room(data):
+    """Room named by a subscribe/unsubscribe message, or None if the collection is not watched."""
+    data = data or {}
+    collection_name = data.get('collection', 'results')
+    watch = hub.watches.get(collection_name)
+    if watch is None:
+        return None
+    for key in watch.room_fields:
+        if key in data:
+            return room_name(collection_name, key, data[key])
+    return room_name(collection_name)
 
 
-    timestamp = int(time.time() * 1000)
-    if operations is None:
-        operations = ['insert']
+@socketio.on('subscribe')
+def on_subscribe(data):
+    room = subscription_room(data)
+    if room is None:
+        return {"error": "Unknown collection"}
+    join_room(room)
+    return {"room": room}
 
-    with collection.watch([{'$match': {'operationType': {'$in': operations}}}]) as stream:
-        for change in stream:
-            data = change['fullDocument']
-            doc_timestamp = data['timestamp']
-            curr_timestamp = int(time.time() * 1000)
-            print((curr_timestamp - doc_timestamp)/1000)
-            if doc_timestamp == timestamp:
-                message = curr_timestamp - int(doc_timestamp)
-                socketio.emit(event, message)
-                timestamp = curr_timestamp
+
+@socketio.on('unsubscribe')
+def on_unsubscribe(data):
+    room = subscription_room(data)
+    if room is not None:
+        leave_room(room)
+    return {"room": room}
 
 
 @socketio.on('connect')
 def on_connect():
-    global watcher
-    if watcher is None:
-        watcher = socketio.start_background_task(
-            mongo_watch,
-            # collection=current_app.config['COLLECTION_NAME'],
-            collection="results",
-            operations=['insert', 'update'],
-            event='notifications'
-        )
-    print('Client connected')
+    metrics.SOCKET_CLIENTS.inc()
+    logger.debug('Client connected')
 
 
 @socketio.on('disconnect')
 def on_disconnect():
-    print('Client disconnected')
+    metrics.SOCKET_CLIENTS.dec()
+    logger.debug('Client disconnected')
+
+
+@notifications_blueprint.route('/stats', methods=['GET'])
+def stats():
+    return hub.metrics(), 200
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import random
+from collections import namedtuple
+
+import aiohttp
+
+from .utils import json_loads
+
+logger = logging.getLogger(__name__)
+
+SSEEvent = namedtuple("SSEEvent", ["data", "event", "id"])
+
+
+def parse_json_payload(payload):
+    """Parse a power meter payload (bytes); the meter sends JSON with single quotes."""
+    return json_loads(payload.replace(b"'", b'"'))
+
+
+class SSEDecoder:
+    """
+    Incremental Server-Sent Events framing.
+
+    Bytes are fed in arbitrary chunks; complete events are returned once their terminating blank line has
+    arrived. Lines may end with ``\\n`` or ``\\r\\n``; comment lines (keep-alives) are ignored.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._data = []
+        self._event = None
+        self.last_event_id = None
+        self.retry = None
+
+    def reset(self):
+        """Drop a partially received event, e.g. after the connection was lost."""
+        self._buffer = b""
+        self._data = []
+        self._event = None
+
+    def feed(self, chunk):
+        lines = (self._buffer + chunk).split(b"\n")
+        self._buffer = lines.pop()
+        events = []
+        for line in lines:
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if not line:
+                if self._data:
+                    events.append(SSEEvent(b"\n".join(self._data), self._event, self.last_event_id))
+                self._data = []
+                self._event = None
+                continue
+            if line.startswith(b":"):
+                continue
+            field, _, value = line.partition(b":")
+            if value.startswith(b" "):
+                value = value[1:]
+            if field == b"data":
+                self._data.append(value)
+            elif field == b"id":
+                self.last_event_id = value.decode("utf-8")
+            elif field == b"event":
+                self._event = value.decode("utf-8")
+            elif field == b"retry" and value.isdigit():
+                self.retry = int(value) / 1000
+        return events
+
+
+class SSEStreamClient:
+    """
+    Reconnecting asyncio SSE client.
+
+    ``url_factory`` is called before every (re)connect so the caller can ask the server to resume from the
+    last sample it has seen. Failed or dropped connections are retried with exponential backoff and full
+    jitter, capped at ``backoff_max`` seconds; the backoff resets once a connection delivers events.
+    """
+
+    def __init__(self, session, url_factory, backoff_base=0.5, backoff_max=30, should_continue=None):
+        self.session = session
+        self.url_factory = url_factory
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.should_continue = should_continue or (lambda: True)
+        self.decoder = SSEDecoder()
+        self.reconnects = 0
+
+    def _backoff(self, attempt):
+        base = self.decoder.retry or self.backoff_base
+        return random.uniform(0, min(self.backoff_max, base * 2 ** attempt))
+
+    async def events(self):
+        """Yield SSEEvent objects until ``should_continue`` returns False or the task is cancelled."""
+        async for batch in self.event_batches():
+            for event in batch:
+                yield event
+
+    async def event_batches(self):
+        """Like events(), but yields the list of events completed by each received chunk at once."""
+        attempt = 0
+        while self.should_continue():
+            url = self.url_factory()
+            headers = {"Accept": "text/event-stream"}
+            if self.decoder.last_event_id:
+                headers["Last-Event-ID"] = self.decoder.last_event_id
+            try:
+                async with self.session.get(url, headers=headers) as response:
+                    response.raise_for_status()
+                    logger.info("stream received: %s", url)
+                    self.decoder.reset()
+                    async for chunk in response.content.iter_any():
+                        events = self.decoder.feed(chunk)
+                        if events:
+                            attempt = 0
+                            yield events
+                        if not self.should_continue():
+                            return
+                logger.info("Power meter stream closed: %s", url)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error("Error while connecting to the power meter stream: %s", e)
+            self.reconnects += 1
+            delay = self._backoff(attempt)
+            attempt += 1
+            logger.info("starting another attempt in %.1f seconds...", delay)
+            await asyncio.sleep(delay)
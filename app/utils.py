@@ -1,40 +1,149 @@
 import math
+from datetime import datetime, timezone
+
 import numpy as np
+import pytz
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # orjson is optional, the stdlib parser is the fallback
+    import json
+    json_loads = json.loads
+
+METER_TIME_FORMAT = "%m/%d/%Y %H:%M:%S.%f"
+_EPOCH = datetime(1970, 1, 1)
+_MAX_CACHED_DAYS = 1024
+_day_offsets = {}
+
+
+def parse_meter_timestamp_strptime(time_string):
+    """Reference parser for meter time strings, returning UTC epoch milliseconds."""
+    dt = datetime.strptime(time_string, METER_TIME_FORMAT).replace(tzinfo=pytz.utc)
+    return int(dt.timestamp() * 1000)
+
+
+def _epoch_seconds_of_day(date_string):
+    seconds = _day_offsets.get(date_string)
+    if seconds is None:
+        days = (datetime.strptime(date_string, "%m/%d/%Y") - _EPOCH).days
+        seconds = days * 86400
+        if len(_day_offsets) >= _MAX_CACHED_DAYS:
+            _day_offsets.clear()
+        _day_offsets[date_string] = seconds
+    return seconds
+
+
+def parse_meter_timestamp(time_string):
+    """
+    Parse a meter time string such as ``11/26/2023 20:17:42.014660`` (UTC) into epoch milliseconds.
+
+    The date prefix is converted once and cached, so each sample only costs slicing the time of day.
+    Anything the fast path does not recognise is handed to strptime, which returns the same value for
+    valid input and raises the same errors for malformed input.
+    """
+    try:
+        date_string, clock = time_string.split(" ")
+        hms, fraction = clock.split(".")
+        hours, minutes, seconds = hms.split(":")
+        if not (clock.isascii() and hours.isdigit() and minutes.isdigit() and seconds.isdigit()
+                and fraction.isdigit() and len(hours) <= 2 and len(minutes) <= 2 and len(seconds) <= 2
+                and len(fraction) <= 6):
+            raise ValueError(time_string)
+        hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+        if hours > 23 or minutes > 59 or seconds > 59:
+            raise ValueError(time_string)
+        day_seconds = _epoch_seconds_of_day(date_string)
+    except (ValueError, AttributeError):
+        return parse_meter_timestamp_strptime(time_string)
+    microseconds = (day_seconds + hours * 3600 + minutes * 60 + seconds) * 1000000 + int(fraction.ljust(6, "0"))
+    # Same float arithmetic as int(datetime.timestamp() * 1000)
+    return int(microseconds / 1000000 * 1000)
+
+
+def timestamp_to_datetime(timestamp):
+    """UTC datetime of an epoch-millisecond timestamp."""
+    return datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc)
+
+
+def _rotation_2D_batch(angles):
+    """Stack of 2D rotation matrices, one per angle, shaped (N, 2, 2)."""
+    # math.cos/math.sin keep the result identical to the scalar rotation_2D
+    cos = np.array([math.cos(angle) for angle in angles], dtype=np.float64)
+    sin = np.array([math.sin(angle) for angle in angles], dtype=np.float64)
+    return np.stack([np.stack([cos, -sin], axis=-1),
+                     np.stack([sin, cos], axis=-1)], axis=-2)
+
+
+def _angle_between_batch(v1, v2):
+    """ Returns the angle in radians between each row of 'v1' (N, 2) and the fixed vector 'v2'. """
+    v2 = np.asarray(v2, dtype=np.float64)
+    v2_u = v2 / np.linalg.norm(v2)
+    degenerate = np.abs(v1).sum(axis=-1) < 1e-6
+    norm = np.linalg.norm(v1, axis=-1)
+    norm[degenerate] = 1.0
+    v1_u = v1 / norm[:, None]
+    cosine = v1_u[:, 0] * v2_u[0] + v1_u[:, 1] * v2_u[1]
+    angles = np.arccos(np.clip(cosine, -1.0, 1.0))
+    angles[degenerate] = 0
+    return angles
+
+
+def _rotate_nonzero_frames(ss, angles):
+    """Rotate every non-empty frame of every non-empty person/sample of ss (N, M, T, V, 2) in place."""
+    N, M, T = ss.shape[:3]
+    sample_mask = ss.reshape(N, -1).sum(axis=1) != 0
+    person_mask = ss.reshape(N, M, -1).sum(axis=2) != 0
+    frame_mask = ss.reshape(N, M, T, -1).sum(axis=3) != 0
+    mask = sample_mask[:, None, None] & person_mask[:, :, None] & frame_mask
+
+    matrix = _rotation_2D_batch(angles)[:, None, None, None]  # (N, 1, 1, 1, 2, 2)
+    x = ss[..., 0]
+    y = ss[..., 1]
+    rotated_x = matrix[..., 0, 0] * x + matrix[..., 0, 1] * y
+    rotated_y = matrix[..., 1, 0] * x + matrix[..., 1, 1] * y
+    mask = mask[..., None]
+    ss[..., 0] = np.where(mask, rotated_x, x)
+    ss[..., 1] = np.where(mask, rotated_y, y)
+    return ss
+
 
+def pre_normalization(data, yaxis=[8, 1], xaxis=[2, 5]):  # original: zaxis=[0, 1], xaxis=[8, 4]
+    """
+    Align a batch of body25 skeletons so the hip-neck bone is parallel to the y axis and the shoulders to the x axis.
 
-def interactive_model_shift(timestamp, additional_parameters=None, shift_time=2, switch=None):
-    # Placeholder for shift time calculation
-    if switch is not None and switch == 1:
-        shift_time = 2.4
-    elif switch is not None and switch == 0:
-        shift_time = 1.4
-    else:
-        shift_time = 2
+    Vectorized over samples, persons, frames and joints; the output matches the per-joint loop
+    implementation (``_pre_normalization_loop``), including skipping of all-zero samples, persons and frames.
+
+    :param data: Pose tensor shaped (N, C, T, V, M) with C=3 (x, y, confidence) and V=25
+    :param yaxis: Joint indices (bottom, top) aligned to the y axis
+    :param xaxis: Joint indices (right shoulder, left shoulder) aligned to the x axis
+    :return: Normalized tensor shaped (N, 2, T, 15, M)
+    """
+    N, C, T, V, M = data.shape
+    s = np.transpose(data, [0, 4, 2, 3, 1])  # N, C, T, V, M  to  N, M, T, V, C
 
-    tagged_timestamp = timestamp - shift_time * 1000
-    # TODO: Replace with actual shift calculation logic
-    return shift_time, int(tagged_timestamp)
+    # convert the ntu format to tailored body25 format: keep the first 15 joints and drop the confidence channel
+    ss = np.zeros((N, M, T, 15, 2))
+    present = s.reshape(N, -1).sum(axis=1) != 0
+    ss[present] = s[present][:, :, :, :15, :2]
 
+    # parallel the bone between hip (jpt 8) and neck (jpt 1) of the first person to the y axis
+    joint_bottom = ss[:, 0, 0, yaxis[0]]  # top and bottom are reverse
+    joint_top = ss[:, 0, 0, yaxis[1]]
+    _rotate_nonzero_frames(ss, _angle_between_batch(-joint_top + joint_bottom, [0, 1]))
 
-def effect_state_detection(previous_value, current_value, threshold):
-    if previous_value != current_value:
-        print(f"value changed from {previous_value} to {current_value}")
-    if previous_value is not None and current_value - previous_value >= threshold and (0 < current_value < 42 or current_value - previous_value >= 30):
-        print(f"previous_value: {previous_value}, current_value: {current_value}, threshold: {threshold}")
-        state = 1
-        switch = 1
-    elif previous_value is not None and previous_value - current_value >= threshold and 0 < previous_value < 28:
-        print(f"previous_value: {previous_value}, current_value: {current_value}, threshold: {threshold}")
-        state = 1
-        switch = 0
-    else:
-        state = 0
-        switch = None
+    # parallel the bone between right shoulder (jpt 2) and left shoulder (jpt 5) of the first person to the x axis
+    joint_rshoulder = ss[:, 0, 0, xaxis[0]]
+    joint_lshoulder = ss[:, 0, 0, xaxis[1]]
+    _rotate_nonzero_frames(ss, _angle_between_batch(joint_rshoulder - joint_lshoulder, [-1, 0]))
 
-    return state, switch
+    data = np.transpose(ss, [0, 4, 2, 3, 1])
+    return data
 
 
-def pre_normalization(data, yaxis=[8, 1], xaxis=[2, 5]):  # original: zaxis=[0, 1], xaxis=[8, 4]
+def _pre_normalization_loop(data, yaxis=[8, 1], xaxis=[2, 5]):
+    """Per-joint reference implementation of :func:`pre_normalization`, kept for benchmarks."""
 
     def rotation_2D(theta):
         a = math.cos(theta)
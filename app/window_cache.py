@@ -0,0 +1,227 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from . import metrics
+
+
+class _Segment:
+    """Frames over the closed interval [start, end] (epoch ms) with the source of each, as read from MongoDB."""
+    __slots__ = ("key", "start", "end", "timestamps", "poses", "sources", "created")
+
+    def __init__(self, key, start, end, timestamps, poses, sources, created):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.timestamps = timestamps
+        self.poses = poses
+        self.sources = sources
+        self.created = created
+
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + self.sources.nbytes + (0 if self.poses is None else self.poses.nbytes)
+
+
+class PoseWindowCache:
+    """
+    Bounded, two-tier cache of the pose windows read by fetch_poses.
+
+    The frame tier keeps the raw (timestamp, pose) frames read from MongoDB per (collection, source, shape),
+    as non-overlapping time segments. A window that overlaps cached segments only queries the parts that are
+    missing, and the pieces are merged into one segment. The tensor tier keeps finished, normalized windows
+    keyed by everything that determines them, so an identical request skips the query and pre_normalization.
+    Each tier is evicted least recently used first once it holds more than its byte budget, and entries
+    older than ``max_age`` seconds are dropped.
+
+    Poses of the last ``settle`` seconds may still be on their way, so nothing newer than that horizon is
+    cached: frames past it and windows ending past it are always read again, and an interval for which
+    MongoDB returned no poses is never recorded as covered.
+    """
+
+    def __init__(self, max_frame_bytes=64 * 2 ** 20, max_tensor_bytes=16 * 2 ** 20, max_age=120, settle=5):
+        self.max_frame_bytes = max_frame_bytes
+        self.max_tensor_bytes = max_tensor_bytes
+        self.max_age = max_age
+        self.settle = settle
+        self._segments = OrderedDict()  # id(segment) -> segment, least recently used first
+        self._frame_bytes = 0
+        self._tensors = OrderedDict()  # key -> (tensor, created)
+        self._tensor_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"frame_hits": 0, "frame_partial_hits": 0, "frame_misses": 0, "tensor_hits": 0,
+                      "tensor_misses": 0, "evicted_size": 0, "evicted_age": 0}
+
+    def summary(self):
+        with self._lock:
+            return {**self.stats, "frame_segments": len(self._segments), "frame_bytes": self._frame_bytes,
+                    "tensors": len(self._tensors), "tensor_bytes": self._tensor_bytes}
+
+    def clear(self):
+        with self._lock:
+            self._segments.clear()
+            self._tensors.clear()
+            self._frame_bytes = self._tensor_bytes = 0
+
+    def horizon(self):
+        """Epoch ms up to which the poses are taken to be complete."""
+        return int((time.time() - self.settle) * 1000)
+
+    def tensor(self, key):
+        """The cached normalized window of ``key``, or None."""
+        with self._lock:
+            self._expire()
+            entry = self._tensors.get(key)
+            if entry is None:
+                self.stats["tensor_misses"] += 1
+                metrics.POSE_CACHE_REQUESTS.inc(tier="tensor", result="miss")
+                return None
+            self._tensors.move_to_end(key)
+            self.stats["tensor_hits"] += 1
+        metrics.POSE_CACHE_REQUESTS.inc(tier="tensor", result="hit")
+        return entry[0]
+
+    def put_tensor(self, key, tensor, end_time):
+        """
+        Cache a normalized window ending at ``end_time``; it is made read-only since every later hit returns the
+        same array. Windows ending past the horizon are not cached.
+        """
+        if tensor.nbytes > self.max_tensor_bytes or end_time > self.horizon():
+            return
+        tensor.flags.writeable = False
+        with self._lock:
+            previous = self._tensors.pop(key, None)
+            if previous is not None:
+                self._tensor_bytes -= previous[0].nbytes
+            self._tensors[key] = (tensor, time.monotonic())
+            self._tensor_bytes += tensor.nbytes
+            while self._tensor_bytes > self.max_tensor_bytes:
+                _, (evicted, _) = self._tensors.popitem(last=False)
+                self._tensor_bytes -= evicted.nbytes
+                self.stats["evicted_size"] += 1
+            metrics.POSE_CACHE_BYTES.set(self._tensor_bytes, tier="tensor")
+
+    def frames(self, key, start, end, fetch):
+        """
+        Timestamps, stacked poses and sources of every frame of ``key`` in [start, end].
+
+        :param fetch: ``fetch(start, end)`` reads the frames of a closed interval from MongoDB and returns
+                      (int64 timestamps, poses or None, object array of sources); only called for the parts
+                      that are not cached
+        """
+        with self._lock:
+            self._expire()
+            cached = [segment for segment in self._segments.values()
+                      if segment.key == key and segment.start <= end + 1 and segment.end >= start - 1]
+            cached.sort(key=lambda segment: segment.start)
+        gaps = []
+        position = start
+        for segment in cached:
+            if segment.start > position:
+                gaps.append((position, segment.start - 1))
+            position = max(position, segment.end + 1)
+        if position <= end:
+            gaps.append((position, end))
+
+        result = "hit" if not gaps else ("partial" if cached else "miss")
+        with self._lock:
+            self.stats[{"hit": "frame_hits", "partial": "frame_partial_hits", "miss": "frame_misses"}[result]] += 1
+        metrics.POSE_CACHE_REQUESTS.inc(tier="frames", result=result)
+
+        now = time.monotonic()
+        pieces = [(segment.timestamps, segment.poses, segment.sources) for segment in cached]
+        fetched = [fetch(gap_start, gap_end) for gap_start, gap_end in gaps]
+        pieces.extend(fetched)
+        shapes = {poses.shape[1:] for _, poses, _ in pieces if poses is not None and len(poses)}
+        if len(shapes) > 1:
+            # Cached frames with another person count than the new ones: read the whole window again
+            for segment in cached:
+                self._drop(segment)
+            timestamps, poses, sources = fetch(start, end)
+            if poses is not None:
+                self._store_covered(key, [(start, end)], timestamps, poses, sources, now)
+            return timestamps, poses, sources
+
+        present = [piece for piece in pieces if piece[1] is not None and len(piece[1])]
+        timestamps = np.concatenate([piece_times for piece_times, _, _ in pieces])
+        order = np.argsort(timestamps, kind="stable")
+        timestamps = timestamps[order]
+        sources = np.concatenate([piece_sources for _, _, piece_sources in pieces])[order]
+        poses = np.concatenate([poses for _, poses, _ in present])[order] if present else None
+
+        if gaps:
+            # Intervals MongoDB returned no poses for may only be waiting for them
+            covered = [(segment.start, segment.end) for segment in cached]
+            covered += [gap for gap, (_, gap_poses, _) in zip(gaps, fetched) if gap_poses is not None]
+            self._store_covered(key, covered, timestamps, poses, sources,
+                                min([now] + [segment.created for segment in cached]))
+        else:
+            with self._lock:
+                for segment in cached:
+                    if id(segment) in self._segments:
+                        self._segments.move_to_end(id(segment))
+
+        first = int(np.searchsorted(timestamps, start, side="left"))
+        last = int(np.searchsorted(timestamps, end, side="right"))
+        return (timestamps[first:last], (None if poses is None or first == last else poses[first:last]),
+                sources[first:last])
+
+    def _store_covered(self, key, intervals, timestamps, poses, sources, created):
+        """Cache the frames of every contiguous run of ``intervals``, cut off at the horizon."""
+        horizon = self.horizon()
+        runs = []
+        for run_start, run_end in sorted(intervals):
+            run_end = min(run_end, horizon)
+            if run_end < run_start:
+                continue
+            if runs and run_start <= runs[-1][1] + 1:
+                runs[-1][1] = max(runs[-1][1], run_end)
+            else:
+                runs.append([run_start, run_end])
+        for run_start, run_end in runs:
+            first = int(np.searchsorted(timestamps, run_start, side="left"))
+            last = int(np.searchsorted(timestamps, run_end, side="right"))
+            self._store(_Segment(key, run_start, run_end, timestamps[first:last],
+                                 None if poses is None or first == last else poses[first:last],
+                                 sources[first:last], created))
+
+    def _store(self, segment):
+        """Cache ``segment`` in place of the segments it covers; skipped if another thread stored an overlapping one."""
+        if segment.nbytes > self.max_frame_bytes:
+            return
+        with self._lock:
+            overlapping = [other for other in self._segments.values()
+                           if other.key == segment.key and other.start <= segment.end and other.end >= segment.start]
+            if any(other.start < segment.start or other.end > segment.end for other in overlapping):
+                return
+            for other in overlapping:
+                del self._segments[id(other)]
+                self._frame_bytes -= other.nbytes
+            self._segments[id(segment)] = segment
+            self._frame_bytes += segment.nbytes
+            while self._frame_bytes > self.max_frame_bytes:
+                _, evicted = self._segments.popitem(last=False)
+                self._frame_bytes -= evicted.nbytes
+                self.stats["evicted_size"] += 1
+            metrics.POSE_CACHE_BYTES.set(self._frame_bytes, tier="frames")
+
+    def _drop(self, segment):
+        with self._lock:
+            if self._segments.pop(id(segment), None) is not None:
+                self._frame_bytes -= segment.nbytes
+
+    def _expire(self):
+        # Must be called with self._lock held
+        oldest = time.monotonic() - self.max_age
+        for segment_id, segment in list(self._segments.items()):
+            if segment.created < oldest:
+                del self._segments[segment_id]
+                self._frame_bytes -= segment.nbytes
+                self.stats["evicted_age"] += 1
+        for key, (tensor, created) in list(self._tensors.items()):
+            if created < oldest:
+                del self._tensors[key]
+                self._tensor_bytes -= tensor.nbytes
+                self.stats["evicted_age"] += 1
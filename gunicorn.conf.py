@@ -0,0 +1,39 @@
+# Production server: gunicorn -c gunicorn.conf.py run:app
+#
+# Flask-SocketIO runs in threading mode on a gthread worker, each WebSocket holding one worker thread, so
+# WEB_THREADS bounds the concurrent Socket.IO clients of an instance. Flask-SocketIO supports exactly one
+# gunicorn worker: gunicorn balances requests across its workers without sticky sessions, so Socket.IO
+# polling and upgrade handshakes would fail, and WEB_WORKERS > 1 is rejected. To scale, run separate
+# single-worker instances instead. The receivers run in exactly one of them, so no device stream is
+# consumed twice: the services instance
+#   START_SERVICES=true PORT=30083 gunicorn -c gunicorn.conf.py run:app
+# next to any number of web instances, started with START_SERVICES=false and
+# SERVICES_URL=http://<services host>:30083, which forward the /api/v1/trigger and /api/v1/notifications
+# routes to it. The load balancer in front of the web instances must use sticky sessions, and every
+# instance, the services one included, must share SOCKETIO_MESSAGE_QUEUE (e.g. redis://) to emit to the
+# clients of the others.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 30082)}"
+workers = int(os.environ.get('WEB_WORKERS', 1))
+if workers != 1:
+    raise RuntimeError("Flask-SocketIO supports a single gunicorn worker; scale with separate instances "
+                       "sharing SOCKETIO_MESSAGE_QUEUE, see gunicorn.conf.py")
+worker_class = "gthread"
+threads = int(os.environ.get('WEB_THREADS', 100))
+graceful_timeout = 30
+accesslog = "-"
+
+
+def post_worker_init(worker):
+    # Background threads must be created in the worker, after the fork
+    if os.environ.get('START_SERVICES', 'true').lower() == 'true':
+        from app.lifecycle import start_services
+        start_services()
+
+
+def worker_exit(server, worker):
+    # Drain receivers, deferred labels and buffered writes before the worker process ends; the margin keeps
+    # the final flush ahead of the SIGKILL that follows graceful_timeout
+    from app.lifecycle import stop_services
+    stop_services(timeout=graceful_timeout - 5)
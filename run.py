@@ -1,5 +1,20 @@
+import os
+import signal
+import sys
+
 from app import create_app
+from app.lifecycle import start_services, stop_services
 app, socketio = create_app()
 
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=30082, debug=False, allow_unsafe_werkzeug=True)
+    start_services()
+    # Let `docker stop` and kill shut down through the finally clause below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        # Development server; in production run `gunicorn -c gunicorn.conf.py run:app`
+        socketio.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 30082)), debug=False,
+                     allow_unsafe_werkzeug=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_services()
@@ -0,0 +1,79 @@
+"""End-to-end throughput of backfill.BackfillJob on a synthetic history.
+
+Seeds --days of event notifications (--events-per-day per day) with 30 fps poses around every event, then
+relabels the whole range. With --mongo-uri the job runs against that server with --workers processes;
+without it, mongomock is used in-process (its $or scans are far slower than an indexed server, so keep
+--days small). Run from the repository root:
+    PYTHONPATH=. python test/bench_backfill.py --mongo-uri mongodb://localhost:27017 --days 30 --workers 8
+"""
+import argparse
+import os
+import time
+from unittest import mock
+
+import numpy as np
+
+from app.backfill import BackfillJob
+from app.database import MongoDBHandler
+
+DEVICE = "bench-meter"
+START = 1700000000000
+DAY = 86400000
+
+
+def seed(handler, days, events_per_day, seed=0):
+    rng = np.random.default_rng(seed)
+    for name in ("notification", "results", "labeled_poses", "backfill_progress"):
+        handler.get_collection(name).drop()
+    handler.ensure_indexes()
+    events, poses = [], 0
+    for day in range(days):
+        results = []
+        for k in range(events_per_day):
+            event_time = START + day * DAY + k * (DAY // events_per_day) + int(rng.integers(0, 60000))
+            events.append({"service": DEVICE, "timestamp": event_time - 2000, "event_time": event_time,
+                           "switch": k % 2, "label_status": 1, "duration": 5})
+            for frame_time in range(event_time - 8000, event_time + 1, 33):
+                pose = rng.random((3, 25, 1), dtype=np.float32)
+                results.append({"service": "pose_detector", "timestamp": frame_time, "camera_name": "cam",
+                                "pose": handler.labeled_pose_document(frame_time, pose, 0)["pose"]})
+        handler.insert_many("results", results)
+        poses += len(results)
+    handler.insert_many("notification", events)
+    return len(events), poses
+
+
+def run(days, events_per_day, workers, mongo_uri):
+    if mongo_uri:
+        # Worker processes open their own client through app.mongodb
+        os.environ["MONGODB_URI"] = mongo_uri
+        os.environ["DATABASE_NAME"] = "bench_backfill"
+        from app import mongodb as handler
+        handler.pose_format = "float32"
+    else:
+        import mongomock
+        with mock.patch("app.database.MongoClient", mongomock.MongoClient):
+            handler = MongoDBHandler("mongodb://localhost", "bench_backfill", pose_format="float32")
+            handler.client  # the client is created lazily, on first use
+        workers = 0
+
+    start = time.perf_counter()
+    events, poses = seed(handler, days, events_per_day)
+    print(f"seeded {events} events and {poses:,} poses in {time.perf_counter() - start:.1f}s")
+
+    job = BackfillJob(DEVICE, START, START + days * DAY, version="bench")
+    start = time.perf_counter()
+    totals = job.run(handler, workers=workers)
+    elapsed = time.perf_counter() - start
+    print(f"backfilled {days} days in {elapsed:.1f}s with {workers or 'no'} worker processes: "
+          f"{totals.get('written', 0) / elapsed:.1f} windows/s, {totals}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=2)
+    parser.add_argument("--events-per-day", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--mongo-uri", default=None)
+    args = parser.parse_args()
+    run(args.days, args.events_per_day, args.workers, args.mongo_uri)
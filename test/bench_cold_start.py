@@ -0,0 +1,64 @@
+"""Cold-start time of the service: importing the app, building it, and starting/stopping its services.
+
+Every run is a fresh interpreter with MONGODB_URI pointing at a closed port and no devices configured, so
+any network access or background thread during import shows up as a failure instead of a slow run.
+Exits non-zero when the median import + create_app time exceeds --target-ms.
+Run from the repository root:  PYTHONPATH=. python test/bench_cold_start.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PROBE = r"""
+import json, threading, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app, socketio = app.create_app()
+created = time.perf_counter()
+threads_after_create = threading.active_count()
+connected_after_create = app.mongodb.is_connected()
+from app.lifecycle import start_services, stop_services
+start_services()
+started = time.perf_counter()
+stop_services(timeout=1)
+stopped = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "create_ms": (created - imported) * 1000,
+                  "start_ms": (started - created) * 1000, "stop_ms": (stopped - started) * 1000,
+                  "threads_after_create": threads_after_create, "connected_after_create": connected_after_create}))
+"""
+
+
+def run(runs, target_ms):
+    devices = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump([], devices)
+    devices.close()
+    env = {**os.environ, "DEVICES_CONFIG": devices.name, "POSE_BUFFER_CAPACITY": "0",
+           "MONGODB_URI": "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=200&connectTimeoutMS=200"}
+    env.setdefault("DATABASE_NAME", "calit2")
+
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", PROBE], env=env, capture_output=True, text=True, check=True)
+        samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    for key in ("import_ms", "create_ms", "start_ms", "stop_ms"):
+        values = [sample[key] for sample in samples]
+        print(f"{key:>10}: median {statistics.median(values):7.1f}  min {min(values):7.1f}  max {max(values):7.1f}")
+    cold_start = statistics.median(sample["import_ms"] + sample["create_ms"] for sample in samples)
+    leaked = [sample for sample in samples if sample["threads_after_create"] > 1 or sample["connected_after_create"]]
+    print(f"import + create_app: median {cold_start:.1f}ms (target {target_ms}ms), "
+          f"{len(leaked)} runs started threads or connected to MongoDB before start_services")
+    return cold_start <= target_ms and not leaked
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--target-ms", type=float, default=1000)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.runs, args.target_ms) else 1)
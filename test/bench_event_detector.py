@@ -0,0 +1,97 @@
+"""Throughput of event_detector.EventDetector against the former per-sample detection.
+
+Feeds a synthetic current trace (noise plus on/off steps) in micro-batches and checks that, without
+debouncing, the detector fires exactly the events the per-sample comparison fires. Batches are lists like
+those of process_data_points; sizes 1-10 are what one network read of a live stream typically holds.
+Run from the repository root:  PYTHONPATH=. python test/bench_event_detector.py --batch-sizes 1,10,65536
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.event_detector import EventDetector
+
+
+def detect_per_sample(previous_value, current_value, threshold):
+    """The former utils.effect_state_detection, without its logging."""
+    if previous_value is not None and current_value - previous_value >= threshold and (
+            0 < current_value < 42 or current_value - previous_value >= 30):
+        return 1, 1
+    elif previous_value is not None and previous_value - current_value >= threshold and 0 < previous_value < 28:
+        return 1, 0
+    return 0, None
+
+
+def synthetic_trace(samples, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(1.0, 0.3, samples).clip(0)
+    # A device drawing ~20 A switches on and off at random points
+    edges = np.sort(rng.choice(samples, size=max(samples // 500, 2), replace=False))
+    on = np.zeros(samples, dtype=bool)
+    for start, stop in zip(edges[::2], edges[1::2]):
+        on[start:stop] = True
+    values[on] += 20
+    timestamps = 1700000000000 + np.arange(samples, dtype=np.int64) * 10
+    return values, timestamps
+
+
+def run(samples, batch_size, values, timestamps, threshold):
+    """Events found feeding the trace in batches of ``batch_size``, without and with debouncing."""
+    value_list, timestamp_list = values.tolist(), timestamps.tolist()
+    batches = [(offset, value_list[offset:offset + batch_size], timestamp_list[offset:offset + batch_size])
+               for offset in range(0, samples, batch_size)]
+
+    detector = EventDetector(threshold)
+    start = time.perf_counter()
+    found = []
+    for offset, batch_values, batch_timestamps in batches:
+        indices, switches = detector.detect(batch_values, batch_timestamps)
+        if indices.size:
+            found.append(np.stack([indices + offset, switches]))
+    elapsed = time.perf_counter() - start
+    events = np.concatenate(found, axis=1) if found else np.empty((2, 0), dtype=np.int64)
+    print(f"batch {batch_size:>6}: {samples / elapsed / 1e6:6.2f}M samples/s, {events.shape[1]} events")
+
+    debounced = EventDetector(threshold, debounce_time=1)
+    start = time.perf_counter()
+    count = 0
+    for _, batch_values, batch_timestamps in batches:
+        count += debounced.detect(batch_values, batch_timestamps)[0].size
+    elapsed = time.perf_counter() - start
+    print(f"   debounced: {samples / elapsed / 1e6:6.2f}M samples/s, {count} events, "
+          f"{debounced.stats['debounced']} suppressed")
+    return events
+
+
+def reference_events(values, threshold, check):
+    """Events of the first ``check`` samples from the former per-sample comparison."""
+    start = time.perf_counter()
+    previous = None
+    reference = []
+    for i, value in enumerate(values[:check].tolist()):
+        state, switch = detect_per_sample(previous, value, threshold)
+        if state:
+            reference.append((i, switch))
+        previous = value
+    elapsed = time.perf_counter() - start
+    print(f"per-sample:   {check / elapsed / 1e6:6.2f}M samples/s, {len(reference)} events")
+    return reference
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=2000000)
+    parser.add_argument("--batch-sizes", default="1,2,5,10,100,65536",
+                        help="comma-separated micro-batch sizes, one run each")
+    parser.add_argument("--threshold", type=float, default=15)
+    parser.add_argument("--check", type=int, default=1000000, help="samples compared with the per-sample loop")
+    args = parser.parse_args()
+    trace_values, trace_timestamps = synthetic_trace(args.samples)
+    check = min(args.check, args.samples)
+    reference = reference_events(trace_values, args.threshold, check) if check else None
+    for size in [int(size) for size in args.batch_sizes.split(",")]:
+        batch_events = run(args.samples, size, trace_values, trace_timestamps, args.threshold)
+        if reference is not None:
+            batched = [(i, switch) for i, switch in batch_events.T.tolist() if i < check]
+            print(f"   {'identical' if batched == reference else 'DIFFERENT'} events on the first {check:,} samples")
@@ -0,0 +1,101 @@
+"""Sustained throughput of database.KafkaMongoConsumer against an in-process fake Kafka consumer.
+
+Uses mongomock by default, or a real server with --mongo-uri (e.g. a local mongod).
+Run from the repository root:  PYTHONPATH=. python test/bench_kafka_consumer.py --messages 200000
+"""
+import argparse
+import json
+import time
+from unittest import mock
+
+from app.database import KafkaMongoConsumer, MongoDBHandler
+
+
+class FakeMessage:
+    def __init__(self, topic, partition, offset, value):
+        self._topic, self._partition, self._offset, self._value = topic, partition, offset, value
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def value(self):
+        return self._value
+
+
+class FakeConsumer:
+    """Serves pre-generated messages round-robin over partitions and records committed offsets."""
+
+    def __init__(self, topic, total, partitions=4):
+        self.topic = topic
+        self.total = total
+        self.partitions = partitions
+        self.produced = 0
+        self.committed = {}
+        self.closed = False
+
+    def subscribe(self, topics):
+        pass
+
+    def consume(self, num_messages=1, timeout=-1):
+        messages = []
+        while self.produced < self.total and len(messages) < num_messages:
+            i = self.produced
+            value = json.dumps({"service": "pose_detector", "timestamp": 1700000000000 + i, "seq": i}).encode()
+            messages.append(FakeMessage(self.topic, i % self.partitions, i // self.partitions, value))
+            self.produced += 1
+        if not messages:
+            time.sleep(min(timeout, 0.01))
+        return messages
+
+    def commit(self, offsets=None, asynchronous=True):
+        for partition in offsets:
+            self.committed[partition.partition] = partition.offset
+
+    def assignment(self):
+        return []
+
+    def close(self):
+        self.closed = True
+
+
+def run(total, batch_size, mongo_uri=None):
+    if mongo_uri:
+        handler = MongoDBHandler(mongo_uri, "bench_kafka_consumer")
+    else:
+        import mongomock
+        with mock.patch("app.database.MongoClient", mongomock.MongoClient):
+            handler = MongoDBHandler("mongodb://localhost", "bench_kafka_consumer")
+            handler.client  # the client is created lazily, on first use
+    handler.get_collection("ingest").drop()
+
+    fake = FakeConsumer("poses", total)
+    consumer = KafkaMongoConsumer(handler, {}, "poses", "ingest", batch_size=batch_size, consumer=fake)
+    start = time.perf_counter()
+    consumer.start()
+    while sum(fake.committed.values()) < total:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    consumer.stop()
+
+    stored = handler.get_collection("ingest").count_documents({})
+    metrics = consumer.metrics()
+    print(f"{total} messages in {elapsed:.2f}s: {total / elapsed:,.0f} msg/s, "
+          f"avg batch {metrics['avg_batch_size']}, stored {stored}, committed {fake.committed}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--mongo-uri", default=None)
+    args = parser.parse_args()
+    run(args.messages, args.batch_size, args.mongo_uri)
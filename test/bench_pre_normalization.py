@@ -0,0 +1,43 @@
+"""Benchmark the vectorized utils.pre_normalization against the per-joint loop implementation.
+
+Run from the repository root:  PYTHONPATH=. python test/bench_pre_normalization.py
+"""
+import time
+
+import numpy as np
+
+from app.utils import pre_normalization, _pre_normalization_loop
+
+
+def make_batch(n, t=30, v=25, m=1, seed=0):
+    """Random (N, 3, T, V, M) pose batch with a few empty frames and samples, like real detector output."""
+    rng = np.random.default_rng(seed)
+    data = rng.uniform(0, 1920, size=(n, 3, t, v, m))
+    data[:, 2] = rng.uniform(0, 1, size=(n, t, v, m))
+    data[::7, :, ::5] = 0  # missing frames
+    data[5::11] = 0  # missing samples
+    return data
+
+
+def best_of(func, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(sizes=(1, 10, 100, 500), t=30, repeat=3):
+    print(f"{'N':>6} {'loop (ms)':>12} {'vectorized (ms)':>16} {'speedup':>9} {'identical':>10}")
+    for n in sizes:
+        data = make_batch(n, t=t)
+        identical = np.array_equal(pre_normalization(data), _pre_normalization_loop(data))
+        loop_time = best_of(_pre_normalization_loop, data, repeat)
+        vectorized_time = best_of(pre_normalization, data, repeat)
+        print(f"{n:>6} {loop_time * 1000:>12.2f} {vectorized_time * 1000:>16.2f} "
+              f"{loop_time / vectorized_time:>8.1f}x {str(identical):>10}")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,65 @@
+"""Check utils.parse_meter_timestamp against strptime and benchmark both.
+
+Run from the repository root:  PYTHONPATH=. python test/bench_timestamp_parsing.py
+"""
+import random
+import time
+
+from app.utils import parse_meter_timestamp, parse_meter_timestamp_strptime
+
+MALFORMED = [
+    "11/26/2023 20:17:42",
+    "11/26/2023 24:17:42.014660",
+    "11/26/2023 20:60:42.014660",
+    "11/26/2023 20:17:42.",
+    "11/26/2023 20:17:42.0146601",
+    "13/26/2023 20:17:42.014660",
+    "02/30/2023 20:17:42.014660",
+    "2023-11-26 20:17:42.014660",
+    "11/26/2023  20:17:42.014660",
+    "",
+]
+
+
+def make_samples(count, seed=0):
+    """Realistic stream: consecutive days, a few thousand samples per second, some short field widths."""
+    rng = random.Random(seed)
+    samples = []
+    for i in range(count):
+        month, day, year = rng.randint(1, 12), rng.randint(1, 28), rng.choice([1999, 2023, 2024, 2038])
+        hour, minute, second = rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59)
+        fraction = str(rng.randint(0, 999999)).zfill(6)[:rng.choice([6, 6, 6, 3, 1])]
+        if i % 10:
+            samples.append(f"{month:02d}/{day:02d}/{year} {hour:02d}:{minute:02d}:{second:02d}.{fraction}")
+        else:
+            samples.append(f"{month}/{day}/{year} {hour}:{minute}:{second}.{fraction}")
+    return samples
+
+
+def outcome(parser, time_string):
+    try:
+        return parser(time_string)
+    except Exception as e:
+        return type(e)
+
+
+def check(samples):
+    mismatches = [s for s in samples + MALFORMED
+                  if outcome(parse_meter_timestamp, s) != outcome(parse_meter_timestamp_strptime, s)]
+    print(f"checked {len(samples) + len(MALFORMED)} strings, mismatches: {mismatches}")
+    return not mismatches
+
+
+def bench(parser, samples):
+    start = time.perf_counter()
+    for time_string in samples:
+        parser(time_string)
+    return len(samples) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    check(make_samples(200000))
+    # A live stream stays on one date for hours, which is the case the date cache is built for
+    stream = [f"11/26/2023 20:{i // 60000 % 60:02d}:{i // 1000 % 60:02d}.{i % 1000 * 1000:06d}" for i in range(200000)]
+    fast, slow = bench(parse_meter_timestamp, stream), bench(parse_meter_timestamp_strptime, stream)
+    print(f"strptime: {slow:,.0f} samples/s, fast parser: {fast:,.0f} samples/s ({fast / slow:.1f}x)")
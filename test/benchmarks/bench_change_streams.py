@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from app.change_streams import ChangeStreamHub  # noqa: E402
+
+from conftest import CAMERAS, START  # noqa: E402
+
+
+class CountingSocketIO:
+    """Socket.IO stand-in that counts emits instead of sending them."""
+
+    def __init__(self):
+        self.emits = 0
+
+    def emit(self, event, data, to=None):
+        self.emits += 1
+
+
+@pytest.mark.parametrize("documents", [100, 3000])
+def test_change_stream_fan_out(benchmark, documents):
+    # One flush interval of pose detector output: dispatch to rooms, then emit the batches
+    socketio = CountingSocketIO()
+    hub = ChangeStreamHub(mongo_db=None, socketio=socketio)
+    watch = hub.watch("results", fields=["timestamp", "service", "camera_name"],
+                      room_fields={"camera": "camera_name"})
+    changes = [{"timestamp": START + i * 33, "service": "pose_detector", "camera_name": CAMERAS[i % len(CAMERAS)]}
+               for i in range(documents)]
+
+    def fan_out():
+        for document in changes:
+            hub._dispatch(watch, document)
+        hub._flush()
+
+    benchmark.extra_info["documents"] = documents
+    benchmark(fan_out)
+    assert socketio.emits > 0
@@ -0,0 +1,57 @@
+import itertools
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from conftest import CAMERAS, HISTORY_SECONDS, START  # noqa: E402
+
+# Label time in the middle of the seeded history
+LABEL_TIME = START + HISTORY_SECONDS * 1000 // 2
+
+
+@pytest.mark.parametrize("sampling", ["resample", "ids", "all"])
+def test_fetch_poses(benchmark, mongo_handler, sampling):
+    poses = benchmark(mongo_handler.fetch_poses, timestamp=LABEL_TIME, past_time=3, sampling=sampling,
+                      source=CAMERAS[0])
+    assert poses.shape == (1, 2, 30, 15, 1)
+
+
+def test_fetch_poses_latest(benchmark, mongo_handler):
+    poses = benchmark(mongo_handler.fetch_poses, timestamp=LABEL_TIME)
+    assert poses.shape == (1, 2, 30, 15, 1)
+
+
+def test_fetch_poses_from_buffer(benchmark, mongo_handler):
+    buffer = mongo_handler.enable_pose_buffer(capacity=HISTORY_SECONDS * 30, watch=False)
+    try:
+        for document in mongo_handler.get_collection("results").find({}).sort("timestamp", 1):
+            buffer.add(document)
+        poses = benchmark(mongo_handler.fetch_poses, timestamp=LABEL_TIME, past_time=3, source=CAMERAS[0])
+        assert poses.shape == (1, 2, 30, 15, 1)
+    finally:
+        mongo_handler.pose_buffer = None
+
+
+@pytest.mark.parametrize("buffered", [False, True])
+def test_store_labeled_pose(benchmark, mongo_handler, buffered):
+    window = np.random.default_rng(0).uniform(-1, 1, size=(1, 2, 30, 15, 1))
+    benchmark(mongo_handler.store_labeled_pose, timestamp=LABEL_TIME, poses=window, label=1, past_time=3,
+              version="benchmark", buffered=buffered)
+    mongo_handler.flush()
+
+
+@pytest.mark.parametrize("overlap", ["identical", "sliding"])
+def test_fetch_poses_cached(benchmark, mongo_handler, overlap):
+    # Identical windows hit the tensor tier; a window sliding by 10 ms only queries its newest frames
+    cache = mongo_handler.enable_window_cache()
+    step = 10 if overlap == "sliding" else 0
+    offsets = itertools.cycle(range(0, HISTORY_SECONDS * 1000 // 4, step) if step else [0])
+    try:
+        poses = benchmark(lambda: mongo_handler.fetch_poses(timestamp=LABEL_TIME + next(offsets), past_time=3,
+                                                            source=CAMERAS[0]))
+        assert poses.shape == (1, 2, 30, 15, 1)
+        benchmark.extra_info.update(cache.summary())
+    finally:
+        mongo_handler.window_cache = None
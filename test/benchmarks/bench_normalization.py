@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from app.utils import pre_normalization  # noqa: E402
+
+
+@pytest.mark.parametrize("t", [30, 60])
+@pytest.mark.parametrize("n", [1, 32, 256])
+def test_pre_normalization(benchmark, pose_batch, n, t):
+    data = pose_batch(n, t=t)
+    benchmark.extra_info["windows"] = n
+    result = benchmark(pre_normalization, data)
+    assert result.shape == (n, 2, t, 15, 1)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from app.event_detector import EventDetector  # noqa: E402
+from app.sse import SSEDecoder  # noqa: E402
+
+
+def meter_values(count, seed=0):
+    """Readings of a meter switching on and off every 200 samples, with noise."""
+    rng = np.random.default_rng(seed)
+    on = (np.arange(count) // 200) % 2 == 1
+    return np.where(on, 20.0, 0.5) + rng.normal(0, 0.2, count)
+
+
+def meter_time(index):
+    """Meter time string of the ``index``-th sample at 10 samples per second."""
+    seconds, milliseconds = divmod(index * 100, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    return f"11/26/2023 20:{minutes % 60:02d}:{seconds:02d}.{milliseconds:03d}000"
+
+
+def meter_line(index, value):
+    return f"data: {{'time': '{meter_time(index)}', 'values': {{'Current': {value:.3f}}}}}".encode()
+
+
+def test_process_data_point(benchmark, receiver):
+    data_point = {"time": "11/26/2023 20:17:42.014660", "values": {"Current": 0.5}}
+    benchmark(receiver.process_data_point, data_point)
+
+
+@pytest.mark.parametrize("batch", [10, 1000])
+def test_process_data_points(benchmark, receiver, batch):
+    data_points = [{"time": meter_time(i), "values": {"Current": float(value)}}
+                   for i, value in enumerate(meter_values(batch))]
+    benchmark.extra_info["samples"] = batch
+    benchmark(receiver.process_data_points, data_points)
+
+
+@pytest.mark.parametrize("batch", [1, 10, 1000, 65536])
+def test_event_detector(benchmark, batch):
+    detector = EventDetector(15)
+    values = meter_values(batch)
+    benchmark.extra_info["samples"] = batch
+    benchmark(detector.detect, values)
+
+
+def test_handle_stream_line(benchmark, receiver):
+    # One line of start_monitoring: strip the SSE prefix, parse the JSON and run the detector
+    line = meter_line(0, 0.5)
+    benchmark(receiver.handle_stream_line, line)
+
+
+def test_sse_decoder(benchmark):
+    chunk = b"".join(meter_line(i, value) + b"\n\n" for i, value in enumerate(meter_values(100)))
+    decoder = SSEDecoder()
+    benchmark.extra_info["events"] = 100
+    events = benchmark(decoder.feed, chunk)
+    assert len(events) == 100
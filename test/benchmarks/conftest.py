@@ -0,0 +1,93 @@
+"""Shared fixtures of the pytest-benchmark suite for the pose-tagging hot paths.
+
+Needs pytest-benchmark (pip install pytest-benchmark); the modules are skipped without it. MongoDB is
+replaced by mongomock, so absolute numbers for the database benchmarks say more about mongomock than about
+a server; compare them only against a baseline from the same setup. Run from the repository root:
+    python -m pytest test/benchmarks --benchmark-save=baseline      # store a baseline
+    python -m pytest test/benchmarks --benchmark-compare            # compare with the latest one
+The comparison fails when a mean is slower than the baseline by more than benchmark_tolerance (pytest.ini).
+"""
+import os
+from unittest import mock
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("DATABASE_NAME", "calit2")
+
+START = 1700000000000
+POSE_FPS = 30
+CAMERAS = ("pi-cam-3", "pi-cam-6")
+HISTORY_SECONDS = 300
+
+
+def pytest_addoption(parser):
+    parser.addini("benchmark_tolerance", "Slowdown of the mean against the compared baseline that fails the run",
+                  default="25%")
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    # --benchmark-compare-fail cannot go into addopts, the plugin rejects it without --benchmark-compare
+    if getattr(config.option, "benchmark_compare", None) and not config.option.benchmark_compare_fail:
+        from pytest_benchmark.utils import parse_compare_fail
+        config.option.benchmark_compare_fail = [parse_compare_fail(f"mean:{config.getini('benchmark_tolerance')}")]
+
+
+def make_pose_batch(n, t=30, v=25, m=1, seed=0):
+    """Random (N, 3, T, V, M) pose batch with a few empty frames and samples, like real detector output."""
+    rng = np.random.default_rng(seed)
+    data = rng.uniform(0, 1920, size=(n, 3, t, v, m))
+    data[:, 2] = rng.uniform(0, 1, size=(n, t, v, m))
+    data[::7, :, ::5] = 0  # missing frames
+    data[5::11] = 0  # missing samples
+    return data
+
+
+def pose_documents(seconds=HISTORY_SECONDS, cameras=CAMERAS, seed=0):
+    """Pose detector output of every camera at 30 fps, as stored in ``results``."""
+    rng = np.random.default_rng(seed)
+    documents = []
+    for frame in range(seconds * POSE_FPS):
+        for camera in cameras:
+            documents.append({"service": "pose_detector", "camera_name": camera,
+                              "timestamp": START + frame * 1000 // POSE_FPS,
+                              "pose": rng.uniform(0, 1920, size=(3, 25, 1)).round(2).tolist()})
+    return documents
+
+
+@pytest.fixture(scope="session")
+def pose_batch():
+    return make_pose_batch
+
+
+@pytest.fixture(scope="session")
+def mongo_handler():
+    """MongoDBHandler on mongomock holding HISTORY_SECONDS of poses from two cameras."""
+    import mongomock
+    from app.database import MongoDBHandler
+
+    with mock.patch("app.database.MongoClient", mongomock.MongoClient):
+        handler = MongoDBHandler("mongodb://localhost", "benchmarks")
+        handler.client  # the client is created lazily, on first use
+    handler.insert_many("results", pose_documents())
+    yield handler
+    handler.close()
+
+
+class ImmediateScheduler:
+    """TaskScheduler stand-in that accepts every task without running it, so only detection is measured."""
+
+    def submit(self, func, *args, **kwargs):
+        return True
+
+    def call_later(self, delay, func, *args, **kwargs):
+        return None
+
+
+@pytest.fixture
+def receiver():
+    from app.save_trigger import PowerMeterReceiver
+
+    return PowerMeterReceiver("http://meter", "bench-meter", threshold=15, camera_base_url="http://segmenter",
+                              camera_name_list=list(CAMERAS), value_key="Current", scheduler=ImmediateScheduler())
@@ -0,0 +1,119 @@
+"""Load test of the notification service: concurrent Socket.IO clients plus REST request throughput.
+
+Starts the service in the chosen mode on a free port with no devices configured, connects --clients
+Socket.IO clients that each subscribe to a room and stay connected, then fires --requests REST calls from
+--concurrency threads while those clients are attached. Needs MongoDB reachable through MONGODB_URI only
+for the watchers; the measured routes do not touch it.
+Run from the repository root:
+    PYTHONPATH=. python test/load_test_server.py --mode werkzeug
+    PYTHONPATH=. python test/load_test_server.py --mode gunicorn
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import socketio
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, threads):
+    devices = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump([], devices)
+    devices.close()
+    env = {**os.environ, "PORT": str(port), "DEVICES_CONFIG": devices.name, "WEB_THREADS": str(threads)}
+    env.setdefault("DATABASE_NAME", "calit2")
+    if mode == "werkzeug":
+        command = [sys.executable, "run.py"]
+    else:
+        command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--access-logfile", os.devnull,
+                   "run:app"]
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(200):
+        try:
+            requests.get(f"{url}/api/v1/trigger/devices", timeout=1)
+            return server, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return f"p50 {pick(0.5):.1f}ms p95 {pick(0.95):.1f}ms p99 {pick(0.99):.1f}ms"
+
+
+def connect_client(url, transport):
+    client = socketio.Client(reconnection=False)
+    start = time.perf_counter()
+    client.connect(url, transports=[transport], wait_timeout=10)
+    client.call("subscribe", {"collection": "notification", "device": "power-meter-14"}, timeout=10)
+    return client, time.perf_counter() - start
+
+
+def timed_get(session, url):
+    start = time.perf_counter()
+    try:
+        ok = session.get(url, timeout=10).status_code == 200
+    except requests.RequestException:
+        ok = False
+    return ok, time.perf_counter() - start
+
+
+def run(mode, clients, requests_count, concurrency, transport, threads):
+    port = free_port()
+    server, url = start_server(mode, port, threads)
+    connected = []
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(clients, 64)) as pool:
+            results = list(pool.map(lambda _: connect_client(url, transport), range(clients)))
+        connected = [client for client, _ in results]
+        elapsed = time.perf_counter() - start
+        print(f"[{mode}] {clients} Socket.IO clients ({transport}) connected and subscribed in {elapsed:.2f}s, "
+              f"{percentiles([latency for _, latency in results])}")
+
+        sessions = [requests.Session() for _ in range(concurrency)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda i: timed_get(sessions[i % concurrency], f"{url}/api/v1/trigger/devices"),
+                                    range(requests_count)))
+        elapsed = time.perf_counter() - start
+        failed = sum(1 for ok, _ in results if not ok)
+        print(f"[{mode}] {requests_count} REST requests, {concurrency} concurrent, {clients} clients attached: "
+              f"{requests_count / elapsed:,.0f} req/s, {percentiles([latency for _, latency in results])}, "
+              f"{failed} failed")
+    finally:
+        for client in connected:
+            client.disconnect()
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["werkzeug", "gunicorn"], default="gunicorn")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--transport", choices=["websocket", "polling"], default="websocket")
+    parser.add_argument("--threads", type=int, default=200, help="gunicorn worker threads")
+    args = parser.parse_args()
+    run(args.mode, args.clients, args.requests, args.concurrency, args.transport, args.threads)
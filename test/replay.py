@@ -0,0 +1,326 @@
+"""Record power meter streams and replay them through the receivers against local stand-ins.
+
+record      saves the raw SSE lines of a live meter stream with their arrival offsets (JSON lines).
+synthesize  writes a recording of a meter switching on and off, for when no live stream is reachable.
+replay      serves a recording from a local SSE server at --speed times real time (0 = as fast as
+            possible) to a ReceiverManager whose camera base URL points at a local fake stream segmenter.
+            Poses are seeded beforehand as a 30 fps synthetic stream into mongomock, or into --mongo-uri.
+            Every detected event is also labeled through insert_label, and the run reports latency
+            percentiles for sample-to-detection, detection-to-clip-request and detection-to-labeled-pose.
+
+Sample times are moved onto the replay's own time base, so the detector, the shift and the label windows
+see the recorded spacing at any speed. Run from the repository root:
+    PYTHONPATH=. python test/replay.py record "http://128.195.151.182:9001/api/data/kafka_stream/power-meter-14?frequency=0" meter.jsonl --duration 600
+    PYTHONPATH=. python test/replay.py synthesize meter.jsonl --duration 300
+    PYTHONPATH=. python test/replay.py replay meter.jsonl --speed 10
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from unittest import mock
+
+import numpy as np
+import requests
+from aiohttp import web
+
+from app.database import MongoDBHandler
+from app.receiver_manager import ReceiverManager
+from app.sse import parse_json_payload
+from app.utils import parse_meter_timestamp
+
+DEVICE = "replay-meter"
+CAMERA = "replay-cam"
+POSE_FPS = 30
+
+
+def record(url, path, duration):
+    started = time.monotonic()
+    count = 0
+    with requests.get(url, stream=True, timeout=(5, 30)) as response, open(path, "w") as output:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            offset = time.monotonic() - started
+            output.write(json.dumps({"offset": round(offset, 4), "line": line.decode("utf-8", "replace")}) + "\n")
+            count += 1
+            if offset >= duration:
+                break
+    print(f"recorded {count} lines in {time.monotonic() - started:.0f}s to {path}")
+
+
+def meter_time(timestamp):
+    return datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc).strftime("%m/%d/%Y %H:%M:%S.%f")
+
+
+def synthesize(path, duration, rate=10, period=20, on_time=6, seed=0):
+    """A meter sampled ``rate`` times per second, switched on for ``on_time`` s every ``period`` s."""
+    rng = np.random.default_rng(seed)
+    events = 0
+    was_on = False
+    with open(path, "w") as output:
+        for sample in range(int(duration * rate)):
+            offset = sample / rate
+            on = (offset % period) >= period - on_time
+            events += on != was_on
+            was_on = on
+            value = (20.0 if on else 0.5) + float(rng.normal(0, 0.2))
+            payload = {"time": meter_time(offset * 1000), "values": {"Current": round(value, 3)}}
+            # The meter sends single-quoted JSON
+            for line in (f"data: {payload}".replace('"', "'"), ""):
+                output.write(json.dumps({"offset": offset, "line": line}) + "\n")
+    print(f"wrote {int(duration * rate)} samples with {events} switch events to {path}")
+
+
+def load_recording(path):
+    """(offset seconds, line bytes, offset of the sample in ms or None) of every recorded line."""
+    lines = []
+    first_sample = None
+    with open(path) as recording:
+        for entry in map(json.loads, recording):
+            line = entry["line"].encode()
+            sample_time = None
+            if line.startswith(b"data: "):
+                sample_time = parse_meter_timestamp(parse_json_payload(line[6:])["time"])
+                first_sample = sample_time if first_sample is None else first_sample
+            lines.append((entry["offset"], line, sample_time))
+    return [(offset, line, None if sample_time is None else sample_time - first_sample)
+            for offset, line, sample_time in lines]
+
+
+class ReplayServer:
+    """Local stand-ins for the meter SSE stream and the stream segmenter, served from one event loop."""
+
+    def __init__(self, recording, speed, base_time):
+        self.recording = recording
+        self.speed = speed
+        self.base_time = base_time  # epoch ms the first sample is moved to
+        self.sent = {}  # sample timestamp -> perf_counter when it was written
+        self.clip_requests = []  # (perf_counter, path, payload)
+        self.finished = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.port = None
+        self.closing = False
+
+    def start(self):
+        threading.Thread(target=self.loop.run_forever, name="replay-server", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get("/api/data/kafka_stream/{device}", self.stream)
+        app.router.add_post("/segmenter/save_past", self.segmenter)
+        app.router.add_post("/segmenter/save_next", self.segmenter)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        self.closing = True
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _stop(self):
+        await self.runner.cleanup()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def rewrite(self, line, sample_time):
+        payload = parse_json_payload(line[6:])
+        timestamp = self.base_time + sample_time
+        payload["time"] = meter_time(timestamp)
+        return b"data: " + json.dumps(payload).encode(), parse_meter_timestamp(payload["time"])
+
+    async def stream(self, request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        # A reconnecting receiver asks to resume after the last sample it saw
+        resume_after = int(request.query.get("start_time", 0))
+        started = time.perf_counter()
+        first_offset = None
+        chunk, chunk_times = [], []
+        for offset, line, sample_time in self.recording:
+            timestamp = None
+            if sample_time is not None:
+                line, timestamp = self.rewrite(line, sample_time)
+                if timestamp <= resume_after:
+                    continue
+            first_offset = offset if first_offset is None else first_offset
+            delay = (offset - first_offset) / self.speed - (time.perf_counter() - started) if self.speed else 0
+            if delay > 0 or len(chunk) >= 256:
+                await self._write(response, chunk, chunk_times)
+                chunk, chunk_times = [], []
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            chunk.append(line)
+            if timestamp is not None:
+                chunk_times.append(timestamp)
+        await self._write(response, chunk, chunk_times)
+        self.finished.set()
+        # Like the live meter, the stream stays open; the replay ends when the server is stopped
+        while not self.closing:
+            await asyncio.sleep(0.1)
+        return response
+
+    async def _write(self, response, lines, timestamps):
+        if not lines:
+            return
+        await response.write(b"\n".join(lines) + b"\n")
+        now = time.perf_counter()
+        for timestamp in timestamps:
+            self.sent.setdefault(timestamp, now)
+
+    async def segmenter(self, request):
+        self.clip_requests.append((time.perf_counter(), request.path, await request.json()))
+        return web.json_response({"status": "Operation completed"})
+
+
+class RecordingHandler(MongoDBHandler):
+    """MongoDBHandler noting when each labeled pose window reaches the database."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.labeled = {}  # label timestamp -> perf_counter of the write
+
+    def insert_many(self, collection_name, documents, ordered=False):
+        result = super().insert_many(collection_name, documents, ordered=ordered)
+        if collection_name == "labeled_poses":
+            now = time.perf_counter()
+            for document in documents:
+                self.labeled.setdefault(document["timestamp"], now)
+        return result
+
+    def insert(self, collection_name, data):
+        result = super().insert(collection_name, data)
+        if collection_name == "labeled_poses":
+            self.labeled.setdefault(data["timestamp"], time.perf_counter())
+        return result
+
+
+def open_handler(mongo_uri):
+    if mongo_uri:
+        handler = RecordingHandler(mongo_uri, "replay_bench")
+    else:
+        import mongomock
+        with mock.patch("app.database.MongoClient", mongomock.MongoClient):
+            handler = RecordingHandler("mongodb://localhost", "replay_bench")
+            handler.client  # the client is created lazily, on first use
+    for name in ("results", "notification", "labeled_poses"):
+        handler.get_collection(name).drop()
+    return handler
+
+
+def seed_poses(handler, start, end, seed=0):
+    """A synthetic 30 fps pose stream of one camera covering [start, end] (epoch ms)."""
+    rng = np.random.default_rng(seed)
+    step = 1000 / POSE_FPS
+    documents = []
+    for frame in range(int((end - start) / step) + 1):
+        documents.append({"service": "pose_detector", "camera_name": CAMERA, "timestamp": int(start + frame * step),
+                          "pose": rng.random((3, 25, 1)).round(4).tolist()})
+        if len(documents) == 5000:
+            handler.insert_many("results", documents)
+            documents = []
+    if documents:
+        handler.insert_many("results", documents)
+    handler.ensure_indexes(["results"])
+
+
+def percentiles(name, samples):
+    if not samples:
+        return f"{name:<28} no samples"
+    values = np.asarray(samples) * 1000
+    return (f"{name:<28} n {len(values):>5}  p50 {np.percentile(values, 50):8.1f}ms  "
+            f"p95 {np.percentile(values, 95):8.1f}ms  p99 {np.percentile(values, 99):8.1f}ms  "
+            f"max {values.max():8.1f}ms")
+
+
+def replay(path, speed, mongo_uri, threshold, save_time, drain):
+    recording = load_recording(path)
+    span = max((sample_time for _, _, sample_time in recording if sample_time is not None), default=0)
+    base_time = int(time.time() * 1000)
+    handler = open_handler(mongo_uri)
+    started = time.perf_counter()
+    # Shifts are at most a few seconds, so the window before the first sample covers every label
+    seed_poses(handler, base_time - (save_time + 10) * 1000, base_time + span + 1000)
+    print(f"seeded {handler.get_collection('results').count_documents({}):,} poses "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    server = ReplayServer(recording, speed, base_time)
+    url = server.start()
+    manager = ReceiverManager(mongo_db=handler, base_url=f"{url}/api/data", camera_base_url=f"{url}/segmenter")
+    receiver = manager.add(DEVICE, start=False, threshold=threshold, save_time=save_time,
+                           camera_name_list=[CAMERA])
+
+    detections = {}  # sample timestamp -> perf_counter of the detection
+    label_times = {}  # shifted (label) timestamp -> perf_counter of the detection
+    handle_event = receiver.handle_event
+
+    def instrumented_handle_event(timestamp, switch):
+        detected = time.perf_counter()
+        detections[timestamp] = detected
+        shifted = int(timestamp - receiver.shift_table.shift(DEVICE, switch) * 1000)
+        label_times[shifted] = detected
+        handle_event(timestamp, switch)
+        # The event path itself stores no label; label like the manual and auto-labeling paths do
+        receiver.insert_label(label=1, timestamp=shifted)
+
+    receiver.handle_event = instrumented_handle_event
+    started = time.perf_counter()
+    receiver.start()
+    server.finished.wait()
+    streamed = time.perf_counter() - started
+    time.sleep(drain)
+    manager.shutdown(timeout=30)
+    handler.flush()
+    server.stop()
+
+    samples = len(server.sent)
+    print(f"replayed {samples:,} samples at {'max' if not speed else f'{speed:g}x'} speed in {streamed:.1f}s "
+          f"({samples / streamed:,.0f} samples/s); {len(detections)} events, "
+          f"{len(server.clip_requests)} clip requests, {len(handler.labeled)} labeled windows")
+    print(percentiles("sample -> detection", [detected - server.sent[timestamp]
+                                              for timestamp, detected in detections.items()
+                                              if timestamp in server.sent]))
+    print(percentiles("detection -> clip request", [requested - label_times[payload["stop_time"]]
+                                                    for requested, _, payload in server.clip_requests
+                                                    if payload.get("stop_time") in label_times]))
+    print(percentiles("detection -> labeled pose", [written - label_times[timestamp]
+                                                    for timestamp, written in handler.labeled.items()
+                                                    if timestamp in label_times]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="record a live meter stream")
+    record_parser.add_argument("url")
+    record_parser.add_argument("output")
+    record_parser.add_argument("--duration", type=float, default=600, help="seconds")
+    synthesize_parser = commands.add_parser("synthesize", help="write a synthetic recording")
+    synthesize_parser.add_argument("output")
+    synthesize_parser.add_argument("--duration", type=float, default=300, help="seconds")
+    synthesize_parser.add_argument("--rate", type=float, default=10, help="samples per second")
+    synthesize_parser.add_argument("--period", type=float, default=20, help="seconds between switch-ons")
+    replay_parser = commands.add_parser("replay", help="replay a recording through a receiver")
+    replay_parser.add_argument("recording")
+    replay_parser.add_argument("--speed", type=float, default=1, help="times real time, 0 = as fast as possible")
+    replay_parser.add_argument("--mongo-uri", default=None, help="default: mongomock")
+    replay_parser.add_argument("--threshold", type=float, default=15)
+    replay_parser.add_argument("--save-time", type=float, default=3, help="seconds")
+    replay_parser.add_argument("--drain", type=float, default=3, help="seconds to wait for labels after the end")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.url, args.output, args.duration)
+    elif args.command == "synthesize":
+        synthesize(args.output, args.duration, args.rate, args.period)
+    else:
+        replay(args.recording, args.speed, args.mongo_uri, args.threshold, args.save_time, args.drain)
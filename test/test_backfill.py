@@ -0,0 +1,52 @@
+"""Tests of backfill.BackfillJob against mongomock. Run from the repository root:
+    python -m pytest test/test_backfill.py
+"""
+import os
+from unittest import mock
+
+import numpy as np
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+os.environ.setdefault("DATABASE_NAME", "calit2")
+
+from app.backfill import BackfillJob  # noqa: E402
+from app.database import MongoDBHandler  # noqa: E402
+
+START = 1700000000000
+
+
+def pose_documents(start, count, persons=1, camera="pi-cam-3", seed=0):
+    """``count`` frames at 30 fps from ``start`` with ``persons`` people."""
+    rng = np.random.default_rng(seed)
+    return [{"service": "pose_detector", "camera_name": camera, "timestamp": start + frame * 1000 // 30,
+             "pose": rng.uniform(0, 1920, size=(3, 25, persons)).round(2).tolist()} for frame in range(count)]
+
+
+@pytest.fixture
+def handler():
+    with mock.patch("app.database.MongoClient", mongomock.MongoClient):
+        handler = MongoDBHandler("mongodb://localhost", "calit2")
+        handler.client
+        yield handler
+
+
+@pytest.mark.parametrize("sampling", ["resample", "ids"])
+def test_mixed_person_counts_keep_every_window(handler, sampling):
+    # One window of single-person frames, then one of two-person frames followed by a few single-person ones
+    handler.get_collection("results").insert_many(
+        pose_documents(START, 160) + pose_documents(START + 100000, 160, persons=2)
+        + pose_documents(START + 105400, 5, seed=1))
+    job = BackfillJob("power-meter-14", START, START + 200000, sampling=sampling)
+    events = [(START + 5000, 1, 5, "first"), (START + 105000, 0, 5, "second")]
+    pose_times, poses, sources = job.fetch_poses(handler, [(START, START + 5000), (START + 99900, START + 106000)])
+    assert poses.dtype == object
+
+    if sampling == "resample":
+        kept, frames = job.resampled_windows(pose_times, poses, sources, events)
+    else:
+        kept, frames = job.sampled_windows(pose_times, poses, events)
+    assert kept == [0, 1]
+    assert [window.shape[-1] for window in frames] == [1, 2]
+    assert [window.shape[-1] for window in job.normalize(frames)] == [1, 2]
@@ -0,0 +1,70 @@
+"""Tests of dataset_export against mongomock. Run from the repository root:
+    python -m pytest test/test_dataset_export.py
+"""
+import os
+import time
+from unittest import mock
+
+import numpy as np
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+os.environ.setdefault("DATABASE_NAME", "calit2")
+
+from app.database import MongoDBHandler  # noqa: E402
+from app.dataset_export import DatasetExporter, PoseDataset  # noqa: E402
+
+START = 1700000000000
+
+
+def labeled_documents(start, count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{"pose": rng.uniform(0, 1, size=(3, 30, 25, 1)).round(3).tolist(), "label": index % 2,
+             "timestamp": start + index * 1000, "version": "v1"} for index in range(count)]
+
+
+@pytest.fixture
+def handler():
+    with mock.patch("app.database.MongoClient", mongomock.MongoClient):
+        handler = MongoDBHandler("mongodb://localhost", "calit2")
+        handler.client
+        yield handler
+
+
+def test_incremental_export_reads_from_the_watermark(handler, tmp_path):
+    collection = handler.get_collection("labeled_poses")
+    collection.insert_many(labeled_documents(START, 10))
+    exporter = DatasetExporter(handler, str(tmp_path), shard_size=4)
+    assert exporter.export(version="v1")["exported"] == 10
+
+    # Two documents share the watermark's timestamp; one of them is new
+    collection.insert_many(labeled_documents(START + 9000, 1, seed=1) + labeled_documents(START + 20000, 3, seed=2))
+    with mock.patch.object(exporter, "exported_ids", side_effect=AssertionError("scanned every id")):
+        assert exporter.export(version="v1")["exported"] == 4
+
+    # A backfilled window older than the watermark is only found when asked for
+    collection.insert_many(labeled_documents(START - 5000, 1, seed=3))
+    assert exporter.export(version="v1")["exported"] == 0
+    assert exporter.export(version="v1", history=True)["exported"] == 1
+
+    dataset = PoseDataset(str(tmp_path))
+    assert len(dataset) == 15
+    assert sorted(dataset.timestamps.tolist()) == sorted(document["timestamp"] for document in collection.find())
+
+
+def test_recent_documents_wait_for_the_next_export(handler, tmp_path):
+    now = int(time.time() * 1000)
+    handler.get_collection("labeled_poses").insert_many(labeled_documents(now - 10000, 5))
+    exporter = DatasetExporter(handler, str(tmp_path))
+    assert exporter.export(settle=60)["exported"] == 0
+    assert exporter.export(settle=0)["exported"] == 5
+
+
+def test_empty_dataset(handler, tmp_path):
+    DatasetExporter(handler, str(tmp_path)).export(version="v1")
+    dataset = PoseDataset(str(tmp_path))
+    assert len(dataset) == 0
+    poses, labels = dataset.take([])
+    assert len(poses) == 0 and len(labels) == 0
+    assert list(dataset.batches(8)) == []
@@ -0,0 +1,166 @@
+"""Tests of database.KafkaMongoConsumer against a fake Kafka consumer and mongomock. Run from the repository root:
+    python -m pytest test/test_kafka_consumer.py
+"""
+import json
+import os
+import time
+from unittest import mock
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+os.environ.setdefault("DATABASE_NAME", "calit2")
+
+from confluent_kafka import KafkaError, KafkaException  # noqa: E402
+from pymongo.errors import AutoReconnect  # noqa: E402
+
+from app.database import KafkaMongoConsumer, MongoDBHandler  # noqa: E402
+
+
+class FakeMessage:
+    def __init__(self, partition, offset, value, topic="poses"):
+        self._topic, self._partition, self._offset, self._value = topic, partition, offset, value
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def value(self):
+        return self._value
+
+
+class FakeConsumer:
+    """Serves the given messages once and records the committed offsets by partition."""
+
+    def __init__(self, messages=(), commit_failures=0):
+        self.messages = list(messages)
+        self.commit_failures = commit_failures
+        self.committed = {}
+        self.commits = 0
+        self.closed = False
+
+    def subscribe(self, topics):
+        pass
+
+    def consume(self, num_messages=1, timeout=-1):
+        messages, self.messages = self.messages[:num_messages], self.messages[num_messages:]
+        return messages
+
+    def commit(self, offsets=None, asynchronous=True):
+        if self.commit_failures:
+            self.commit_failures -= 1
+            raise KafkaException(KafkaError(KafkaError.REBALANCE_IN_PROGRESS))
+        self.commits += 1
+        for partition in offsets:
+            self.committed[partition.partition] = partition.offset
+
+    def close(self):
+        self.closed = True
+
+
+def payload(seq):
+    return json.dumps({"service": "pose_detector", "timestamp": 1700000000000 + seq, "seq": seq}).encode()
+
+
+@pytest.fixture
+def handler():
+    with mock.patch("app.database.MongoClient", mongomock.MongoClient):
+        handler = MongoDBHandler("mongodb://localhost", "calit2")
+        handler.client
+        yield handler
+
+
+def stored(handler):
+    return sorted(document["seq"] for document in handler.get_collection("ingest").find({}, {"seq": 1}))
+
+
+def test_offsets_committed_after_insert(handler):
+    fake = FakeConsumer()
+    consumer = KafkaMongoConsumer(handler, {}, "poses", "ingest", consumer=fake)
+    messages = [FakeMessage(seq % 2, seq // 2, payload(seq)) for seq in range(6)]
+    commits_at_insert = []
+
+    def insert_many(*args, **kwargs):
+        commits_at_insert.append(fake.commits)
+        return type(handler).insert_many(handler, *args, **kwargs)
+
+    with mock.patch.object(handler, "insert_many", side_effect=insert_many):
+        assert consumer.write_batch(messages)
+    assert commits_at_insert == [0]
+    assert stored(handler) == list(range(6))
+    assert fake.committed == {0: 3, 1: 3}
+
+
+def test_write_error_is_retried_without_commit(handler):
+    fake = FakeConsumer()
+    consumer = KafkaMongoConsumer(handler, {}, "poses", "ingest", consumer=fake, retry_delay=0)
+    messages = [FakeMessage(0, seq, payload(seq)) for seq in range(3)]
+    with mock.patch.object(handler, "insert_many", side_effect=AutoReconnect("primary stepped down")):
+        assert not consumer.write_batch(messages)
+    assert fake.committed == {}
+    assert stored(handler) == []
+
+    consumer.running = True
+    failures = [AutoReconnect("primary stepped down")]
+
+    def flaky_insert(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return type(handler).insert_many(handler, *args, **kwargs)
+
+    with mock.patch.object(handler, "insert_many", side_effect=flaky_insert):
+        consumer._write_until_done(messages)
+    assert stored(handler) == [0, 1, 2]
+    assert fake.committed == {0: 3}
+
+
+def test_commit_error_is_retried(handler):
+    fake = FakeConsumer(commit_failures=1)
+    consumer = KafkaMongoConsumer(handler, {}, "poses", "ingest", consumer=fake, retry_delay=0)
+    consumer.running = True
+    consumer._write_until_done([FakeMessage(0, 0, payload(0))])
+    assert consumer.stats["commit_errors"] == 1
+    assert fake.committed == {0: 1}
+
+
+def test_run_writes_every_batch(handler):
+    fake = FakeConsumer([FakeMessage(0, seq, payload(seq)) for seq in range(10)])
+    consumer = KafkaMongoConsumer(handler, {}, "poses", "ingest", batch_size=4, batch_duration=0.01,
+                                  consumer=fake)
+    consumer.start()
+    deadline = time.monotonic() + 5
+    while fake.committed.get(0) != 10 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    consumer.stop()
+    assert fake.closed
+    assert stored(handler) == list(range(10))
+    assert fake.committed == {0: 10}
+
+
+def test_tombstones_are_skipped_and_committed(handler):
+    fake = FakeConsumer()
+    consumer = KafkaMongoConsumer(handler, {}, "poses", "ingest", consumer=fake)
+    assert consumer.write_batch([FakeMessage(0, 0, payload(0)), FakeMessage(0, 1, None), FakeMessage(0, 2, payload(2))])
+    assert stored(handler) == [0, 2]
+    assert consumer.stats["tombstones"] == 1
+    assert fake.committed == {0: 3}
+
+    assert consumer.write_batch([FakeMessage(0, 3, None)])
+    assert fake.committed == {0: 4}
+
+
+def test_decode_values_falls_back_per_payload():
+    assert KafkaMongoConsumer.decode_values([b'{"a": 1}', b'{"b": 2}']) == ([{"a": 1}, {"b": 2}], 0)
+    # Invalid payloads are dropped without shifting the others
+    assert KafkaMongoConsumer.decode_values([b'{"a": 1}', b'{"b"', b'{"c": 3}']) == ([{"a": 1}, {"c": 3}], 1)
+    assert KafkaMongoConsumer.decode_values([b'{"a": 1}', b'1,2', b'{"c": 3}']) == ([{"a": 1}, {"c": 3}], 1)
+    assert KafkaMongoConsumer.decode_values([]) == ([], 0)
@@ -0,0 +1,65 @@
+"""Tests of fetch_poses from the pose ring buffer against the same windows read from mongomock. Run from the
+repository root:
+    python -m pytest test/test_pose_buffer.py
+"""
+import os
+from unittest import mock
+
+import numpy as np
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+os.environ.setdefault("DATABASE_NAME", "calit2")
+
+from app.database import MongoDBHandler  # noqa: E402
+
+START = 1700000000000
+CAMERAS = ("pi-cam-3", "pi-cam-6")
+
+
+def pose_documents(start, count, camera, seed=0):
+    """``count`` frames of one camera at 30 fps from ``start``."""
+    rng = np.random.default_rng(seed)
+    return [{"service": "pose_detector", "camera_name": camera, "timestamp": start + frame * 1000 // 30,
+             "pose": rng.uniform(0, 1920, size=(3, 25, 1)).round(2).tolist()} for frame in range(count)]
+
+
+@pytest.fixture
+def handler():
+    with mock.patch("app.database.MongoClient", mongomock.MongoClient):
+        handler = MongoDBHandler("mongodb://localhost", "calit2")
+        handler.client
+        yield handler
+
+
+def without_buffer(handler, **kwargs):
+    buffer, handler.pose_buffer = handler.pose_buffer, None
+    try:
+        return handler.fetch_poses(**kwargs)
+    finally:
+        handler.pose_buffer = buffer
+
+
+def test_buffered_window_matches_mongodb(handler):
+    # The second camera only starts halfway through the window, so its buffer misses the window
+    documents = pose_documents(START, 300, CAMERAS[0]) + pose_documents(START + 5000, 150, CAMERAS[1], seed=1)
+    documents.sort(key=lambda document: document["timestamp"])
+    handler.get_collection("results").insert_many([dict(document) for document in documents])
+    buffer = handler.enable_pose_buffer(watch=False)
+    for document in documents:
+        buffer.add(document)
+
+    for source in (None, CAMERAS[0], CAMERAS[1]):
+        kwargs = {"timestamp": START + 9500, "past_time": 3, "source": source}
+        expected = without_buffer(handler, **kwargs)
+        misses = buffer.stats["misses"]
+        np.testing.assert_array_equal(handler.fetch_poses(**kwargs), expected)
+        assert buffer.stats["misses"] == misses
+
+    # Read from the buffer of the first camera and from MongoDB for the second
+    kwargs = {"timestamp": START + 6000, "past_time": 3}
+    expected = without_buffer(handler, **kwargs)
+    with mock.patch.object(handler, "_query_frames", wraps=handler._query_frames) as query_frames:
+        np.testing.assert_array_equal(handler.fetch_poses(**kwargs), expected)
+    assert [call.args[-1] for call in query_frames.call_args_list] == [CAMERAS[1]]
@@ -0,0 +1,96 @@
+"""Tests of the fetch_poses window cache against mongomock. Run from the repository root:
+    python -m pytest test/test_window_cache.py
+"""
+import os
+import time
+from unittest import mock
+
+import numpy as np
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+os.environ.setdefault("DATABASE_NAME", "calit2")
+
+from app.database import MongoDBHandler  # noqa: E402
+
+START = 1700000000000
+CAMERAS = ("pi-cam-3", "pi-cam-6")
+
+
+def pose_documents(start, count, cameras=CAMERAS, seed=0):
+    """``count`` frames per camera at 30 fps from ``start``."""
+    rng = np.random.default_rng(seed)
+    return [{"service": "pose_detector", "camera_name": camera, "timestamp": start + frame * 1000 // 30,
+             "pose": rng.uniform(0, 1920, size=(3, 25, 1)).round(2).tolist()}
+            for frame in range(count) for camera in cameras]
+
+
+@pytest.fixture
+def handler():
+    with mock.patch("app.database.MongoClient", mongomock.MongoClient):
+        handler = MongoDBHandler("mongodb://localhost", "calit2")
+        handler.client
+        yield handler
+
+
+def uncached(handler, **kwargs):
+    cache, handler.window_cache = handler.window_cache, None
+    try:
+        return handler.fetch_poses(**kwargs)
+    finally:
+        handler.window_cache = cache
+
+
+def test_overlapping_windows_match_uncached(handler):
+    handler.get_collection("results").insert_many(pose_documents(START, 600))
+    cache = handler.enable_window_cache()
+    requests = [(START + 8000, 3, None), (START + 9000, 3, None), (START + 8000, 3, None),
+                (START + 10000, 5, CAMERAS[0]), (START + 9500, 2, CAMERAS[0])]
+    for timestamp, past_time, source in requests:
+        expected = uncached(handler, timestamp=timestamp, past_time=past_time, source=source)
+        cached = handler.fetch_poses(timestamp=timestamp, past_time=past_time, source=source)
+        np.testing.assert_array_equal(cached, expected)
+    stats = cache.summary()
+    assert stats["tensor_hits"] == 1
+    assert stats["frame_partial_hits"] >= 1
+
+
+def test_empty_interval_is_not_cached(handler):
+    cache = handler.enable_window_cache()
+    assert handler.fetch_poses(timestamp=START + 5000, past_time=3) is None
+    handler.get_collection("results").insert_many(pose_documents(START + 1000, 91))
+    expected = uncached(handler, timestamp=START + 5000, past_time=3)
+    assert expected is not None
+    np.testing.assert_array_equal(handler.fetch_poses(timestamp=START + 5000, past_time=3), expected)
+    assert cache.summary()["frame_hits"] == 0
+
+
+def test_recent_tail_is_not_cached(handler):
+    cache = handler.enable_window_cache(settle=5)
+    now = int(time.time() * 1000)
+    documents = pose_documents(now - 3000, 90)
+    collection = handler.get_collection("results")
+    # Only the first camera's poses of the last three seconds have arrived
+    collection.insert_many([document for document in documents if document["camera_name"] == CAMERAS[0]][:45])
+    handler.fetch_poses(timestamp=now, past_time=3)
+    collection.insert_many([document for document in documents
+                            if document["camera_name"] == CAMERAS[1] or document["timestamp"] >= now - 1500])
+    expected = uncached(handler, timestamp=now, past_time=3)
+    np.testing.assert_array_equal(handler.fetch_poses(timestamp=now, past_time=3), expected)
+    assert cache.summary()["frame_segments"] == 0
+    assert cache.summary()["tensors"] == 0
+
+
+def test_eviction_by_size_and_age(handler):
+    handler.get_collection("results").insert_many(pose_documents(START, 600))
+    cache = handler.enable_window_cache(max_frame_bytes=200000, max_tensor_bytes=20000)
+    for offset in range(0, 15000, 3000):
+        handler.fetch_poses(timestamp=START + 5000 + offset, past_time=3, source=CAMERAS[0])
+    stats = cache.summary()
+    assert stats["evicted_size"] > 0
+    assert stats["frame_bytes"] <= 200000 and stats["tensor_bytes"] <= 20000
+
+    cache.max_age = 0
+    handler.fetch_poses(timestamp=START + 5000, past_time=3, source=CAMERAS[0])
+    assert cache.summary()["evicted_age"] > 0